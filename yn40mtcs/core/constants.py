@@ -28,7 +28,8 @@ class STATE(Enum):
     STOP=22
     ACU_ERR=23
     UNKNOWN=24
+    TRACKBODY=25
 
 STATE_NAMES = [None, "ON", "OFF", "CLOSE", "OPEN", "INSERT", "EXTRACT", "IDLE", "MOVING", "STANDBY", \
                 "LIMIT", "TRACKAZEL", "TRACKRADEC", "FAULT", "INIT", "RUNNING", "ALARM", "DISABLE", \
-                "HEALTH", "ERROR", "POWEROFF", "QUERY", "STOP", "ACU_ERR", "UNKNOWN"]
\ No newline at end of file
+                "HEALTH", "ERROR", "POWEROFF", "QUERY", "STOP", "ACU_ERR", "UNKNOWN", "TRACKBODY"]
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os
 import sys
 import threading
+import time
 import logging
 
 import numpy as np
@@ -9,13 +10,15 @@ from yn40mtcs.core.device import Device
 from yn40mtcs.core.utils import get_parameter, data_path
 from yn40mtcs.core.attribute import Attribute
 from yn40mtcs.core.constants import *
-from yn40mtcs.func import acu39, conv_coord, virtualacu
+from yn40mtcs.func import acu39, conv_coord, coordservice, ephemeris, pointingmodel, virtualacu, weather
+from yn40mtcs.func.trajectory import Trajectory
 
 logger = logging.getLogger('{}.device.{}'.format(LOGGER_NAME, __name__))
 class Telescope(Device):
     def __init__(self, config):
         super(Telescope, self).__init__(config)
         self._lock = threading.Lock()
+        self._Trajectory = None
         self.declare_attributes()
         self.read_config()
         self.Threads = []
@@ -35,13 +38,32 @@ class Telescope(Device):
         self.EL_off = Attribute('EL_off', 'EL_off', value=0, unit="deg", group='Basic', description="Position offset EL") 
 
         self.sourcename= Attribute('SourceName', 'SourceName', value='', unit="", group='Basic', description="Source Name") 
+        self.PM_version = Attribute('PM_version', 'PM_version', value=0, unit="", group='Basic', description="Pointing model version of the last command")
     
     def read_config(self):
         self._Longitude = [float(v) for v in self.config.longitude.split(':')]
         self._Latitude = [float(v) for v in self.config.latitude.split(':')]
         self._Height = self.config.h
-        self._Atmosphere = self.config.atmosphere
-        self._PointingParameter = np.loadtxt(data_path(self.config.pointing_par))  # Read parameters from new_pointing_par.txt
+        self._Atmosphere = [float(v) for v in str(self.config.atmosphere).split(',')]
+        # versioned pointing model with the optional residual map, reloaded
+        # when either file changes or by the Model command; the correction
+        # grid ('bilinear' or 'bicubic') is tabulated with each version,
+        # None evaluates the model. The plain vpar.txt gives no corrections,
+        # and the grid and the map wait for a verified basis of the terms
+        grid = {}
+        residual = self.config.getValue('pointing_residual')
+        if not pointingmodel.VERIFIED:
+            if self.config.getValue('pointing_grid') or residual:
+                logger.warning('pointing_grid and pointing_residual ignored, the pointing model basis {} is provisional'.format(
+                               pointingmodel.BASIS))
+            residual = None
+        elif self.config.getValue('pointing_grid'):
+            grid = {'method': self.config.pointing_grid, 'tol': float(self.config.getValue('pointing_grid_tol', pointingmodel.GRID_TOL))}
+        self._PointingModels = pointingmodel.ModelStore(data_path(self.config.pointing_par),
+                                                        residual and data_path(residual), **grid)
+        if self.config.getValue('pointing_watch'):
+            self._PointingModels.watch(float(self.config.pointing_watch))
+        self._ApplyPointing = bool(self.config.getValue('apply_pointing', False))
 
 
         # Selecting the virtual control device
@@ -54,8 +76,219 @@ class Telescope(Device):
             sys.exit(0)
 
         # Ra-Dec to Az-El
-        self._CoorGeo = conv_coord.CoordGeometry(iersfile=self.config.iers_fil, ephfile=self.config.eph_fil)
+        self._CoorGeo = conv_coord.CoordGeometry(iersfile=self.config.iers_fil, ephfile=self.config.eph_fil,
+                                                 precision=self.config.getValue('precision', 'full'))
+        self._CoorGeo.observer.update(self._Longitude + self._Latitude + [self._Height], self._Atmosphere)
+        # pick up a new finals2000A.all dropped into the data directory
+        self._CoorGeo.EOP.watch(data_path('finals2000A.all'))
+        # predictive command timing: the ACU acts on a position acu_latency (s)
+        # after it is sent, and moves straight between commands; updates are
+        # spaced so that this stays within track_tol (arcsec) of the track
+        self._AcuLatency = float(self.config.getValue('acu_latency', 0.))
+        self._TrackTol = float(self.config.getValue('track_tol', 1.))
+        self._TrackInterval = tuple(self.config.getValue('track_interval', (0.1, 2.)))
+        # tracks computed by the coordinate service process instead of this one
+        self._CoordService = None
+        if self.config.getValue('coord_service'):
+            state = self._CoorGeo.observer.state
+            self._CoordService = coordservice.connect(self.config.coord_service, state.SC, state.MCOW,
+                                                      self.config.getValue('coord_service_key'),
+                                                      backend=self.config.coord_converter,
+                                                      iersfile=self.config.iers_fil, ephfile=self.config.eph_fil,
+                                                      precision=self.config.getValue('precision', 'full'))
+        # live weather for the refraction, 'atmosphere' is the starting value
+        self._Weather = None
+        if self.config.getValue('weather_source'):
+            self._Weather = weather.WeatherStation(self._CoorGeo.observer, self.config.weather_source,
+                                                   on_update=self._weather_changed)
+            self._Weather.start()
+
+    def _weather_changed(self, state):
+        '''
+            new weather in the observer: the track is refitted from now on
+            and the coordinate service gets it for its samples ahead of now
+        '''
+        trajectory = self._Trajectory
+        if isinstance(trajectory, Trajectory):
+            trajectory.invalidate()
+        if self._CoordService is not None:
+            self._CoordService.set_observer(MCOW=state.MCOW)
         
+    #--------------------Source trajectory--------------------
+    def TrackRADEC(self, ra, dec):
+        '''
+            ra, dec: 'hh:mm:ss.s' '+dd:mm:ss.s'
+            The az/el track is precomputed in the background, the control
+            loop reads it through source_azel()
+        '''
+        _ra, _dec = conv_coord._parse_cos(ra + ' ' + dec)
+        _backend = self.config.coord_converter
+        def reduce(t):
+            # site and weather from the observer context of _CoorGeo
+            return self._CoorGeo.radec2azel_batch(_ra, _dec, t, backend=_backend)
+        if self._CoordService is not None:
+            trajectory = self._CoordService.track(_ra, _dec, fallback=reduce)
+        else:
+            trajectory = Trajectory(reduce)
+            trajectory.start()
+        with self._lock:
+            old, self._Trajectory = self._Trajectory, trajectory
+            self.RA_obj.value = ra
+            self.DEC_obj.value = dec
+            self.state = STATE.TRACKRADEC
+        if old is not None:
+            old.stop()
+        logger.info('Tracking RA={} DEC={}'.format(ra, dec))
+
+    def TrackBody(self, body):
+        '''
+            body: solar system body of the JPL ephemeris ('Moon', 'Sun', 'Mars' ...)
+            The topocentric apparent az/el is tabulated as Chebyshev segments,
+            one span before the command returns and the rest of the observing
+            window (body_window, s) in the background; the control loop
+            interpolates it through source_azel()
+        '''
+        target = ephemeris.BODIES.get(body.lower())
+        if target is None:
+            logger.error('unknown body {}, one of {}'.format(body, ', '.join(sorted(ephemeris.BODIES))))
+            return False
+        def reduce(t):
+            # site and weather from the observer context of _CoorGeo
+            return self._CoorGeo.body2azel_batch(target, t)
+        trajectory = Trajectory(reduce, lead=float(self.config.getValue('body_window', 3600.)))
+        trajectory.start(first=trajectory.span)
+        with self._lock:
+            old, self._Trajectory = self._Trajectory, trajectory
+            self.sourcename.value = body
+            self.RA_obj.value = ''
+            self.DEC_obj.value = ''
+            self.state = STATE.TRACKBODY
+        if old is not None:
+            old.stop()
+        logger.info('Tracking body {}'.format(body))
+        return True
+
+    @property
+    def _PointingParameter(self):
+        # coefficients of the pointing model in use
+        return self._PointingModels.coef
+
+    def PointingModel(self, par, az, el):
+        '''
+            dAz, dEl (deg) of the pointing model par at az, el (deg),
+            scalars or arrays
+        '''
+        model = self._PointingModels.model
+        if par is not model.coef:
+            # coefficients as in vpar.txt, of no verified basis
+            model = pointingmodel.PointingModel(par, basis='')
+        return model.correct(az, el)
+
+    def LoadPointingModel(self, version=None):
+        '''
+            reload pointing_par, put a version of its history in use, or
+            with 'fit' the latest model the pointing fit wrote to
+            pointing_fit, which is refused until the basis of the terms is
+            verified; the control loop picks the new model up at its next
+            command
+        '''
+        try:
+            if version is None:
+                self._PointingModels.reload()
+            elif version=='fit':
+                pointingmodel.require_basis('Model fit')
+                self._PointingModels.reload(data_path(self.config.pointing_fit))
+            else:
+                self._PointingModels.install(int(version))
+        except (OSError, ValueError) as msg:
+            logger.error('pointing model not loaded: {}'.format(msg))
+            return False
+        logger.info('pointing model version {}'.format(self._PointingModels.version))
+        return True
+
+    def source_azel(self, t=None):
+        '''
+            Az/El (deg) of the tracked source at UNIX time t (default now)
+        '''
+        trajectory = self._Trajectory
+        if trajectory is None:
+            return None
+        return trajectory.evaluate(t)
+
+    def track_command(self, t=None):
+        '''
+            Az, El (deg) and their rates (deg/s) to send at UNIX time t
+            (default now), predicted for when the ACU acts on them, the UNIX
+            time of the next update and the version of the pointing model,
+            which is added when apply_pointing is set; None when nothing is
+            tracked
+        '''
+        trajectory = self._Trajectory
+        if trajectory is None:
+            return None
+        if t is None:
+            t = time.time()
+        model = self._PointingModels.model
+        az, el, daz, dele, ddaz, ddel = [float(v[0]) for v in trajectory.evaluate_rates(t + self._AcuLatency)]
+        # a straight move between commands dt apart misses the track by acc*dt^2/8
+        acc = np.hypot(ddaz*np.cos(np.deg2rad(el)), ddel)*3600.
+        lo, hi = self._TrackInterval
+        interval = hi if acc==0. else float(np.clip(np.sqrt(8.*self._TrackTol/acc), lo, hi))
+        if self._ApplyPointing:
+            dAz, dEl = model.correct(az, el)
+            az += dAz
+            el += dEl
+        return az, el, daz, dele, t + interval, model.version
+
+    def send_track(self, t=None):
+        '''
+            send the predicted position of the tracked source with the offsets,
+            and the rates as feed-forward when the hardware takes them
+            return: UNIX time of the next update, None when nothing is tracked
+        '''
+        command = self.track_command(t)
+        if command is None:
+            return None
+        az, el, daz, dele, tnext, version = command
+        self.AZ_obj.value = (az + self.AZ_off.value) % 360.
+        self.EL_obj.value = el + self.EL_off.value
+        self.PM_version.value = version
+        if getattr(self.Hardware, 'feed_forward', False):
+            self.Hardware.point_to(self.AZ_obj.value, self.EL_obj.value, daz, dele)
+        else:
+            self.Hardware.point_to(self.AZ_obj.value, self.EL_obj.value)
+        return tnext
+
+    #--------------------Control loop--------------------
+    def _control_loop(self, stop):
+        '''
+            send the track commands at the times track_command asks for,
+            poll at the shortest update interval while nothing is tracked
+        '''
+        while not stop.is_set():
+            try:
+                tnext = self.send_track()
+            except Exception as msg:
+                logger.error('track command failed: {}'.format(msg))
+                tnext = None
+            if tnext is None:
+                tnext = time.time() + self._TrackInterval[0]
+            stop.wait(max(tnext - time.time(), 0.))
+
+    def StartControlThread(self):
+        if self.Threads:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=self._control_loop, args=(stop,), daemon=True)
+        thread.start()
+        self.Threads.append((thread, stop))
+
+    def StopControlThread(self):
+        for thread, stop in self.Threads:
+            stop.set()
+            thread.join()
+        self.Threads = []
+
     #--------------------Display antenna status information--------------------
     def show_state(self):
         if self.state.value == 'EXIT':
@@ -74,6 +307,7 @@ class Telescope(Device):
         print('RA_obj: {}'.format(self.RA_obj.value))
         print('DEC_obj: {}'.format(self.DEC_obj.value))
         print('----------Point Model-------------------')
+        print('version {}'.format(self._PointingModels.version))
         print(self._PointingParameter)
         print('----------Pointing state ---------------')
         if self.Isready():
@@ -94,7 +328,9 @@ class Telescope(Device):
         print('Tell                Telescope state')
         print('AZEL AZ EL          Point telescope to given AZ EL')
         print('RADEC RA DEC        Keep telescope track to given RA DEC')
+        print('BODY NAME           Keep telescope track to a solar system body (Moon, Sun, Mars ...)')
         print('Off RA_off DEC_off  Set offsets')
+        print('Model [VERSION]     Reload the pointing model, or put a version of it in use')
         print('Start               Start control loop')
         print('Halt                Stop telescope')
         print('Exit                Exit current program')
@@ -129,6 +365,13 @@ class Telescope(Device):
                 self.TrackRADEC(ra,dec)
             else:
                 logger.error('Missing operation variable')
+        elif cmds[0]=='BODY':
+            if len(cmds) >= 2:
+                self.TrackBody(cmds[1])
+            else:
+                logger.error('Missing operation variable')
+        elif cmds[0]=='Model':
+            self.LoadPointingModel(cmds[1] if len(cmds)>=2 else None)
         elif cmds[0]=='Off':
             if len(cmds)>=3:
                 az_off = float(cmds[1])
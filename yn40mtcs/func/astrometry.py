@@ -0,0 +1,493 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    star-independent astrometry context basing SOFA iauApco13,
+    quick ICRS -> observed transformation for any number of sources
+    Date   : Oct. 18th 2026
+'''
+
+import copy
+import ctypes
+import itertools
+import logging
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from . import sofaswig as sofa
+from yn40mtcs.core.constants import LOGGER_NAME
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+DJ00 = 2451545.0
+AU_M = 149597870700.  # astronomical unit (m)
+AU_LT = 499.004783836  # light time for 1 au (s)
+
+# Precision tiers of the observed-place reduction
+#   bodies:   light deflection that is applied
+#   nutation: IAU 2000A (IAU 2006/2000A, iauPnm06a) or IAU 2000B (iauPnm00b)
+#   refresh:  how long the slow terms (precession-nutation, Earth ephemeris,
+#             aberration) are reused (s), the Earth rotation angle is always exact
+# Accuracy envelope against 'full', above 5 deg elevation:
+#   standard: < 1 mas, more only within a few arcmin of Jupiter/Saturn (< 17 mas at the limb)
+#   fast:     < 2 mas, same caveat
+# (python -m yn40mtcs.func.conv_coord tiers)
+PRECISION_TIERS = {
+    'full':     {'bodies': ('Sun', 'Jupiter', 'Saturn'), 'nutation': '2000A', 'refresh': 0.},
+    'standard': {'bodies': ('Sun',), 'nutation': '2000A', 'refresh': 1.},
+    'fast':     {'bodies': ('Sun',), 'nutation': '2000B', 'refresh': 60.},
+}
+
+def _swig_array(ptr, shape):
+    '''
+    copy a double array behind a SWIG pointer into numpy
+    '''
+    size = int(np.prod(shape))
+    buf = (ctypes.c_double*size).from_address(int(ptr))
+    return np.array(buf, dtype=float).reshape(shape)
+
+def era00(dj1, dj2):
+    '''
+    Earth rotation angle (IAU 2000), vectorized iauEra00
+    dj1, dj2: UT1 as a 2-part Julian Date
+    '''
+    dj1 = np.asarray(dj1, dtype=float)
+    dj2 = np.asarray(dj2, dtype=float)
+    t = (dj1 - DJ00) + dj2
+    f = np.fmod(dj1, 1.0) + np.fmod(dj2, 1.0)
+    return np.mod(2*np.pi*(f + 0.7790572732640 + 0.00273781191135448*t), 2*np.pi)
+
+def utc2tt(utc1, utc2):
+    '''
+    UTC -> TT, 2-part Julian Date arrays (iauUtctai + iauTaitt per epoch)
+    '''
+    utc1, utc2 = np.broadcast_arrays(np.atleast_1d(np.asarray(utc1, dtype=float)),
+                                     np.atleast_1d(np.asarray(utc2, dtype=float)))
+    tt1 = np.empty(len(utc1))
+    tt2 = np.empty(len(utc1))
+    tai1, tai2, t1, t2 = [sofa.doublep() for i in range(4)]
+    for i in range(len(utc1)):
+        if sofa.iauUtctai(utc1[i], utc2[i], tai1, tai2)<0:
+            raise ValueError('iauUtctai: unacceptable date {} {}'.format(utc1[i], utc2[i]))
+        sofa.iauTaitt(tai1.value(), tai2.value(), t1, t2)
+        tt1[i], tt2[i] = t1.value(), t2.value()
+    return tt1, tt2
+
+def site2rad(SC):
+    '''
+    SC: [lon_d, lon_m, lon_s, lat_d, lat_m, lat_s, height] as used by CoordGeometry
+    return: east longitude(rad), latitude(rad), height(m)
+    '''
+    elong = np.deg2rad(SC[0]+SC[1]/60.+SC[2]/3600.)
+    phi = np.deg2rad(SC[3]+SC[4]/60.+SC[5]/3600.)
+    return elong, phi, float(SC[6])
+
+def refco(MCOW):
+    '''
+    refraction constants A, B (rad) of iauRefco for
+    MCOW = [pressure(hPa), temperature(C), humidity(0-1), wavelength(um)]
+    '''
+    refa = sofa.doublep()
+    refb = sofa.doublep()
+    sofa.iauRefco(float(MCOW[0]), float(MCOW[1]), float(MCOW[2]), float(MCOW[3]), refa, refb)
+    return refa.value(), refb.value()
+
+ObserverState = namedtuple('ObserverState', ['revision', 'SC', 'MCOW', 'elong', 'phi', 'hm', 'xyz', 'refa', 'refb'])
+
+class ObserverContext(object):
+    '''
+    site and weather of the observer with the quantities derived from them:
+    longitude, latitude, height, geocentric site vector (m, iauGd2gc WGS84)
+    and the refraction constants (iauRefco)
+
+    Each input is compared with the current one and the derived quantities
+    are only recomputed when it changed. The whole state is one ObserverState
+    replaced in a single assignment; its revision counts the changes so that
+    users can tell whether their own caches are still valid. resolve() gives
+    the state of explicit values for one call without publishing it.
+    '''
+    def __init__(self, SC, MCOW):
+        '''
+        SC:   [lon_d, lon_m, lon_s, lat_d, lat_m, lat_s, height]
+        MCOW: [pressure(hPa), temperature(C), humidity(0-1), wavelength(um)]
+        '''
+        self._lock = threading.Lock()
+        self.state = None
+        # revisions of the states of resolve() count down from -1, apart
+        # from those of the published states
+        self._temporaries = itertools.count(-1, -1)
+        self._temporary = None
+        self.update(SC, MCOW)
+
+    @staticmethod
+    def _derive(revision, SC, MCOW, state):
+        '''
+        ObserverState of SC, MCOW (tuples of floats), reusing what does not
+        change from state (None derives everything)
+        '''
+        if state is None or SC!=state.SC:
+            elong, phi, hm = site2rad(SC)
+            xyz = sofa.doubleArray(3)
+            sofa.iauGd2gc(1, elong, phi, hm, xyz)
+            xyz = np.array([xyz[i] for i in range(3)])
+        else:
+            elong, phi, hm, xyz = state.elong, state.phi, state.hm, state.xyz
+        if state is None or MCOW!=state.MCOW:
+            refa, refb = refco(MCOW)
+        else:
+            refa, refb = state.refa, state.refb
+        return ObserverState(revision, SC, MCOW, elong, phi, hm, xyz, refa, refb)
+
+    def update(self, SC=None, MCOW=None):
+        '''
+        set the site and/or the weather, None keeps the current value
+        return: the current ObserverState
+        '''
+        state = self.state
+        if state is not None and (SC is None or tuple(SC)==state.SC) and (MCOW is None or tuple(MCOW)==state.MCOW):
+            return state
+        with self._lock:
+            state = self.state
+            if state is None:
+                revision, site, weather = 0, None, None
+            else:
+                revision, site, weather = state.revision, state.SC, state.MCOW
+            SC = site if SC is None else tuple(float(v) for v in SC)
+            MCOW = weather if MCOW is None else tuple(float(v) for v in MCOW)
+            if SC!=site or MCOW!=weather:
+                state = self._derive(revision + 1, SC, MCOW, state)
+                self.state = state
+            return state
+
+    def resolve(self, SC=None, MCOW=None):
+        '''
+        state for one call: the current one, or for explicit site and/or
+        weather that differ from it a state that is not published, so the
+        observer shared by Telescope, WeatherStation and the trajectories
+        is left as it is; the last such state is reused for the same values
+        '''
+        state = self.state
+        if (SC is None or tuple(SC)==state.SC) and (MCOW is None or tuple(MCOW)==state.MCOW):
+            return state
+        SC = state.SC if SC is None else tuple(float(v) for v in SC)
+        MCOW = state.MCOW if MCOW is None else tuple(float(v) for v in MCOW)
+        temporary = self._temporary
+        if temporary is None or temporary.SC!=SC or temporary.MCOW!=MCOW:
+            temporary = self._derive(next(self._temporaries), SC, MCOW, state)
+            self._temporary = temporary
+        return temporary
+
+    def set_site(self, SC):
+        return self.update(SC=SC)
+
+    def set_weather(self, pressure=None, temperature=None, humidity=None, wavelength=None):
+        '''
+        live weather values, None keeps the current value
+        '''
+        MCOW = list(self.state.MCOW)
+        for i, v in enumerate([pressure, temperature, humidity, wavelength]):
+            if v is not None:
+                MCOW[i] = float(v)
+        return self.update(MCOW=MCOW)
+
+def _apco00b(utc1, utc2, dut1, elong, phi, hm, xp, yp, phpa, tc, rh, wl, astrom, eo):
+    '''
+    iauApco13 with the IAU 2000B precession-nutation model
+    '''
+    d = [sofa.doublep() for i in range(8)]
+    tai1, tai2, tt1, tt2, ut11, ut12, x, y = d
+    j = sofa.iauUtctai(utc1, utc2, tai1, tai2)
+    if j<0:
+        return j
+    sofa.iauTaitt(tai1.value(), tai2.value(), tt1, tt2)
+    if sofa.iauUtcut1(utc1, utc2, dut1, ut11, ut12)<0:
+        return -1
+    tt1, tt2 = tt1.value(), tt2.value()
+
+    # Earth barycentric and heliocentric position/velocity (TDB ~ TT)
+    ehpv = sofa.Create2DArray23()
+    ebpv = sofa.Create2DArray23()
+    sofa.iauEpv00(tt1, tt2, ehpv, ebpv)
+    ehp = sofa.doubleArray(3)
+    for i in range(3):
+        ehp[i] = sofa.GetElem2DArray23(ehpv, 0, i)
+
+    # CIP and CIO from the IAU 2000B bias-precession-nutation matrix
+    r = sofa.Create2DArray33()
+    sofa.iauPnm00b(tt1, tt2, r)
+    sofa.iauBpn2xy(r, x, y)
+    s = sofa.iauS00(tt1, tt2, x.value(), y.value())
+    theta = sofa.iauEra00(ut11.value(), ut12.value())
+    sp = sofa.iauSp00(tt1, tt2)
+    refa = sofa.doublep()
+    refb = sofa.doublep()
+    sofa.iauRefco(phpa, tc, rh, wl, refa, refb)
+    sofa.iauApco(tt1, tt2, ebpv, ehp, x.value(), y.value(), s, theta, elong, phi, hm, xp, yp, sp,
+                 refa.value(), refb.value(), astrom)
+    eo.assign(sofa.iauEors(r, s))
+    return j
+
+class AstrometryContext(object):
+    '''
+    star-independent parameters of one epoch and one site (SOFA iauASTROM)
+
+    The context is immutable once built, so several callers (control loop,
+    cross scan, GUI) can share it. Positions at other instants inside the
+    validity window only need a new Earth rotation angle, the slower terms
+    (precession-nutation, Earth ephemeris, aberration) are taken from the
+    reference epoch.
+    '''
+    def __init__(self, utc1, utc2, dut1, xp, yp, SC, MCOW, window=10., nutation='2000A'):
+        '''
+        utc1, utc2: UTC as a 2-part quasi Julian Date
+        dut1:       UT1-UTC (s)
+        xp, yp:     polar motion (arcsec)
+        SC:         site coordinate, see site2rad
+        MCOW:       [pressure(hPa), temperature(C), humidity(0-1), wavelength(um)]
+        window:     validity window of the slow terms (s)
+        nutation:   '2000A' (iauApco13) or '2000B' (iauPnm00b + iauApco)
+        '''
+        self.utc1 = float(utc1)
+        self.utc2 = float(utc2)
+        self.dut1 = float(dut1)
+        self.window = float(window)
+        self.nutation = nutation
+        self.SC = tuple(SC)
+        self.MCOW = tuple(MCOW)
+        elong, phi, hm = site2rad(SC)
+        astrom = sofa.iauASTROM()
+        eo = sofa.doublep()
+        args = (self.utc1, self.utc2, self.dut1, elong, phi, hm,
+                np.deg2rad(xp/3600.), np.deg2rad(yp/3600.),
+                float(MCOW[0]), float(MCOW[1]), float(MCOW[2]), float(MCOW[3]),
+                astrom, eo)
+        if nutation=='2000A':
+            j = sofa.iauApco13(*args)
+        elif nutation=='2000B':
+            j = _apco00b(*args)
+        else:
+            raise ValueError('unknown nutation model {}'.format(nutation))
+        if j<0:
+            raise ValueError('iauApco13: unacceptable date {} {}'.format(utc1, utc2))
+        elif j>0:
+            logger.debug('iauApco13: dubious year {} {}'.format(utc1, utc2))
+
+        self.eo = eo.value()
+        self.em = astrom.em
+        self.eh = _swig_array(astrom.eh, (3,))
+        self.v = _swig_array(astrom.v, (3,))
+        self.bm1 = astrom.bm1
+        self.bpn = _swig_array(astrom.bpn, (3, 3))
+        self.along = astrom.along
+        self.xpl = astrom.xpl
+        self.ypl = astrom.ypl
+        self.sphi = astrom.sphi
+        self.cphi = astrom.cphi
+        self.diurab = astrom.diurab
+        self.eral = astrom.eral
+        self.refa = astrom.refa
+        self.refb = astrom.refb
+
+    def with_weather(self, MCOW, refa, refb):
+        '''
+        copy of the context for other weather, only the refraction constants change
+        '''
+        ctx = copy.copy(self)
+        ctx.MCOW = tuple(MCOW)
+        ctx.refa = refa
+        ctx.refb = refb
+        return ctx
+
+    def covers(self, utc1, utc2):
+        '''
+        whether the UTC epoch lies inside the validity window
+        '''
+        return abs((utc1 - self.utc1) + (utc2 - self.utc2))*86400. <= self.window
+
+    def atciq(self, rc, dc):
+        '''
+        ICRS RA,Dec (rad) -> CIRS RA,Dec (rad), vectorized iauAtciq with
+        zero proper motion and parallax (light deflection by the Sun, aberration)
+        '''
+        rc = np.asarray(rc, dtype=float)
+        dc = np.asarray(dc, dtype=float)
+        cd = np.cos(dc)
+        p = np.stack([cd*np.cos(rc), cd*np.sin(rc), np.sin(dc)], axis=-1)
+        p = self._cirs(p)
+        ri = np.mod(np.arctan2(p[..., 1], p[..., 0]), 2*np.pi)
+        di = np.arctan2(p[..., 2], np.hypot(p[..., 0], p[..., 1]))
+        return ri, di
+
+    def _cirs(self, p, deflect=True, q=None):
+        '''
+        ICRS unit vectors (..., 3) -> CIRS unit vectors, light deflection
+        by the Sun (unless deflect is False), aberration and
+        bias-precession-nutation
+        q: unit vectors from the Sun to sources at a finite distance
+           (iauLd), default p for sources at infinity (iauLdsun)
+        '''
+        # Light deflection by the Sun (iauLd)
+        em = self.em
+        if deflect:
+            e = self.eh
+            if q is None:
+                q = p
+            dlim = 1e-6/max(em*em, 1.0)
+            qdqpe = 1.0 + q.dot(e)
+            w = sofa.SRS/em/np.maximum(qdqpe, dlim)
+            eq = np.cross(e, q)
+            p = p + w[..., np.newaxis]*np.cross(p, eq)
+
+        # Aberration (iauAb)
+        v = self.v
+        pdv = p.dot(v)
+        w1 = 1.0 + pdv/(1.0 + self.bm1)
+        w2 = sofa.SRS/em
+        p = p*self.bm1 + w1[..., np.newaxis]*v + w2*(v - pdv[..., np.newaxis]*p)
+        p = p/np.sqrt((p*p).sum(axis=-1))[..., np.newaxis]
+
+        # Bias-precession-nutation, giving CIRS proper direction
+        return p.dot(self.bpn.T)
+
+    def atioq(self, ri, di, eral=None):
+        '''
+        CIRS RA,Dec (rad) -> observed azimuth and zenith distance (rad),
+        vectorized iauAtioq
+        eral: Earth rotation angle + longitude, default is the context epoch
+        '''
+        CELMIN = 1e-6
+        SELMIN = 0.05
+        if eral is None:
+            eral = self.eral
+        ri = np.asarray(ri, dtype=float)
+        di = np.asarray(di, dtype=float)
+
+        # CIRS RA,Dec to Cartesian -HA,Dec
+        cd = np.cos(di)
+        x = cd*np.cos(ri - eral)
+        y = cd*np.sin(ri - eral)
+        z = np.sin(di)*np.ones_like(x)
+
+        # Polar motion
+        sx = np.sin(self.xpl)
+        cx = np.cos(self.xpl)
+        sy = np.sin(self.ypl)
+        cy = np.cos(self.ypl)
+        xhd = cx*x + sx*z
+        yhd = sx*sy*x + cy*y - cx*sy*z
+        zhd = -sx*cy*x + sy*y + cx*cy*z
+
+        # Diurnal aberration
+        f = 1.0 - self.diurab*yhd
+        xhdt = f*xhd
+        yhdt = f*(yhd + self.diurab)
+        zhdt = f*zhd
+
+        # Cartesian -HA,Dec to Cartesian Az,El (S=0,E=90)
+        xaet = self.sphi*xhdt - self.cphi*zhdt
+        yaet = yhdt
+        zaet = self.cphi*xhdt + self.sphi*zhdt
+
+        # Azimuth (N=0,E=90)
+        azobs = np.where((xaet!=0.0) | (yaet!=0.0), np.arctan2(yaet, -xaet), 0.0)
+
+        # Refraction, A*tan(z)+B*tan^3(z) model with Newton-Raphson correction
+        r = np.maximum(np.hypot(xaet, yaet), CELMIN)
+        z = np.maximum(zaet, SELMIN)
+        tz = r/z
+        w = self.refb*tz*tz
+        dl = (self.refa + w)*tz/(1.0 + (self.refa + 3.0*w)/(z*z))
+        cosdel = 1.0 - dl*dl/2.0
+        f = cosdel - dl*z/r
+        xaeo = xaet*f
+        yaeo = yaet*f
+        zaeo = cosdel*zaet + dl*r
+        zdobs = np.arctan2(np.hypot(xaeo, yaeo), zaeo)
+        return np.mod(azobs, 2*np.pi), zdobs
+
+    def eral_at(self, utc1, utc2):
+        '''
+        Earth rotation angle + longitude at other UTC epochs (vectorized)
+        '''
+        return era00(utc1, np.asarray(utc2) + self.dut1/86400.) + self.along
+
+    def body2azel(self, pos, xyz, utc1=None, utc2=None, deflect=True):
+        '''
+        pos:        geocentric astrometric position of a solar system body
+                    (au, ICRS, light time applied), array (..., 3)
+        xyz:        geocentric site vector (m, ITRS), e.g. ObserverState.xyz
+        utc1, utc2: UTC epochs inside the validity window, default is the context epoch
+        deflect:    light deflection by the Sun, False for the Sun itself
+        return:     topocentric observed Az, El in degrees
+
+        Deflection for the body distance (as iauAtciqn, nil for the Moon)
+        and annual aberration are applied to the geocentric direction, then
+        the site is moved off the geocentre (parallax) in the CIRS before the
+        diurnal aberration and refraction of atioq.
+        '''
+        pos = np.asarray(pos, dtype=float)
+        dist = np.sqrt((pos*pos).sum(axis=-1))
+        # body seen from the Sun
+        q = pos + self.em*self.eh
+        q = q/np.sqrt((q*q).sum(axis=-1))[..., np.newaxis]
+        p = self._cirs(pos/dist[..., np.newaxis], deflect, q)*dist[..., np.newaxis]
+        eral = self.eral if utc1 is None else self.eral_at(utc1, utc2)
+        # site in the CIRS, polar motion neglected (< 10 uas for the Moon)
+        rho = np.hypot(xyz[0], xyz[1])/AU_M
+        q = p - np.stack(np.broadcast_arrays(rho*np.cos(eral), rho*np.sin(eral), xyz[2]/AU_M), axis=-1)
+        ri = np.mod(np.arctan2(q[..., 1], q[..., 0]), 2*np.pi)
+        di = np.arctan2(q[..., 2], np.hypot(q[..., 0], q[..., 1]))
+        aob, zob = self.atioq(ri, di, eral)
+        return np.rad2deg(aob), 90. - np.rad2deg(zob)
+
+    def radec2azel(self, ra, dec, utc1=None, utc2=None):
+        '''
+        ra, dec:    ICRS coordinates (rad), numpy broadcasting applies
+        utc1, utc2: UTC epochs inside the validity window, default is the context epoch
+        return:     Az, El in degrees
+        '''
+        ri, di = self.atciq(ra, dec)
+        eral = None if utc1 is None else self.eral_at(utc1, utc2)
+        aob, zob = self.atioq(ri, di, eral)
+        return np.rad2deg(aob), 90. - np.rad2deg(zob)
+
+if __name__=='__main__':
+    import sys
+    import time
+    print('testing astrometry.py')
+    sc = [102, 47, 45.6, 25, 1, 40.8, 1974.0]
+    m = [800, 25, 0.5, 50000]
+    utc1, utc2 = 2460197.5, 0.6043113425925926
+    ctx = AstrometryContext(utc1, utc2, 0.0150, 0.2293, 0.2801, sc, m)
+
+    # quick transform against SOFA iauAtco13 for the same epoch
+    ra = np.random.uniform(0, 2*np.pi, 2000)
+    dec = np.arcsin(np.random.uniform(-1, 1, 2000))
+    elong, phi, hm = site2rad(sc)
+    aob, zob, hob, dob, rob, eo = [sofa.doublep() for i in range(6)]
+    start = time.perf_counter()
+    ref = []
+    for r, d in zip(ra, dec):
+        sofa.iauAtco13(r, d, 0, 0, 0, 0, utc1, utc2, 0.0150, elong, phi, hm,
+                       np.deg2rad(0.2293/3600.), np.deg2rad(0.2801/3600.), m[0], m[1], m[2], m[3],
+                       aob, zob, hob, dob, rob, eo)
+        ref.append((np.rad2deg(aob.value()), 90. - np.rad2deg(zob.value())))
+    atco = time.perf_counter() - start
+    ref = np.array(ref)
+    start = time.perf_counter()
+    az, el = ctx.radec2azel(ra, dec)
+    quick = time.perf_counter() - start
+    above = ref[:, 1] > 5.
+    print('max |dAz cosEl|, |dEl| (arcsec) above 5 deg:',
+          (np.abs((az - ref[:, 0] + 180.) % 360. - 180.)*np.cos(np.deg2rad(ref[:, 1])))[above].max()*3600,
+          np.abs(el - ref[:, 1])[above].max()*3600)
+    print('iauAtco13 loop %.4f s, context %.4f s for %d sources' % (atco, quick, len(ra)))
+
+    # IAU 2000B context and 60 s old slow terms, as in the 'fast' tier
+    fast = AstrometryContext(utc1, utc2 - 30./86400., 0.0150, 0.2293, 0.2801, sc, m,
+                             window=PRECISION_TIERS['fast']['refresh'], nutation='2000B')
+    az, el = fast.radec2azel(ra, dec, utc1, utc2)
+    print('fast tier max |dAz cosEl|, |dEl| (arcsec) above 5 deg:',
+          (np.abs((az - ref[:, 0] + 180.) % 360. - 180.)*np.cos(np.deg2rad(ref[:, 1])))[above].max()*3600,
+          np.abs(el - ref[:, 1])[above].max()*3600)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    constraint engine: sun separation, elevation limits and cable wrap of a
+    planned schedule, checked in one vectorized pass before the antenna moves
+    Date   : Oct. 18th 2026
+'''
+
+import logging
+import time
+
+import numpy as np
+
+from yn40mtcs.core.constants import LOGGER_NAME
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+# elevation limit of cross_scan, upper elevation limit (near the zenith the
+# azimuth rate exceeds the drives) and the closest approach to the Sun (deg)
+EL_MIN = 8.2
+EL_MAX = 88.
+SUN_MIN = 15.
+
+SCHEDULE_DTYPE = [('name', 'U32'), ('ra', 'f8'), ('dec', 'f8'), ('start', 'f8'), ('end', 'f8')]
+SAMPLE_DTYPE = [('entry', 'i4'), ('t', 'f8'), ('az', 'f8'), ('el', 'f8'), ('sun', 'f8'), ('wd_switch', 'i1')]
+VIOLATION_DTYPE = [('entry', 'i4'), ('name', 'U32'), ('kind', 'U8'), ('start', 'f8'), ('end', 'f8'), ('value', 'f8')]
+
+def wd_switch(az0, az):
+    '''
+    cable wrap switch of AcuProtcl.track_on for a move from az0 to az (deg),
+    vectorized: 0 same side of 180, 1 from -270 to +270, 2 from +270 to -270
+    '''
+    az0 = np.asarray(az0)
+    az = np.asarray(az)
+    return np.where((az0<180.) & (az>=180.), 1, np.where((az0>=180.) & (az<180.), 2, 0)).astype(np.int8)
+
+def _unix(t):
+    return np.asarray(t).astype('datetime64[ms]').astype(np.int64)/1e3
+
+def vlbi_schedule(srclst):
+    '''
+    schedule of a VLBI session (SourceList filenum '2'), each scan from
+    its pre-observation time to the end of the valid time
+    '''
+    src = srclst.sources
+    schedule = np.zeros(len(src), dtype=SCHEDULE_DTYPE)
+    for key in ['name', 'ra', 'dec']:
+        schedule[key] = src[key]
+    schedule['start'] = _unix(src['preob_time'])
+    schedule['end'] = _unix(src['valid_time'])
+    return schedule
+
+def campaign(srclst, names, start, duration=600., gap=0.):
+    '''
+    pointing campaign: the named sources of srclst one after the other from
+    UNIX time start, duration (s) each with gap (s) between them
+    '''
+    schedule = np.zeros(len(names), dtype=SCHEDULE_DTYPE)
+    for i, name in enumerate(names):
+        idx = srclst.find(name)
+        if idx is None:
+            raise ValueError('source {} is not in {}'.format(name, srclst.filename))
+        schedule[i]['name'] = srclst.sources['name'][idx]
+        schedule[i]['ra'], schedule[i]['dec'] = srclst.get_radec_rad(idx)
+    schedule['start'] = start + np.arange(len(names))*(duration + gap)
+    schedule['end'] = schedule['start'] + duration
+    return schedule
+
+def radec_commands(commands, duration=600.):
+    '''
+    commands: (UNIX time, 'RADEC hh:mm:ss.s +dd:mm:ss.s') pairs as given to
+              Telescope.run, each tracked until the next one
+    duration: how long the last one is tracked (s)
+    '''
+    from yn40mtcs.func.conv_coord import _parse_cos
+    schedule = np.zeros(len(commands), dtype=SCHEDULE_DTYPE)
+    for i, (t, command) in enumerate(sorted(commands, key=lambda c: c[0])):
+        cmds = command.split()
+        if cmds[0]!='RADEC' or len(cmds)<3:
+            raise ValueError('not a RADEC command: {}'.format(command))
+        schedule[i]['name'] = cmds[1] + ' ' + cmds[2]
+        schedule[i]['ra'], schedule[i]['dec'] = _parse_cos(cmds[1] + ' ' + cmds[2])
+        schedule[i]['start'] = t
+    schedule['end'][:-1] = schedule['start'][1:]
+    schedule['end'][-1:] = schedule['start'][-1:] + duration
+    return schedule
+
+def _runs(flag, entry):
+    '''
+    first and last index of the runs of True in flag that stay in one entry
+    '''
+    edge = np.diff(np.concatenate(([False], flag, [False])).astype(np.int8))
+    split = flag[1:] & flag[:-1] & (entry[1:]!=entry[:-1])
+    first = np.sort(np.concatenate((np.nonzero(edge==1)[0], np.nonzero(split)[0] + 1)))
+    last = np.sort(np.concatenate((np.nonzero(edge==-1)[0] - 1, np.nonzero(split)[0])))
+    return first, last
+
+class ConstraintEngine(object):
+    '''
+    checks a schedule (SCHEDULE_DTYPE) on a sample grid: elevation limits,
+    Sun separation and the cable wrap switches the ACU will make
+
+    The positions come from one astrometry context for the whole schedule
+    (its slow terms drift by less than 1 arcsec a day) and the Sun from one
+    vectorized ephemeris read, so a 24 h schedule is one pass over arrays.
+    '''
+    def __init__(self, coodgeo=None, el_min=EL_MIN, el_max=EL_MAX, sun_min=SUN_MIN, cadence=30.):
+        '''
+        coodgeo: CoordGeometry (site and weather from its observer), default a new one
+        cadence: longest sample step within an entry (s)
+        '''
+        if coodgeo is None:
+            from yn40mtcs.func.conv_coord import CoordGeometry
+            coodgeo = CoordGeometry()
+        self.coodgeo = coodgeo
+        self.el_min = float(el_min)
+        self.el_max = float(el_max)
+        self.sun_min = float(sun_min)
+        self.cadence = float(cadence)
+
+    def sample(self, schedule, az0=None):
+        '''
+        az/el, Sun separation and wrap switch along the schedule
+        az0: antenna azimuth before the first entry, default no switch there
+        return: structured array of SAMPLE_DTYPE, entries in schedule order
+        '''
+        from yn40mtcs.func.conv_coord import utc_jd
+        from yn40mtcs.func.astrometry import utc2tt
+        from yn40mtcs.func.ephemeris import SUN, EARTH
+        span = schedule['end'] - schedule['start']
+        n = np.maximum(np.ceil(span/self.cadence).astype(int), 1) + 1
+        entry = np.repeat(np.arange(len(schedule)), n)
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        t = schedule['start'][entry] + span[entry]*k/(n - 1)[entry]
+        samples = np.zeros(len(t), dtype=SAMPLE_DTYPE)
+        if not len(t):
+            return samples
+        samples['entry'] = entry
+        samples['t'] = t
+
+        # positions from one context at the middle of the schedule
+        t0, t1 = t.min(), t.max()
+        utc1, utc2 = utc_jd(0.5*(t0 + t1))
+        ctx = self.coodgeo.get_context(utc1[0], utc2[0], window=0.5*(t1 - t0) + 1.)
+        utc1, utc2 = utc_jd(t)
+        ra = schedule['ra'][entry]
+        dec = schedule['dec'][entry]
+        samples['az'], samples['el'] = ctx.radec2azel(ra, dec, utc1, utc2)
+
+        # geocentric Sun, TT - UTC taken at the middle of the schedule
+        tt1, tt2 = utc2tt(utc1[:1], utc2[:1])
+        dtt = (tt1[0] - utc1[0]) + (tt2[0] - utc2[0])
+        sun = self.coodgeo.JPLEPH.state(utc1, utc2 + dtt, [SUN], center=EARTH)[:, 0, 0]
+        sun /= np.sqrt((sun*sun).sum(axis=-1))[:, np.newaxis]
+        src = np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+        samples['sun'] = np.rad2deg(np.arccos(np.clip((src*sun).sum(axis=-1), -1., 1.)))
+
+        previous = np.roll(samples['az'], 1)
+        previous[0] = samples['az'][0] if az0 is None else az0
+        samples['wd_switch'] = wd_switch(previous, samples['az'])
+        return samples
+
+    def check(self, schedule, az0=None):
+        '''
+        return: samples (SAMPLE_DTYPE) and violations (VIOLATION_DTYPE), one
+                violation per run of samples of one entry, with the worst
+                value: lowest/highest elevation, closest Sun approach (deg)
+                or the wrap switch code; kind 'wrap' at the first sample of
+                an entry is the switch of the slew to it, later ones happen
+                while tracking
+        '''
+        samples = self.sample(schedule, az0)
+        entry = samples['entry']
+        checks = [('el_min', samples['el']<self.el_min, samples['el'], np.minimum),
+                  ('el_max', samples['el']>self.el_max, samples['el'], np.maximum),
+                  ('sun', samples['sun']<self.sun_min, samples['sun'], np.minimum),
+                  ('wrap', samples['wd_switch']!=0, samples['wd_switch'].astype(float), np.maximum)]
+        found = []
+        for kind, flag, value, worst in checks:
+            first, last = _runs(flag, entry)
+            if not len(first):
+                continue
+            v = np.zeros(len(first), dtype=VIOLATION_DTYPE)
+            v['entry'] = entry[first]
+            v['name'] = schedule['name'][entry[first]]
+            v['kind'] = kind
+            v['start'] = samples['t'][first]
+            v['end'] = samples['t'][last]
+            # worst value of each run, reduceat over [first, last + 1) pairs
+            bounds = np.ravel(np.column_stack((first, last + 1)))
+            v['value'] = worst.reduceat(np.append(value, 0.), bounds)[::2]
+            found.append(v)
+        violations = np.concatenate(found) if found else np.zeros(0, dtype=VIOLATION_DTYPE)
+        violations = violations[np.lexsort((violations['start'], violations['entry']))]
+        if len(violations):
+            logger.warning('{} constraint violations in a schedule of {} entries'.format(len(violations), len(schedule)))
+        return samples, violations
+
+def format_violations(violations):
+    '''
+    text lines of a violation table, times in UTC
+    '''
+    lines = []
+    for v in violations:
+        lines.append('{:4d} {:<20s} {:<7s} {} - {}  {:8.2f}'.format(v['entry'], v['name'], v['kind'],
+                     time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(v['start'])),
+                     time.strftime('%H:%M:%S', time.gmtime(v['end'])), v['value']))
+    return lines
+
+if __name__=='__main__':
+    from yn40mtcs.func.sourcelist import SourceList
+    print('testing constraints.py')
+    engine = ConstraintEngine()
+
+    srclst = SourceList(filenum='2')
+    samples, violations = engine.check(vlbi_schedule(srclst))
+    print('VLBI session, %d scans, %d samples, %d violations' % (len(srclst.sources), len(samples), len(violations)))
+    print('\n'.join(format_violations(violations)))
+
+    # 24 h pointing campaign over the calibrators, 5 minutes per source
+    srclst = SourceList(filenum='0')
+    names = list(srclst.sources['name'][np.arange(288) % len(srclst.sources)])
+    schedule = campaign(srclst, names, 1694304000., 300.)
+    engine.check(schedule)
+    start = time.perf_counter()
+    samples, violations = engine.check(schedule)
+    elapsed = time.perf_counter() - start
+    print('24 h campaign, %d entries, %d samples: %.3f s, %d violations (%s)' % (len(schedule), len(samples), elapsed,
+            len(violations), ', '.join('%s %d' % (k, (violations['kind']==k).sum()) for k in ['el_min', 'el_max', 'sun', 'wrap'])))
+
+    # the sampled elevations against the full reduction
+    i = np.arange(0, len(samples), 97)
+    az, el = engine.coodgeo.radec2azel_batch(schedule['ra'][samples['entry'][i]], schedule['dec'][samples['entry'][i]],
+                                             samples['t'][i], backend='CONTEXT')
+    print('max |El - full reduction| (arcsec): %.3f' % (np.abs(np.diagonal(el) - samples['el'][i]).max()*3600.))
+
+    print('\n'.join(format_violations(engine.check(radec_commands(
+            [(1694347200., 'RADEC 05:34:31.9 +22:00:52'), (1694350800., 'RADEC 11:00:00.0 +05:00:00')]))[1])))
@@ -10,7 +10,9 @@ Date   : Aug. 22th 2019
 
 
 import numpy as np
+import os
 import sys
+import threading
 import matplotlib.pylab as plt
 from time import sleep
 import time
@@ -19,46 +21,345 @@ from astropy.utils import iers
 from astropy.utils.iers import IERS_A
 import astropy.units
 import astropy.time
+from astropy.table import Column, MaskedColumn
 from astropy.coordinates import SkyCoord,EarthLocation,AltAz
 
 from . import sofaswig as sofa
-from . import jplephswig as jpleph
 from . import eop
+from .ephemeris import JPLEphemeris, copy_to_swig, SATURN, JUPITER, SUN, EARTH
+from .astrometry import AstrometryContext, ObserverContext, PRECISION_TIERS, AU_LT, utc2tt
+from .trajectory import finite_rates
 
 from yn40mtcs.core.utils import data_path
 
 iers.conf.auto_download = False
 
+_IERS_LOCK = threading.Lock()
+
+def _save_iers(cache, key, table):
+    # the columns of an IERS table as plain arrays, no pickled objects
+    arrays = {'key': np.array(key), 'names': np.array(table.colnames)}
+    kinds, units = [], []
+    for k, name in enumerate(table.colnames):
+        col = table[name]
+        unit = getattr(col, 'unit', None)
+        if isinstance(col, astropy.units.Quantity):
+            kinds.append('quantity')
+            arrays['c%d' % k] = col.value
+        elif hasattr(col, 'mask'):
+            kinds.append('masked')
+            arrays['c%d' % k] = np.ma.getdata(col)
+            arrays['m%d' % k] = np.asarray(col.mask)
+        else:
+            kinds.append('column')
+            arrays['c%d' % k] = np.asarray(col)
+        units.append('' if unit is None else unit.to_string())
+    arrays['kinds'] = np.array(kinds)
+    arrays['units'] = np.array(units)
+    for name, value in table.meta.items():
+        arrays['meta_' + name] = np.array(value)
+    tmp = cache + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, cache)
+
+def _load_iers(cache, key):
+    # table of _save_iers, None when the cache is missing or of another key
+    with np.load(cache, allow_pickle=False) as f:
+        if f['key'].tolist()!=list(key):
+            return None
+        columns = []
+        for k, (kind, unit) in enumerate(zip(f['kinds'], f['units'])):
+            if kind=='quantity':
+                columns.append(astropy.units.Quantity(f['c%d' % k], unit or None))
+            elif kind=='masked':
+                columns.append(MaskedColumn(f['c%d' % k], mask=f['m%d' % k], unit=unit or None))
+            else:
+                columns.append(Column(f['c%d' % k], unit=unit or None))
+        meta = {name[5:]: f[name][()] for name in f.files if name.startswith('meta_')}
+        meta = {name: str(v) if isinstance(v, np.str_) else v for name, v in meta.items()}
+        return IERS_A(columns, names=f['names'].tolist(), meta=meta)
+
+def load_astropy_iers(filepath=data_path('finals2000A.all')):
+    '''
+    install finals2000A.all as the astropy IERS table, once per process
+    the columns of the parsed table are saved to filepath + '.cache'
+    (np.savez, read without pickle) and reused while the astropy version
+    and the time and size of filepath stay the same
+    '''
+    with _IERS_LOCK:
+        if iers.IERS.iers_table is not None:
+            return iers.IERS.iers_table
+        cache = filepath + '.cache'
+        key = (astropy.__version__, repr(os.path.getmtime(filepath)), str(os.path.getsize(filepath)))
+        table = None
+        try:
+            table = _load_iers(cache, key)
+        except (OSError, ValueError, KeyError):
+            pass
+        if table is None:
+            table = IERS_A.open(filepath)
+            try:
+                _save_iers(cache, key, table)
+            except OSError:
+                pass
+        iers.IERS_A_URL = filepath
+        iers.IERS.iers_table = table
+        return table
+
+def _parse_cos(COS):
+    '''
+    'hh:mm:ss.s +dd:mm:ss.s' -> ICRS RA, Dec in radians
+    a (ra, dec) tuple in radians is passed through
+    '''
+    if isinstance(COS, tuple):
+        return float(COS[0]), float(COS[1])
+    ralist = (COS.split())[0].split(':')
+    declist = (COS.split())[1].split(':')
+    ra = (float(ralist[0]) + float(ralist[1])/60. + float(ralist[2])/3600.)*15.
+    dec = abs(float(declist[0])) + float(declist[1])/60. + float(declist[2])/3600.
+    if declist[0].strip().startswith('-'):
+        dec = -dec
+    return np.deg2rad(ra), np.deg2rad(dec)
+
+# degrees field of SOFA.ObservationCatalog for -1 < Dec < 0 deg: the class
+# takes the sign from the value (a -0 reads as north) and the integer part
+# of its magnitude, so a fraction of a degree carries the sign of 0 deg
+SOUTH_ZERO = -0.5
+
+def _sofa_catalog(ra, dec):
+    '''
+    RA, Dec (rad) -> integer hours, seconds of time, degrees, arcsec for
+    SOFA.ObservationCatalog (with zero minutes). The sign of the declination
+    is carried by the degrees, SOUTH_ZERO for -1 < Dec < 0 deg
+    '''
+    ra = np.atleast_1d(ra)
+    dec = np.atleast_1d(dec)
+    ra_s = np.degrees(ra % (2*np.pi))*240.
+    ra_h = (ra_s//3600).astype(int)
+    ra_s = ra_s - ra_h*3600.
+    dec_s = np.abs(np.degrees(dec))*3600.
+    dec_d = (dec_s//3600).astype(int)
+    dec_s = dec_s - dec_d*3600.
+    dec_d = np.where(dec<0, np.where(dec_d==0, SOUTH_ZERO, -dec_d), dec_d)
+    return ra_h, ra_s, dec_d, dec_s
+
+DJ_UNIX = 2440587.5 # JD of 1970-01-01T00:00:00
+NS_DAY = 86400*10**9
+
+def utc_jd(curtim):
+    '''
+    UTC epoch(s) -> 2-part quasi Julian Date arrays (jd1, jd2), accepts
+      'now'
+      float UNIX time(s) in seconds
+      tuple (jd1, jd2) of a 2-part JD, or of an MJD when jd1 + jd2 < 1e6
+      numpy.datetime64 / datetime.datetime, scalar or array
+      'YYYY-MM-DD hh:mm:ss' string(s) and astropy Time
+    '''
+    if isinstance(curtim, astropy.time.Time):
+        curtim = curtim.utc
+        return np.atleast_1d(curtim.jd1), np.atleast_1d(curtim.jd2)
+    if isinstance(curtim, tuple):
+        jd1, jd2 = np.broadcast_arrays(np.atleast_1d(np.asarray(curtim[0], dtype=float)),
+                                       np.atleast_1d(np.asarray(curtim[1], dtype=float)))
+        if np.all(jd1 + jd2<1e6):
+            jd1 = jd1 + 2400000.5
+        return jd1, jd2
+    if isinstance(curtim, str) and curtim=='now':
+        curtim = time.time()
+    curtim = np.atleast_1d(curtim)
+    if curtim.dtype.kind in 'iuf':
+        days = np.floor(curtim/86400.)
+        return DJ_UNIX + days, (curtim - days*86400.)/86400.
+    if curtim.dtype.kind in 'USO':
+        try:
+            curtim = np.array([str(v).replace(' ', 'T') for v in curtim], dtype='datetime64[ns]')
+        except ValueError:
+            # not ISO 8601, e.g. fields without leading zeros
+            return utc_jd(astropy.time.Time([str(v) for v in curtim], scale='utc'))
+    ns = curtim.astype('datetime64[ns]').astype(np.int64)
+    days = ns//NS_DAY
+    return DJ_UNIX + days.astype(float), (ns - days*NS_DAY)/float(NS_DAY)
+
+def utc_ymdhms(utc1, utc2):
+    '''
+    2-part quasi JD arrays -> (N, 6) year, month, day, hour, minute, second
+    as taken by SOFA.InputTime
+    '''
+    day = np.asarray(utc1, dtype=float) - DJ_UNIX
+    whole = np.floor(day)
+    frac = (day - whole) + np.asarray(utc2, dtype=float)
+    carry = np.floor(frac)
+    whole = (whole + carry).astype(np.int64)
+    sec = (frac - carry)*86400.
+    date = whole.astype('datetime64[D]')
+    month = date.astype('datetime64[M]')
+    ymdhms = np.empty((len(date), 6))
+    ymdhms[:, 0] = date.astype('datetime64[Y]').astype(int) + 1970
+    ymdhms[:, 1] = month.astype(int) % 12 + 1
+    ymdhms[:, 2] = (date - month).astype(int) + 1
+    ymdhms[:, 3] = sec//3600.
+    ymdhms[:, 4] = (sec - ymdhms[:, 3]*3600.)//60.
+    ymdhms[:, 5] = sec - ymdhms[:, 3]*3600. - ymdhms[:, 4]*60.
+    return ymdhms
+
+class _Engine(threading.local):
+    '''
+    stateful SOFA class and its ephemeris buffers, one set per thread,
+    created on first use in each thread
+    '''
+    def __init__(self):
+        self.sofa = sofa.SOFA()
+        self.pvbuf = [sofa.Create2DArray23() for i in range(4)]
+        # observer revision last passed to SetSite/SetSiteCondition
+        self.revision = None
+
+# site and weather a new CoordGeometry starts with
+DEFAULT_SC = [102,47,45.6,25,1,40.8,1974.0]
+DEFAULT_MCOW = [800,25,0.5,50000]
+
 class CoordGeometry:
-    def __init__(self, iersfile='iers.txt', ephfile='DE435.1950.2050'):
+    def __init__(self, iersfile='iers.eop', ephfile='DE435.1950.2050', precision='full'):
+        '''
+        precision: 'full', 'standard' or 'fast', see astrometry.PRECISION_TIERS
+                   below 'full' the SOFA backend is served by the shared context
+        '''
+        if precision not in PRECISION_TIERS:
+            raise ValueError('unknown precision tier {}'.format(precision))
+        self.precision = precision
+        # the CONTEXT backend runs at least at the standard tier
+        self._tier = PRECISION_TIERS['standard' if precision=='full' else precision]
         self.fileEOP = data_path(iersfile)
         self.fileEPH = data_path(ephfile)
         self.EOP = eop.EOP(filepath=self.fileEOP)
-        self.JPLEPH = jpleph.JPLEph(self.fileEPH)
+        self.JPLEPH = JPLEphemeris(self.fileEPH)
 
-        self.sofa=sofa.SOFA()
-        iers.IERS_A_URL = data_path('finals2000A.all')
-        # iers_a = iers.IERS_A.open(iers.IERS_A_URL)
-        iers.IERS.iers_table = iers.IERS_A.open(iers.IERS_A_URL)
+        # the SOFA backend runs on a per-thread engine, so the control loop,
+        # cross scans and the GUI can convert concurrently without a lock;
+        # the shared context and the EOP/ephemeris readers are immutable
+        self._engine = _Engine()
+        # the astropy IERS table is only loaded when the ASTROPY backend is used
+        self._context = None
+        # SC/MCOW arguments of None use the observer, others apply to the
+        # call only (ObserverContext.resolve)
+        self.observer = ObserverContext(DEFAULT_SC, DEFAULT_MCOW)
+        self._locations = {}
+        self._skycoords = {}
 
-    def radec2azel(self, COS, SC=[102,47,45.6,25,1,40.8,1974.0], MCOW=[800,25,0.5,50000], curtim='now', boldebug=False, backend='SOFA'):
+    def _earth_location(self, SC):
         '''
-        curtim: UTC time
+        EarthLocation of the site, built once per site coordinate
         '''
-        if backend=='ASTROPY':
-            strlon = '%fd'%(SC[0]+SC[1]/60.+SC[2]/3600.)
-            strlat = '%fd'%(SC[3]+SC[4]/60.+SC[5]/3600.)
-            observing_location = EarthLocation(lat=strlat, lon=strlon, height=SC[6]*astropy.units.m)
-            c3 = SkyCoord(COS, unit=(astropy.units.hour, astropy.units.deg), frame='icrs')
-            if curtim=='now':
-                observing_time = astropy.time.Time.now()
-                # print("Current time: %s" % observing_time.value)
+        key = tuple(SC)
+        loc = self._locations.get(key)
+        if loc is None:
+            loc = EarthLocation(lat=(SC[3]+SC[4]/60.+SC[5]/3600.)*astropy.units.deg,
+                                lon=(SC[0]+SC[1]/60.+SC[2]/3600.)*astropy.units.deg,
+                                height=SC[6]*astropy.units.m)
+            self._locations[key] = loc
+        return loc
+
+    def _skycoord(self, COS):
+        '''
+        ICRS SkyCoord of 'hh:mm:ss.s +dd:mm:ss.s' or (ra, dec) in radians, built once per source
+        '''
+        c = self._skycoords.get(COS)
+        if c is None:
+            if len(self._skycoords)>=4096:
+                self._skycoords.clear()
+            if isinstance(COS, tuple):
+                c = SkyCoord(ra=COS[0]*astropy.units.rad, dec=COS[1]*astropy.units.rad, frame='icrs')
             else:
-                loct = curtim.split(' ')
-                locymd = loct[0].split('-')
-                lochms = loct[1].split(':')
-                strtime = '%s-%s-%sT%s:%s:%s'%(locymd[0], locymd[1], locymd[2], lochms[0], lochms[1], lochms[2])
-                observing_time = astropy.time.Time(strtime, format='isot', scale='utc')
+                c = SkyCoord(COS, unit=(astropy.units.hour, astropy.units.deg), frame='icrs')
+            self._skycoords[COS] = c
+        return c
+
+    def get_context(self, utc1, utc2, SC=None, MCOW=None, window=None):
+        '''
+        shared astrometry context for the UTC epoch (2-part quasi JD)
+        a new context is only built when the epoch leaves the validity
+        window of the current one, the site / weather changes or the EOP
+        table is refreshed (also by EOP.watch)
+        window: validity window (s), default is the refresh of the precision tier
+        a weather change only replaces the refraction constants
+        '''
+        if window is None:
+            window = self._tier['refresh']
+        obs = self.observer.resolve(SC, MCOW)
+        ctx = self._context
+        if ctx is None or ctx.SC!=obs.SC or ctx.window!=window or ctx.eop_version!=self.EOP.version \
+                or not ctx.covers(utc1, utc2):
+            ctx = self._build_context(utc1, utc2, obs.SC, obs.MCOW, window)
+            self._context = ctx
+        elif ctx.MCOW!=obs.MCOW:
+            ctx = ctx.with_weather(obs.MCOW, obs.refa, obs.refb)
+            self._context = ctx
+        return ctx
+
+    def set_weather(self, pressure=None, temperature=None, humidity=None, wavelength=None):
+        '''
+        live weather: pressure(hPa), temperature(C), humidity(0-1), wavelength(um)
+        '''
+        return self.observer.set_weather(pressure, temperature, humidity, wavelength)
+
+    @property
+    def sofa(self):
+        '''
+        SOFA class of the calling thread
+        '''
+        return self._engine.sofa
+
+    def _sofa_observer(self, obs):
+        '''
+        SOFA class of the calling thread, site and weather passed to it only
+        when they changed
+        '''
+        engine = self._engine
+        if engine.revision!=obs.revision:
+            engine.sofa.SetSite(*obs.SC)
+            engine.sofa.SetSiteCondition(*obs.MCOW)
+            engine.revision = obs.revision
+        return engine
+
+    def refresh_eop(self, finals=None):
+        '''
+        merge a new finals2000A.all into the EOP table while running,
+        the shared context is rebuilt with the new values on next use
+        '''
+        return self.EOP.refresh(finals or data_path('finals2000A.all'))
+
+    def _build_context(self, utc1, utc2, SC, MCOW, window):
+        # the version is taken before the values, a refresh in between
+        # only costs one more rebuild
+        version = self.EOP.version
+        dut1, pmx, pmy, cipx, cipy = self.EOP.getEOP(utc1-2400000.5+utc2)
+        ctx = AstrometryContext(utc1, utc2, dut1, pmx, pmy, SC, MCOW, window, self._tier['nutation'])
+        ctx.eop_version = version
+        return ctx
+
+    def radec2azel(self, COS, SC=None, MCOW=None, curtim='now', boldebug=False, backend='SOFA'):
+        '''
+        COS:    'hh:mm:ss.s +dd:mm:ss.s', or (ra, dec) ICRS in radians
+                (e.g. SourceList.get_radec_rad)
+        SC, MCOW: site and weather as in ObserverContext for this call only,
+                None uses self.observer
+        curtim: UTC time, see utc_jd ('now', UNIX time, JD/MJD pair, datetime64, string)
+        backend: 'SOFA', 'ASTROPY' or 'CONTEXT' (shared AstrometryContext)
+        '''
+        if backend=='SOFA' and self.precision!='full':
+            backend = 'CONTEXT'
+        if backend=='CONTEXT':
+            utc1, utc2 = utc_jd(curtim)
+            ra, dec = _parse_cos(COS)
+            Az, El = self.get_context(utc1[0], utc2[0], SC, MCOW).radec2azel(ra, dec, utc1[0], utc2[0])
+            return float(Az), float(El)
+        obs = self.observer.resolve(SC, MCOW)
+        if backend=='ASTROPY':
+            load_astropy_iers()
+            observing_location = self._earth_location(obs.SC)
+            c3 = self._skycoord(COS)
+            utc1, utc2 = utc_jd(curtim)
+            observing_time = astropy.time.Time(utc1[0], utc2[0], format='jd', scale='utc')
 
             aa = AltAz(location=observing_location, obstime=observing_time)
             jj = c3.transform_to(aa)
@@ -67,41 +368,31 @@ class CoordGeometry:
             return az_astropy, el_astropy
         #--------------------SOFA backend
 
-        sofa1= self.sofa
-        ## Site Coordinate
-        elon_d = SC[0]
-        elon_m = SC[1]
-        elon_s = SC[2]
-        ephi_d = SC[3]
-        ephi_m = SC[4]
-        ephi_s = SC[5]
-        ht = SC[6]
-        sofa1.SetSite(elon_d,elon_m,elon_s,ephi_d,ephi_m,ephi_s,ht)
+        ## Site Coordinate, Meteorological Condition and Observational Wavelength
+        engine = self._sofa_observer(obs)
+        sofa1 = engine.sofa
         if boldebug:
             print("--------------------Set Site Coordinate--------------------")
             sofa1.PrintSite()
             print(" ")
-
-        # Set Meteorological Condition and Observational Wavelength
-        pres = MCOW[0]
-        temp = MCOW[1]
-        humi = MCOW[2]
-        wavl = MCOW[3] # micrometer
-        sofa1.SetSiteCondition(pres,temp,humi,wavl)
-
-        if boldebug:
             print("--------------------Set Condition of Site--------------------")
             sofa1.PrintSSC()
         
         # Set Catalog of Observational Source
-        ralist = (COS.split())[0].split(':')
-        declist =( COS.split())[1].split(':')
-        ra_h = float(ralist[0])
-        ra_m = float(ralist[1])
-        ra_s = float(ralist[2])
-        dec_d = float(declist[0])
-        dec_m = float(declist[1])
-        dec_s = float(declist[2])
+        if isinstance(COS, tuple):
+            ra_h, ra_s, dec_d, dec_s = [v[0].item() for v in _sofa_catalog(*COS)]
+            ra_m = dec_m = 0
+        else:
+            ralist = (COS.split())[0].split(':')
+            declist =( COS.split())[1].split(':')
+            ra_h = float(ralist[0])
+            ra_m = float(ralist[1])
+            ra_s = float(ralist[2])
+            dec_d = float(declist[0])
+            dec_m = float(declist[1])
+            dec_s = float(declist[2])
+            if dec_d==0 and declist[0].strip().startswith('-'):
+                dec_d = SOUTH_ZERO
         sofa1.ObservationCatalog(ra_h,ra_m,ra_s,dec_d,dec_m,dec_s)
         if boldebug:
             print("--------------------Set Catalog of Observational Source--------------------")
@@ -116,22 +407,8 @@ class CoordGeometry:
 
         # Set time (Julian Date)
         sofa1.CurrentTimeInit()
-        if curtim=='now':
-            # sofa1.SetTime()
-            observing_time = astropy.time.Time.now()
-            # print("Current time: %s" % observing_time.value)
-            observing_time = str(observing_time)
-            loct=observing_time.split(' ')
-            locymd=loct[0]
-            lochms=loct[1]
-            arg=[float(v) for v in locymd.split('-')]+[float(v) for v in lochms.split(':')]
-            sofa1.InputTime(*arg)
-        else:
-            loct=curtim.split(' ')
-            locymd=loct[0]
-            lochms=loct[1]
-            arg=[float(v) for v in locymd.split('-')]+[float(v) for v in lochms.split(':')]
-            sofa1.InputTime(*arg)
+        utc1, utc2 = utc_jd(curtim)
+        sofa1.InputTime(*utc_ymdhms(utc1[:1], utc2[:1])[0])
 
         sofa1.JulianDate_UTC()
         if boldebug:
@@ -166,60 +443,156 @@ class CoordGeometry:
             sofa1.PrintCIO()
 
         # Read JPL DE405 file
-        ncent = 12
-        pv = np.linspace(1,24,24)
-        j = 0
-        jpl = self.JPLEPH
-        for ntarg in [6,5,11,3]:
-            flag = jpl.Calculate(tdb1,tdb2,ntarg,ncent)
-            for i in range(6):
-                pv[i+j]=jpl.GetValue(i)
-            j = j+6
-
-        p_v = pv.reshape(8,3)
+        pb1, pv0, pv1, pv2 = self._ephemeris_buffers(engine, tdb1, tdb2, boldebug)
+
+        sofa1.TerrestialEphemeris(pb1,pv0,pv1,pv2)
+        Az = sofa1.Getaz()
+        El = sofa1.Getel()
+        if boldebug:
+            print('Az(deg)=',Az, 'El(deg)=', El)
+
+        return Az, El
+
+    def _ephemeris_buffers(self, engine, tdb1, tdb2, boldebug=False):
+        '''
+        position-velocity of Earth, Saturn, Jupiter and Sun as SOFA 2x3 arrays
+        in the buffers of the engine
+        '''
+        p_v = self.JPLEPH.state(tdb1, tdb2, [SATURN, JUPITER, SUN, EARTH])[0]
         if boldebug:
             print('Saturn, Jupiter, Sun, Earth position and velocity')
             print('from', self.fileEPH)
             print(p_v)
-        pv00 = p_v[0:2][:]
-        pv11 = p_v[2:4][:]
-        pv22 = p_v[4:6][:]
-        pb11 = p_v[6:8][:]
-
-        # Create the 2D Array of C++ double
-        pv0 = sofa.Create2DArray23()
-        pv1 = sofa.Create2DArray23()
-        pv2 = sofa.Create2DArray23()
-        pb1 = sofa.Create2DArray23()
-        for i1 in range(3):
-            for j1 in range(2):
-                sofa.SetElem2DArray23(pv0,j1,i1,pv00[j1][i1])
-                sofa.SetElem2DArray23(pv1,j1,i1,pv11[j1][i1])
-                sofa.SetElem2DArray23(pv2,j1,i1,pv22[j1][i1])
-                sofa.SetElem2DArray23(pb1,j1,i1,pb11[j1][i1])
 
         #pb1 earth position-velocity
         #pv0 saturn position-velocity
         #pv1 Jupiter position-velocity
         #pv2 sun position velocity
-        if boldebug:
-            print('--------------------Earth position-velocity--------------------')
-            print(pb11)
-            print('--------------------Saturn position-velocity-------------------')
-            print(pv00)
-            print('--------------------Jupiter position-velocity------------------')
-            print(pv11)
-            print('----------------------Sun position-velocity--------------------')
-            print(pv22)
+        pv0, pv1, pv2, pb1 = engine.pvbuf
+        for buf, v in zip(engine.pvbuf, p_v):
+            copy_to_swig(buf, v)
+        return pb1, pv0, pv1, pv2
 
-        sofa1.TerrestialEphemeris(pb1,pv0,pv1,pv2)
-        Az = sofa1.Getaz()
-        El = sofa1.Getel()
-        if boldebug:
-            print('Az(deg)=',Az, 'El(deg)=', El)
+    def radec2azel_batch(self, ra, dec, curtim, SC=None, MCOW=None, backend='SOFA'):
+        '''
+        ra, dec: ICRS coordinates in radians, scalar or 1-D array of sources
+        curtim:  UTC epochs, see utc_jd (UNIX times, JD/MJD pair of arrays, datetime64 array ...)
+        return:  Az, El in degrees, arrays of shape (number of epochs, number of sources)
+
+        The per-epoch reduction (time scales, EOP, CIP/CIO, JPL lookups) is
+        done once for each epoch and shared by all sources.
+        '''
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+        if backend=='SOFA' and self.precision!='full':
+            backend = 'CONTEXT'
+        if backend=='CONTEXT':
+            utc1, utc2 = utc_jd(curtim)
+            Az = np.empty((len(utc1), len(ra)))
+            El = np.empty((len(utc1), len(ra)))
+            obs = self.observer.resolve(SC, MCOW)
+            ctx = None
+            for i in range(len(utc1)):
+                if ctx is None or not ctx.covers(utc1[i], utc2[i]):
+                    ctx = self._build_context(utc1[i], utc2[i], obs.SC, obs.MCOW, self._tier['refresh'])
+                Az[i], El[i] = ctx.radec2azel(ra, dec, utc1[i], utc2[i])
+            return Az, El
+        utc1, utc2 = utc_jd(curtim)
+        obs = self.observer.resolve(SC, MCOW)
 
+        if backend=='ASTROPY':
+            load_astropy_iers()
+            observing_location = self._earth_location(obs.SC)
+            c3 = SkyCoord(ra=ra*astropy.units.rad, dec=dec*astropy.units.rad, frame='icrs')
+            aa = AltAz(location=observing_location, obstime=astropy.time.Time(utc1, utc2, format='jd', scale='utc')[:, np.newaxis])
+            jj = c3[np.newaxis, :].transform_to(aa)
+            return jj.az.deg, jj.alt.deg
+        #--------------------SOFA backend
+
+        engine = self._sofa_observer(obs)
+        sofa1 = engine.sofa
+
+        ra_h, ra_s, dec_d, dec_s = _sofa_catalog(ra, dec)
+
+        ymdhms = utc_ymdhms(utc1, utc2)
+        eops = np.array(self.EOP.getEOP(utc1 - 2400000.5 + utc2))
+        Az = np.empty((len(utc1), len(ra)))
+        El = np.empty((len(utc1), len(ra)))
+        for i in range(len(utc1)):
+            sofa1.CurrentTimeInit()
+            sofa1.InputTime(*ymdhms[i])
+            sofa1.JulianDate_UTC()
+            dut1, pmx, pmy, cipx, cipy = eops[:, i]
+            sofa1.CoordinateCorrection(pmx,pmy,cipx,cipy,dut1)
+            sofa1.TerrestrialTime()
+            tdb1 = sofa1.GetTDB1()
+            tdb2 = sofa1.GetTDB2()
+            sofa1.CIP_CIO()
+            pb1, pv0, pv1, pv2 = self._ephemeris_buffers(engine, tdb1, tdb2)
+            for j in range(len(ra)):
+                sofa1.ObservationCatalog(int(ra_h[j]),0,float(ra_s[j]),float(dec_d[j]),0,float(dec_s[j]))
+                sofa1.ObsCorrection(0,0,0.0,0.0)
+                sofa1.TerrestialEphemeris(pb1,pv0,pv1,pv2)
+                Az[i, j] = sofa1.Getaz()
+                El[i, j] = sofa1.Getel()
         return Az, El
 
+    def body2azel_batch(self, target, curtim, SC=None, MCOW=None):
+        '''
+        target: jpl_pleph target number of a solar system body (ephemeris.BODIES)
+        curtim: UTC epochs, see utc_jd
+        return: topocentric apparent Az, El in degrees, arrays over curtim
+
+        The JPL states are read for all epochs at once (TDB ~ TT), with the
+        light time iterated; the observed place uses the shared context
+        machinery with the parallax of the site.
+        '''
+        utc1, utc2 = utc_jd(curtim)
+        obs = self.observer.resolve(SC, MCOW)
+        tt1, tt2 = utc2tt(utc1, utc2)
+        earth = self.JPLEPH.state(tt1, tt2, [EARTH])[:, 0, 0]
+        tau = np.zeros(len(tt1))
+        for i in range(3):
+            pos = self.JPLEPH.state(tt1, tt2 - tau, [target])[:, 0, 0] - earth
+            tau = np.sqrt((pos*pos).sum(axis=-1))*AU_LT/86400.
+        Az = np.empty(len(utc1))
+        El = np.empty(len(utc1))
+        ctx = None
+        for i in range(len(utc1)):
+            if ctx is None or not ctx.covers(utc1[i], utc2[i]):
+                ctx = self._build_context(utc1[i], utc2[i], obs.SC, obs.MCOW, self._tier['refresh'])
+            Az[i], El[i] = ctx.body2azel(pos[i], obs.xyz, utc1[i], utc2[i], target!=SUN)
+        return Az, El
+
+    def radec2azel_rates(self, ra, dec, curtim, SC=None, MCOW=None, backend='SOFA', h=0.5):
+        '''
+        ra, dec, curtim as in radec2azel_batch
+        h:      difference step (s)
+        return: Az, El (deg), their rates (deg/s) and accelerations (deg/s^2),
+                arrays of shape (number of epochs, number of sources), by
+                central differences of the batch reduction
+        '''
+        utc1, utc2 = utc_jd(curtim)
+        t = (utc1 - DJ_UNIX)*86400. + utc2*86400.
+        return finite_rates(lambda x: self.radec2azel_batch(ra, dec, x, SC, MCOW, backend), t, h)
+
+    def radec2azel_track(self, COS, curtim, SC=None, MCOW=None, backend='ASTROPY'):
+        '''
+        track of one source: COS 'hh:mm:ss.s +dd:mm:ss.s', curtim as in radec2azel_batch
+        the ASTROPY backend transforms the cached SkyCoord into one AltAz
+        frame with an array obstime
+        return: Az, El in degrees, arrays over curtim
+        '''
+        if backend!='ASTROPY':
+            ra, dec = _parse_cos(COS)
+            Az, El = self.radec2azel_batch(ra, dec, curtim, SC=SC, MCOW=MCOW, backend=backend)
+            return Az[:, 0], El[:, 0]
+        load_astropy_iers()
+        utc1, utc2 = utc_jd(curtim)
+        aa = AltAz(location=self._earth_location(self.observer.resolve(SC, MCOW).SC), obstime=astropy.time.Time(utc1, utc2, format='jd', scale='utc'))
+        jj = self._skycoord(COS).transform_to(aa)
+        return jj.az.deg, jj.alt.deg
+
 if __name__=='__main__':
     print('testing conv_coord.py')
     cos = '05:34:32.00 22:00:58.00'
@@ -299,3 +672,161 @@ if __name__=='__main__':
             # print "Now az=",az, 'el=',el
         f.close()
 
+    if sys.argv[1]=='bench':
+        # scalar radec2azel in a loop against radec2azel_batch over a night
+        from yn40mtcs.func.sourcelist import SourceList
+        coodgeo = CoordGeometry()
+        srclst = SourceList(filenum='0')
+        coslist = [srclst.get_radec(i)[0] + ' ' + srclst.get_radec(i)[1] for i in range(srclst.number_src())]
+        c = SkyCoord(coslist, unit=(astropy.units.hour, astropy.units.deg), frame='icrs')
+        obstime = astropy.time.Time('2023-09-10 12:00:00', scale='utc') + np.arange(12)*astropy.units.hour
+        for backend in ['SOFA', 'ASTROPY', 'CONTEXT']:
+            start = time.perf_counter()
+            for t in obstime:
+                for cos in coslist:
+                    coodgeo.radec2azel(COS=cos, SC=sc, MCOW=m, curtim=t.iso, backend=backend)
+            loop = time.perf_counter() - start
+            start = time.perf_counter()
+            az, el = coodgeo.radec2azel_batch(c.ra.rad, c.dec.rad, obstime, SC=sc, MCOW=m, backend=backend)
+            batch = time.perf_counter() - start
+            print('%s: %d epochs x %d sources, loop %.3f s, batch %.3f s, speedup %.1f' % \
+                    (backend, len(obstime), len(coslist), loop, batch, loop/batch))
+
+    if sys.argv[1]=='tiers':
+        # accuracy envelope and latency of the precision tiers against 'full'
+        from yn40mtcs.func.sourcelist import SourceList
+        srclst = SourceList(filenum='0')
+        coslist = [srclst.get_radec(i)[0] + ' ' + srclst.get_radec(i)[1] for i in range(srclst.number_src())]
+        c = SkyCoord(coslist, unit=(astropy.units.hour, astropy.units.deg), frame='icrs')
+        obstime = astropy.time.Time('2023-09-10 12:00:00', scale='utc') + np.arange(0, 43200, 97.)*astropy.units.s
+        result = {}
+        for precision in ['full', 'standard', 'fast']:
+            coodgeo = CoordGeometry(precision=precision)
+            start = time.perf_counter()
+            for t in obstime[:20]:
+                for cos in coslist:
+                    coodgeo.radec2azel(COS=cos, SC=sc, MCOW=m, curtim=t.iso)
+            single = (time.perf_counter() - start)/20/len(coslist)
+            start = time.perf_counter()
+            result[precision] = coodgeo.radec2azel_batch(c.ra.rad, c.dec.rad, obstime, SC=sc, MCOW=m)
+            batch = (time.perf_counter() - start)/result[precision][0].size
+            msg = '%-8s  %8.1f us/call, batch %6.2f us/position' % (precision, single*1e6, batch*1e6)
+            if precision!='full':
+                az, el = result[precision]
+                az0, el0 = result['full']
+                ok = el0>5.
+                daz = ((az - az0 + 180.) % 360. - 180.)*np.cos(np.deg2rad(el0))
+                msg += ', max |dAz cosEl| %.2f mas, |dEl| %.2f mas' % \
+                        (np.abs(daz)[ok].max()*3.6e6, np.abs(el - el0)[ok].max()*3.6e6)
+                south = ok & ((c.dec.deg<0) & (c.dec.deg>-1))[np.newaxis, :]
+                if south.any():
+                    msg += ' (-1 < Dec < 0 deg: %.2f, %.2f mas)' % \
+                            (np.abs(daz)[south].max()*3.6e6, np.abs(el - el0)[south].max()*3.6e6)
+            print(msg)
+
+    if sys.argv[1]=='startup':
+        # where the CoordGeometry start-up time goes, and the deferred IERS table
+        steps = []
+        start = time.perf_counter()
+        coodgeo = CoordGeometry()
+        steps.append(('CoordGeometry()', time.perf_counter() - start))
+        start = time.perf_counter()
+        eop.EOP(coodgeo.fileEOP)
+        steps.append(('  EOP store', time.perf_counter() - start))
+        start = time.perf_counter()
+        sofa.SOFA()
+        steps.append(('  SOFA', time.perf_counter() - start))
+        start = time.perf_counter()
+        IERS_A.open(data_path('finals2000A.all'))
+        steps.append(('IERS_A.open (was at start-up)', time.perf_counter() - start))
+        cache = data_path('finals2000A.all') + '.cache'
+        if os.path.exists(cache):
+            os.remove(cache)
+        for name in ['first ASTROPY use, no cache', 'first ASTROPY use, cached']:
+            iers.IERS.iers_table = None
+            start = time.perf_counter()
+            load_astropy_iers()
+            steps.append((name, time.perf_counter() - start))
+        for name, t in steps:
+            print('%-32s %8.1f ms' % (name, t*1e3))
+
+    if sys.argv[1]=='astropy':
+        # ASTROPY backend: per call, as a track in one call, against SOFA
+        coodgeo = CoordGeometry()
+        cos = '05:34:32.00 22:00:58.00'
+        obstime = astropy.time.Time('2023-09-10 12:00:00', scale='utc') + np.arange(0, 3600, 10.)*astropy.units.s
+        isot = [t.iso for t in obstime]
+        coodgeo.radec2azel(COS=cos, SC=sc, MCOW=m, curtim=isot[0], backend='ASTROPY')
+        start = time.perf_counter()
+        for t in isot[:20]:
+            coodgeo._locations.clear()
+            coodgeo._skycoords.clear()
+            coodgeo.radec2azel(COS=cos, SC=sc, MCOW=m, curtim=t, backend='ASTROPY')
+        uncached = (time.perf_counter() - start)/20
+        start = time.perf_counter()
+        for t in isot[:20]:
+            coodgeo.radec2azel(COS=cos, SC=sc, MCOW=m, curtim=t, backend='ASTROPY')
+        cached = (time.perf_counter() - start)/20
+        start = time.perf_counter()
+        az1, el1 = coodgeo.radec2azel_track(cos, obstime, SC=sc, MCOW=m)
+        track = (time.perf_counter() - start)/len(obstime)
+        start = time.perf_counter()
+        ref = np.array([coodgeo.radec2azel(COS=cos, SC=sc, MCOW=m, curtim=t) for t in isot])
+        sofatime = (time.perf_counter() - start)/len(obstime)
+        daz = ((az1 - ref[:, 0] + 180.) % 360. - 180.)*np.cos(np.deg2rad(ref[:, 1]))
+        print('ASTROPY uncached %.2f ms, cached %.2f ms, track %.3f ms, SOFA %.3f ms per position' % \
+                (uncached*1e3, cached*1e3, track*1e3, sofatime*1e3))
+        print('ASTROPY track - SOFA, max |dAz cosEl| %.2f mas, |dEl| %.2f mas' % \
+                (np.abs(daz).max()*3.6e6, np.abs(el1 - ref[:, 1]).max()*3.6e6))
+
+    if sys.argv[1]=='threads':
+        # conversions from several threads at once against the same calls in one thread
+        from concurrent.futures import ThreadPoolExecutor
+        from yn40mtcs.func.sourcelist import SourceList
+        coodgeo = CoordGeometry()
+        srclst = SourceList(filenum='0')
+        rng = np.random.default_rng(1)
+        jobs = [(srclst.get_radec_rad(i), 1694347200. + rng.uniform(0., 43200.), backend)
+                for i in rng.integers(0, srclst.number_src(), 2000) for backend in ['SOFA', 'CONTEXT']]
+        def convert(job):
+            return coodgeo.radec2azel(job[0], curtim=job[1], backend=job[2])
+        ref = [convert(job) for job in jobs]
+        for nthread in [2, 4, 8, 16]:
+            with ThreadPoolExecutor(nthread) as pool:
+                start = time.perf_counter()
+                result = list(pool.map(convert, jobs, chunksize=7))
+                elapsed = time.perf_counter() - start
+            bad = sum(r!=v for r, v in zip(result, ref))
+            print('%2d threads: %d conversions, %d differ from the serial run, %.1f us each' % \
+                    (nthread, len(jobs), bad, elapsed/len(jobs)*1e6))
+        ra = np.array([job[0][0] for job in jobs[:40:2]])
+        dec = np.array([job[0][1] for job in jobs[:40:2]])
+        t = 1694347200. + np.arange(0, 600, 60.)
+        ref = coodgeo.radec2azel_batch(ra, dec, t)
+        with ThreadPoolExecutor(8) as pool:
+            result = list(pool.map(lambda i: coodgeo.radec2azel_batch(ra, dec, t), range(32)))
+        print('SOFA batch from 8 threads, identical:', all(np.array_equal(r[0], ref[0]) and np.array_equal(r[1], ref[1]) for r in result))
+
+    if sys.argv[1]=='bodies':
+        # solar system bodies: tabulated track interpolated per tick against a reduction per tick
+        from yn40mtcs.func.ephemeris import BODIES
+        from yn40mtcs.func.trajectory import Trajectory
+        coodgeo = CoordGeometry()
+        # the trajectory drops segments already passed, tabulate from now
+        t0 = time.time()
+        for name in ['sun', 'moon', 'mars', 'jupiter']:
+            traj = Trajectory(lambda t: coodgeo.body2azel_batch(BODIES[name], t, SC=sc, MCOW=m))
+            start = time.perf_counter()
+            traj.extend(t0 + 3600., start=t0)
+            table = time.perf_counter() - start
+            t = t0 + np.sort(np.random.uniform(0., 3600., 200))
+            start = time.perf_counter()
+            track = np.array([traj.evaluate(v) for v in t])
+            tick = (time.perf_counter() - start)/len(t)
+            start = time.perf_counter()
+            az, el = np.array([coodgeo.body2azel_batch(BODIES[name], v, SC=sc, MCOW=m) for v in t])[..., 0].T
+            direct = (time.perf_counter() - start)/len(t)
+            daz = (track[:, 0] - az + 180.) % 360. - 180.
+            print('%-8s one hour tabulated in %.2f s (%d segments), %.1f us per tick against %.1f us, max error %.4f arcsec' % \
+                    (name, table, len(traj._segments), tick*1e6, direct*1e6,
+                     np.sqrt((daz*np.cos(np.deg2rad(el)))**2 + (track[:, 1] - el)**2).max()*3600.))
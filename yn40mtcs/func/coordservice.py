@@ -0,0 +1,514 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    coordinate service: az/el tracks computed in a separate process and
+    published into a shared memory ring read by several consumers
+    Date   : Oct. 18th 2026
+'''
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import connection, shared_memory
+
+import numpy as np
+
+from yn40mtcs.core.constants import LOGGER_NAME
+from yn40mtcs.func.trajectory import finite_rates
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+DEFAULT_ADDRESS = ('127.0.0.1', 50060)
+
+# per track slot; a slot handed to another source gets a new generation,
+# count is the number of samples written so far, sample n is at t0 + n*cadence;
+# seq is odd while samples of the slot are being written (a seqlock)
+SLOT_DTYPE = np.dtype([('gen', '<u8'), ('count', '<i8'), ('t0', '<f8'), ('cadence', '<f8'),
+                       ('ra', '<f8'), ('dec', '<f8'), ('end', '<f8'), ('users', '<i8'), ('seq', '<u8')])
+# tries of a reader that meets a write before it falls back to the reduction
+RETRIES = 3
+
+def _layout(buf, nslot, length):
+    '''
+    slot headers (nslot,) and samples (nslot, length, 3) of t, Az, El as
+    views on the shared memory buffer
+    '''
+    slots = np.ndarray((nslot,), dtype=SLOT_DTYPE, buffer=buf)
+    samples = np.ndarray((nslot, length, 3), dtype='<f8', buffer=buf, offset=nslot*SLOT_DTYPE.itemsize)
+    return slots, samples
+
+def _attach(name):
+    '''
+    open an existing shared memory block without handing it to this
+    process' resource tracker, which would remove it when the process exits
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def _authkey(key):
+    '''
+    connection key as bytes, a str is encoded; the requests are pickled,
+    so a key is required
+    '''
+    if not key:
+        raise ValueError('the coordinate service needs an authentication key (coord_service_key)')
+    return key.encode() if isinstance(key, str) else bytes(key)
+
+def parse_address(spec):
+    '''
+    'host:port' or a path (AF_UNIX) -> Listener/Client address
+    '''
+    if isinstance(spec, tuple):
+        return spec
+    host, sep, port = spec.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return spec
+
+class CoordService(object):
+    '''
+    computes the requested tracks with its own CoordGeometry and writes them
+    into a ring of samples per track in shared memory
+
+    Requests are dicts over a multiprocessing.connection socket:
+      {'cmd': 'track', 'ra':, 'dec': (rad), 'cadence': (s), 'start':, 'end': (UNIX, optional)}
+      {'cmd': 'release', 'slot':, 'gen':}
+      {'cmd': 'observer', 'SC':, 'MCOW':}
+      {'cmd': 'status'}, {'cmd': 'shutdown'}
+    Consumers asking for the same source and cadence share one slot. A
+    bounded range that fits in the ring is computed at once, otherwise the
+    ring is kept 'lead' seconds ahead of now. A new site or weather rewrites
+    the samples ahead of now.
+    '''
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, nslot=16, length=8192, lead=60., period=0.5,
+                 backend='CONTEXT', SC=None, MCOW=None, **geometry):
+        '''
+        authkey:   key the clients authenticate with
+        nslot:     number of tracks served at once
+        length:    samples per ring, must hold 2*lead of samples at the finest cadence
+        backend:   reduction backend of radec2azel_batch
+        SC, MCOW:  site and weather of the service observer
+        geometry:  keyword arguments of CoordGeometry (iersfile, ephfile, precision)
+        '''
+        from yn40mtcs.func.conv_coord import CoordGeometry
+        self.address = parse_address(address)
+        self.nslot = int(nslot)
+        self.length = int(length)
+        self.lead = float(lead)
+        self.period = float(period)
+        self.backend = backend
+        self.authkey = _authkey(authkey)
+        self.coodgeo = CoordGeometry(**geometry)
+        self.coodgeo.observer.update(SC, MCOW)
+        size = self.nslot*(SLOT_DTYPE.itemsize + self.length*3*8)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.slots, self.samples = _layout(self.shm.buf, self.nslot, self.length)
+        self.slots[:] = 0
+        self._keys = {}
+        self._lock = threading.Lock()
+        # one writer per slot at a time, the connection threads and the
+        # serve loop both fill; observer revision the samples were computed with
+        self._fills = [threading.Lock() for i in range(self.nslot)]
+        self._revisions = [None]*self.nslot
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._listener = None
+
+    def _reply(self, slot):
+        return {'slot': slot, 'gen': int(self.slots['gen'][slot]), 'shm': self.shm.name,
+                'nslot': self.nslot, 'length': self.length, 'backend': self.backend}
+
+    def _track(self, ra, dec, cadence=0.1, start=None, end=None):
+        cadence = float(cadence)
+        if cadence*self.length<2*self.lead:
+            raise ValueError('cadence {} s is too fine for a ring of {} samples'.format(cadence, self.length))
+        key = (round(float(ra), 9), round(float(dec), 9), cadence, start, end)
+        with self._lock:
+            slot = self._keys.get(key)
+            if slot is not None:
+                self.slots['users'][slot] += 1
+                return self._reply(slot)
+            free = np.nonzero(self.slots['users']==0)[0]
+            if not len(free):
+                raise RuntimeError('all {} track slots are in use'.format(self.nslot))
+            slot = int(free[0])
+            for k, v in list(self._keys.items()):
+                if v==slot:
+                    del self._keys[k]
+            if start is None:
+                start = np.floor(time.time()/cadence)*cadence
+            with self._fills[slot]:
+                s = self.slots[slot:slot+1]
+                # readers check the generation, bump it before anything else changes
+                s['gen'] += 1
+                s['count'] = 0
+                s['t0'] = start
+                s['cadence'] = cadence
+                s['ra'] = ra
+                s['dec'] = dec
+                s['end'] = np.inf if end is None else end
+                s['users'] = 1
+                self._revisions[slot] = None
+            self._keys[key] = slot
+        self._fill(slot)
+        logger.info('track slot {}: RA {} Dec {} every {} s'.format(slot, ra, dec, cadence))
+        return self._reply(slot)
+
+    def _release(self, slot, gen):
+        with self._lock:
+            if self.slots['gen'][slot]==gen and self.slots['users'][slot]>0:
+                self.slots['users'][slot] -= 1
+                # an unused slot is no longer filled, a new request for its
+                # key takes a slot from the start again
+                if self.slots['users'][slot]==0:
+                    for k, v in list(self._keys.items()):
+                        if v==slot:
+                            del self._keys[k]
+        return {'slot': slot}
+
+    def _fill(self, slot):
+        '''
+        compute the samples of a slot that are due, and those ahead of now
+        again when the observer changed since they were computed
+        '''
+        with self._fills[slot]:
+            s = self.slots[slot]
+            count, t0, cadence, ra, dec, end = [s[k] for k in ['count', 't0', 'cadence', 'ra', 'dec', 'end']]
+            now = time.time()
+            if (end - t0)/cadence<self.length:
+                target = end
+            else:
+                target = min(end, now + self.lead)
+            n = max(min(int(np.floor((target - t0)/cadence)) + 1 - count, self.length//2), 0)
+            revision = self.coodgeo.observer.state.revision
+            first = count
+            if self._revisions[slot] is not None and self._revisions[slot]!=revision:
+                first = min(max(int(np.ceil((now - t0)/cadence)), count - self.length + n, 0), count)
+            self._revisions[slot] = revision
+            if first==count + n:
+                return
+            index = np.arange(first, count + n)
+            t = t0 + index*cadence
+            az, el = self.coodgeo.radec2azel_batch(ra, dec, t, backend=self.backend)
+            ring = index % self.length
+            # readers retry when seq changed across their read or was odd
+            self.slots['seq'][slot] += 1
+            self.samples[slot, ring, 0] = t
+            self.samples[slot, ring, 1] = az[:, 0]
+            self.samples[slot, ring, 2] = el[:, 0]
+            self.slots['count'][slot] = count + n
+            self.slots['seq'][slot] += 1
+
+    def handle(self, request):
+        cmd = request.get('cmd')
+        if cmd=='track':
+            return self._track(request['ra'], request['dec'], request.get('cadence', 0.1),
+                               request.get('start'), request.get('end'))
+        if cmd=='release':
+            return self._release(int(request['slot']), int(request['gen']))
+        if cmd=='observer':
+            state = self.coodgeo.observer.update(request.get('SC'), request.get('MCOW'))
+            return {'revision': state.revision}
+        if cmd=='status':
+            return {'shm': self.shm.name, 'nslot': self.nslot, 'length': self.length,
+                    'users': self.slots['users'].tolist(), 'count': self.slots['count'].tolist()}
+        if cmd=='shutdown':
+            self._stop.set()
+            self._wake.set()
+            return {}
+        raise ValueError('unknown request {}'.format(cmd))
+
+    def _serve_connection(self, conn):
+        with conn:
+            while not self._stop.is_set():
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = self.handle(request)
+                except Exception as msg:
+                    reply = {'error': str(msg)}
+                conn.send(reply)
+                self._wake.set()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                conn = self._listener.accept()
+            except Exception as msg:
+                if not self._stop.is_set():
+                    logger.error('coordinate service: {}'.format(msg))
+                continue
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def serve_forever(self):
+        '''
+        accept requests and keep the active tracks filled until shutdown
+        '''
+        self._listener = connection.Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept, daemon=True).start()
+        logger.info('coordinate service on {}, shared memory {}'.format(self.address, self.shm.name))
+        try:
+            while not self._stop.is_set():
+                for slot in np.nonzero(self.slots['users']>0)[0]:
+                    try:
+                        self._fill(int(slot))
+                    except Exception as msg:
+                        logger.error('track slot {} failed: {}'.format(slot, msg))
+                self._wake.wait(self.period)
+                self._wake.clear()
+        finally:
+            self._listener.close()
+            del self.slots, self.samples
+            self.shm.close()
+            self.shm.unlink()
+
+def _serve(kwargs):
+    CoordService(**kwargs).serve_forever()
+
+def start_service(address=DEFAULT_ADDRESS, authkey=None, timeout=30., **kwargs):
+    '''
+    run a CoordService in a child process, return the process once it accepts requests
+    '''
+    kwargs['address'] = parse_address(address)
+    kwargs['authkey'] = _authkey(authkey)
+    process = multiprocessing.Process(target=_serve, args=(kwargs,), daemon=True, name='coordservice')
+    process.start()
+    deadline = time.time() + timeout
+    while True:
+        try:
+            connection.Client(kwargs['address'], authkey=kwargs['authkey']).close()
+            return process
+        except OSError:
+            if time.time()>deadline or not process.is_alive():
+                raise RuntimeError('coordinate service did not start on {}'.format(address))
+            time.sleep(0.05)
+
+class CoordClient(object):
+    '''
+    connection to a CoordService, thread-safe
+    '''
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, backend=None):
+        '''
+        backend: reduction backend the tracks must be computed with, None
+                 takes the one of the service
+        '''
+        self.address = parse_address(address)
+        self.backend = backend
+        self._conn = connection.Client(self.address, authkey=_authkey(authkey))
+        self._lock = threading.Lock()
+        self._shm = {}
+
+    def request(self, **request):
+        with self._lock:
+            self._conn.send(request)
+            reply = self._conn.recv()
+        if 'error' in reply:
+            raise RuntimeError('coordinate service: {}'.format(reply['error']))
+        return reply
+
+    def layout(self, reply):
+        '''
+        slot headers and samples of the shared memory named in a reply
+        '''
+        name = reply['shm']
+        if name not in self._shm:
+            shm = _attach(name)
+            self._shm[name] = (shm, ) + _layout(shm.buf, reply['nslot'], reply['length'])
+        return self._shm[name][1:]
+
+    def set_observer(self, SC=None, MCOW=None):
+        return self.request(cmd='observer', SC=None if SC is None else list(SC),
+                            MCOW=None if MCOW is None else list(MCOW))
+
+    def track(self, ra, dec, cadence=0.1, start=None, end=None, fallback=None):
+        '''
+        started ServiceTrack of ICRS ra, dec (rad)
+        '''
+        track = ServiceTrack(self, ra, dec, cadence, start, end, fallback)
+        track.start()
+        return track
+
+    def close(self):
+        self._conn.close()
+        for shm, slots, samples in self._shm.values():
+            del slots, samples
+        self._shm = {}
+
+class ServiceTrack(object):
+    '''
+    az/el track read from the shared memory ring, same interface as
+    trajectory.Trajectory; evaluate() copies nothing and takes no lock
+    '''
+    def __init__(self, client, ra, dec, cadence=0.1, start=None, end=None, fallback=None):
+        '''
+        fallback: reduce(t) used outside the computed samples, as in Trajectory
+        '''
+        self.client = client
+        self.request = {'cmd': 'track', 'ra': float(ra), 'dec': float(dec), 'cadence': float(cadence),
+                        'start': start, 'end': end}
+        self.fallback = fallback
+        self.slot = None
+
+    def start(self):
+        reply = self.client.request(**self.request)
+        if self.client.backend is not None and reply['backend']!=self.client.backend:
+            self.client.request(cmd='release', slot=reply['slot'], gen=reply['gen'])
+            raise ValueError('coordinate service reduces with {}, {} asked for'.format(
+                             reply['backend'], self.client.backend))
+        self.slots, self.samples = self.client.layout(reply)
+        self.length = reply['length']
+        self.gen = reply['gen']
+        self.slot = reply['slot']
+        s = self.slots[self.slot]
+        self.t0, self.cadence = float(s['t0']), float(s['cadence'])
+        # field views of the headers, read on every evaluate()
+        self._seq, self._count, self._gen = self.slots['seq'], self.slots['count'], self.slots['gen']
+
+    def stop(self):
+        if self.slot is not None:
+            self.client.request(cmd='release', slot=self.slot, gen=self.gen)
+            self.slot = None
+
+    def _locate(self, t):
+        '''
+        ring index of the sample before t and the interpolation weight,
+        None when t is outside the samples held
+        '''
+        x = (t - self.t0)/self.cadence
+        n = int(np.floor(x))
+        count = int(self._count[self.slot])
+        if n<max(count - self.length, 0) or n + 1>=count:
+            return None
+        return n, x - n
+
+    def covers(self, t):
+        return self._locate(t) is not None
+
+    def evaluate(self, t=None):
+        '''
+        Az, El (deg) at UNIX time t, default now, linear between the samples
+        '''
+        if t is None:
+            t = time.time()
+        for i in range(RETRIES):
+            seq = self._seq[self.slot]
+            if seq % 2:
+                continue
+            located = self._locate(t)
+            if located is None:
+                break
+            n, w = located
+            a = self.samples[self.slot, n % self.length]
+            b = self.samples[self.slot, (n + 1) % self.length]
+            az0, el0, az1, el1 = a[1], a[2], b[1], b[2]
+            # the samples are valid if no write started or ended while they
+            # were read and the slot was not reassigned
+            if self._seq[self.slot]==seq and self._gen[self.slot]==self.gen:
+                daz = (az1 - az0 + 180.) % 360. - 180.
+                return float((az0 + w*daz) % 360.), float(el0 + w*(el1 - el0))
+        if self.fallback is None:
+            raise ValueError('track slot {} does not cover {}'.format(self.slot, t))
+        logger.warning('coordinate service does not cover {}, using full reduction'.format(t))
+        az, el = self.fallback(np.array([t]))
+        return float(np.ravel(az)[0]), float(np.ravel(el)[0])
+
+    def evaluate_rates(self, t=None):
+        '''
+        Az, El (deg), rates (deg/s) and accelerations (deg/s^2) at UNIX times
+        t (default now) by central differences over the samples
+        '''
+        if t is None:
+            t = time.time()
+        def position(x):
+            return np.array([self.evaluate(v) for v in x]).T
+        return finite_rates(position, t, self.cadence)
+
+def connect(spec, SC=None, MCOW=None, authkey=None, backend='CONTEXT', **geometry):
+    '''
+    client of the service at 'host:port'; 'local' first starts one in a
+    child process (CoordGeometry keyword arguments in geometry) listening
+    on the loopback interface, with a key of its own unless one is given
+    SC, MCOW: site and weather passed to the service observer
+    authkey:  key of the service
+    backend:  reduction backend of the tracks, a running service with
+              another one is refused when a track is asked for
+    '''
+    address = DEFAULT_ADDRESS if spec=='local' else parse_address(spec)
+    if spec=='local':
+        authkey = authkey or os.urandom(32)
+        start_service(address, authkey, SC=SC, MCOW=MCOW, backend=backend, **geometry)
+    client = CoordClient(address, authkey, backend)
+    if SC is not None or MCOW is not None:
+        client.set_observer(SC, MCOW)
+    return client
+
+if __name__=='__main__':
+    import sys
+    if len(sys.argv)>1 and sys.argv[1]=='serve':
+        # standalone service, the key as in coord_service_key and the backend
+        # as in coord_converter:
+        # COORD_SERVICE_KEY=... python -m yn40mtcs.func.coordservice serve [host:port [backend]]
+        logging.basicConfig(level=logging.INFO)
+        CoordService(sys.argv[2] if len(sys.argv)>2 else DEFAULT_ADDRESS, os.environ.get('COORD_SERVICE_KEY'),
+                     backend=sys.argv[3] if len(sys.argv)>3 else 'CONTEXT').serve_forever()
+        sys.exit(0)
+
+    from yn40mtcs.func.conv_coord import CoordGeometry
+    print('testing coordservice.py')
+    key = os.urandom(32)
+    process = start_service(authkey=key)
+    clients = [CoordClient(authkey=key) for i in range(3)]
+    ra, dec = np.deg2rad(83.633), np.deg2rad(22.0145)
+    tracks = [client.track(ra, dec, 0.1) for client in clients]
+    print('three consumers, slots:', [track.slot for track in tracks], clients[0].request(cmd='status')['users'])
+
+    coodgeo = CoordGeometry()
+    t = time.time() + np.sort(np.random.uniform(0., 30., 2000))
+    start = time.perf_counter()
+    track = np.array([tracks[0].evaluate(v) for v in t])
+    print('evaluate %.2f us per call' % ((time.perf_counter() - start)/len(t)*1e6))
+    az, el = coodgeo.radec2azel_batch(ra, dec, t, backend='CONTEXT')
+    daz = (track[:, 0] - az[:, 0] + 180.) % 360. - 180.
+    print('max error against the direct reduction (arcsec): %.4f' % \
+            (np.sqrt((daz*np.cos(np.deg2rad(el[:, 0])))**2 + (track[:, 1] - el[:, 0])**2).max()*3600.))
+    print('other consumers agree:', all(tr.evaluate(t[0])==tuple(track[0]) for tr in tracks[1:]))
+
+    # a 100 Hz loop in this process while tracks are computed: in the
+    # service process, and in a thread of this process
+    def jitter(seconds=3.):
+        late = []
+        tick = time.perf_counter()
+        while time.perf_counter() - tick<seconds:
+            due = time.perf_counter() + 0.01
+            tracks[0].evaluate()
+            while time.perf_counter()<due:
+                pass
+            late.append(time.perf_counter() - due)
+        return np.percentile(late, 99.9)*1e3
+    more = [clients[0].track(ra + 0.1*i, dec, 0.1) for i in range(1, 8)]
+    print('loop lateness, 99.9%%, tracks in the service process: %.3f ms' % jitter())
+    stop = threading.Event()
+    def compute():
+        while not stop.is_set():
+            coodgeo.radec2azel_batch(ra + np.arange(8)*0.1, np.full(8, dec), time.time() + np.arange(600)*0.1, backend='SOFA')
+    worker = threading.Thread(target=compute, daemon=True)
+    worker.start()
+    print('loop lateness, 99.9%%, tracks in a thread of this process: %.3f ms' % jitter())
+    stop.set()
+    worker.join()
+    for tr in tracks + more:
+        tr.stop()
+    clients[0].request(cmd='shutdown')
+    for client in clients:
+        client.close()
+    process.join(5.)
@@ -4,30 +4,423 @@
 Author : Huang Yuxiang, Li Kejia, Dai Wei, Wei Shoulin
 Date   : Aug. 24th 2019
          Sep. 10th 2023
+         Oct. 18th 2026  binary memory-mapped store, finals2000A.all builder,
+                         refresh with atomic swap
 '''
 
+import logging
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
 import numpy as np
 
+from yn40mtcs.core.constants import LOGGER_NAME
 from yn40mtcs.core.utils import data_path
 
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+# binary store: 64 byte header, then little-endian float64 rows of
+# MJD, PMx(arcsec), PMy(arcsec), UT1-UTC(s), dX(mas), dY(mas); a refresh
+# appends a marker row (NaN, number of rows) and the rows from the first
+# new or changed day on, which replace the rows before them from that day
+MAGIC = b'YN40EOP\0'
+FORMAT = 1
+HEADER = struct.Struct('<8siii4d')
+HEADER_SIZE = 64
+NCOL = 6
+# a store is rewritten in one piece when the appended rows reach this
+# fraction of the table
+COMPACT = 0.5
+
+# finals2000A.all fixed columns (0-based slices), IERS readme.finals2000A
+FINALS_COLUMNS = [(7, 15), (18, 27), (37, 46), (58, 68), (97, 106), (116, 125)]
+FINALS_WIDTH = 188
+
+def _fixed_columns(raw, start, stop):
+    '''
+    float column from a (N, width) byte array, blank fields become NaN
+    '''
+    field = np.char.strip(np.ascontiguousarray(raw[:, start:stop]).view('S%d' % (stop - start)).ravel())
+    return np.where(field==b'', b'nan', field).astype(float)
+
+def read_finals(filepath=data_path('finals2000A.all')):
+    '''
+    parse finals2000A.all, measured and predicted rows (IERS Bulletin A values)
+    return: table (N, 6) as stored, MJD of the first predicted UT1-UTC
+    '''
+    with open(filepath, 'rb') as f:
+        lines = f.read().splitlines()
+    raw = np.array(lines, dtype='S%d' % FINALS_WIDTH).view(np.uint8).reshape(len(lines), FINALS_WIDTH).copy()
+    raw[raw==0] = ord(' ')
+    table = np.column_stack([_fixed_columns(raw, a, b) for a, b in FINALS_COLUMNS])
+    # the tail of the file has dates only; the nutation offsets stop before the
+    # polar motion and UT1 predictions do, hold the last value there
+    keep = ~np.isnan(table[:, :4]).any(axis=1)
+    table = table[keep]
+    for col in (4, 5):
+        valid = ~np.isnan(table[:, col])
+        idx = np.maximum.accumulate(np.where(valid, np.arange(len(table)), 0))
+        table[:, col] = np.where(valid[idx], table[idx, col], 0.)
+    predicted = raw[keep, 57]==ord('P')
+    mjd_predicted = table[predicted, 0].min() if predicted.any() else table[-1, 0] + 1.
+    return table, mjd_predicted
+
+def read_header(filepath):
+    '''
+    header of a binary store as a dict
+    '''
+    with open(filepath, 'rb') as f:
+        magic, fmt, version, nrows, created, first, last, predicted = HEADER.unpack(f.read(HEADER.size))
+    if magic!=MAGIC:
+        raise ValueError('{} is not an EOP store'.format(filepath))
+    if fmt!=FORMAT:
+        raise ValueError('{}: EOP store format {} is not supported'.format(filepath, fmt))
+    return {'version': version, 'nrows': nrows, 'created': created,
+            'coverage': (first, last), 'predicted': predicted}
+
+def write_store(filepath, table, mjd_predicted, version=None):
+    '''
+    write table (N, 6) as a binary store, the version counts up from the
+    store that is replaced
+    '''
+    table = np.ascontiguousarray(table, dtype='<f8')
+    if version is None:
+        version = 1
+        if os.path.exists(filepath):
+            try:
+                version = read_header(filepath)['version'] + 1
+            except ValueError:
+                pass
+    head = HEADER.pack(MAGIC, FORMAT, version, len(table), time.time(),
+                       table[0, 0], table[-1, 0], mjd_predicted)
+    with open(filepath, 'wb') as f:
+        f.write(head.ljust(HEADER_SIZE, b'\0'))
+        f.write(table.tobytes())
+    return version
+
+def append_store(filepath, header, block, mjd_predicted, version):
+    '''
+    append block, the rows of the table from its first MJD on, to a binary
+    store with the given header; the rows are written after the ones in
+    use and the header is rewritten last, so readers that opened the store
+    before keep their rows
+    return: the version
+    '''
+    block = np.ascontiguousarray(block, dtype='<f8')
+    marker = np.array([[np.nan, len(block), 0., 0., 0., 0.]], dtype='<f8')
+    nrows = header['nrows'] + 1 + len(block)
+    with open(filepath, 'r+b') as f:
+        f.seek(HEADER_SIZE + header['nrows']*NCOL*8)
+        f.write(marker.tobytes())
+        f.write(block.tobytes())
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        head = HEADER.pack(MAGIC, FORMAT, version, nrows, time.time(),
+                           header['coverage'][0], block[-1, 0], mjd_predicted)
+        f.seek(0)
+        f.write(head.ljust(HEADER_SIZE, b'\0'))
+        f.flush()
+        os.fsync(f.fileno())
+    return version
+
+def read_store(filepath, header):
+    '''
+    table (N, 6) of a binary store, memory-mapped while nothing has been
+    appended to it
+    return: table, number of appended rows
+    '''
+    raw = np.memmap(filepath, dtype='<f8', mode='r', offset=HEADER_SIZE, shape=(header['nrows'], NCOL))
+    marks = np.flatnonzero(np.isnan(raw[:, 0]))
+    if len(marks)==0:
+        return raw, 0
+    table = np.asarray(raw[:marks[0]])
+    for m in marks:
+        block = raw[m+1:m+1+int(raw[m, 1])]
+        table = np.concatenate((table[table[:, 0]<block[0, 0]], block))
+    return table, len(raw) - marks[0]
+
+def read_table(filepath):
+    '''
+    finals2000A.all or a six column text table like iers.txt
+    return: table (N, 6), MJD of the first predicted row
+    '''
+    if filepath.endswith('.txt'):
+        table = np.loadtxt(filepath)
+        return table, table[-1, 0] + 1.
+    return read_finals(filepath)
+
+def merge(table, new):
+    '''
+    rows of new replace those of table for the same MJD and extend it
+    return: merged table, number of new rows, number of changed rows
+    '''
+    first, last = new[0, 0], new[-1, 0]
+    old = table[(table[:, 0]>=first) & (table[:, 0]<=last)]
+    common = np.isin(new[:, 0], old[:, 0])
+    nnew = int((~common).sum())
+    nchanged = int(np.any(new[common]!=old[np.isin(old[:, 0], new[:, 0])], axis=1).sum())
+    merged = np.concatenate((table[table[:, 0]<first], new, table[table[:, 0]>last]))
+    return merged, nnew, nchanged
+
+def build(finals=data_path('finals2000A.all'), output=data_path('iers.eop')):
+    '''
+    finals2000A.all (or a six column text table like iers.txt) -> binary store
+    '''
+    table, mjd_predicted = read_table(finals)
+    version = write_store(output, table, mjd_predicted)
+    logger.info('EOP store {} version {}: MJD {}-{}, predictions from {}'.format(
+                output, version, table[0, 0], table[-1, 0], mjd_predicted))
+    return output
+
+Snapshot = namedtuple('Snapshot', ['version', 'created', 'coverage', 'predicted', 'table',
+                                   'mjd', 'values', 'slope'])
+
+def _snapshot(version, created, predicted, table):
+    '''
+    snapshot of a table (N, 6): the MJD column, a contiguous (N, 5) table in
+    the order returned by getEOP (UT1-UTC, PMx, PMy, dX, dY in arcsec) and the
+    slopes per day of its N-1 intervals
+    '''
+    mjd=np.ascontiguousarray(table[:,0])
+    values=np.ascontiguousarray(table[:,[3,1,2,4,5]])
+    values[:,3:]*=1e-3
+    slope=np.diff(values, axis=0)/np.diff(mjd)[:,np.newaxis]
+    return Snapshot(version, created, (float(mjd[0]), float(mjd[-1])), predicted, table, mjd, values, slope)
+
 class EOP(object):
-    def __init__(self, filepath= data_path('iers.txt')):
-        self.iers=np.loadtxt(filepath)
-        self.vmjd=self.iers[:,0]
-        self.vpmx=self.iers[:,1]
-        self.vpmy=self.iers[:,2]
-        self.vut1utc=self.iers[:,3]
-        self.vdx=self.iers[:,4]
-        self.vdy=self.iers[:,5]
+    '''
+    Earth orientation parameters interpolated from the daily table
+
+    The table and its version, coverage and start of predictions form one
+    snapshot. refresh() builds a new snapshot and replaces the reference in
+    one assignment; getEOP() takes the reference once per call, so readers
+    never see a half-updated table and never wait for a refresh.
+    '''
+    def __init__(self, filepath= data_path('iers.eop')):
+        '''
+        filepath: binary store (memory-mapped) or the six column text table
+        '''
+        self.filepath=filepath
+        self._snapshot=self._load(filepath)
+        self._lock=threading.Lock()
+        self._thread=None
+        self._stop=threading.Event()
+        self._warned=False
+        self._bracket=None
+
+        today=time.time()/86400.+40587.
+        if not self.coverage[0]<=today<=self.coverage[1]:
+            logger.warning('EOP data {} (MJD {}-{}) does not cover today (MJD {:.0f}), update finals2000A.all'.format(
+                           filepath, self.coverage[0], self.coverage[1], today))
+        elif today>=self.predicted:
+            logger.info('EOP data {} is predicted after MJD {}'.format(filepath, self.predicted))
+
+    @staticmethod
+    def _load(filepath):
+        if filepath.endswith('.txt'):
+            iers=np.loadtxt(filepath)
+            return _snapshot(0, os.path.getmtime(filepath), iers[-1,0]+1., iers)
+        header=read_header(filepath)
+        iers, appended=read_store(filepath, header)
+        return _snapshot(header['version'], header['created'], header['predicted'], iers)
+
+    version=property(lambda self: self._snapshot.version)
+    created=property(lambda self: self._snapshot.created)
+    coverage=property(lambda self: self._snapshot.coverage)
+    predicted=property(lambda self: self._snapshot.predicted)
+    iers=property(lambda self: self._snapshot.table)
+    vmjd=property(lambda self: self._snapshot.table[:,0])
+    vpmx=property(lambda self: self._snapshot.table[:,1])
+    vpmy=property(lambda self: self._snapshot.table[:,2])
+    vut1utc=property(lambda self: self._snapshot.table[:,3])
+    vdx=property(lambda self: self._snapshot.table[:,4])
+    vdy=property(lambda self: self._snapshot.table[:,5])
+
+    def refresh(self, finals=data_path('finals2000A.all')):
+        '''
+        merge the new and changed daily rows of finals into the table
+        a binary store gets the rows from the first new or changed day
+        appended (and is rewritten next to the old one and renamed over it
+        once the appended rows reach COMPACT of the table), then the
+        snapshot is swapped
+        return: True if the table changed
+        '''
+        with self._lock:
+            snap=self._snapshot
+            new, predicted=read_table(finals)
+            if predicted<snap.predicted:
+                logger.warning('{} predicts from MJD {}, older than the EOP data in use ({}), ignored'.format(
+                               finals, predicted, snap.predicted))
+                return False
+            old=np.asarray(snap.table)
+            table, nnew, nchanged=merge(old, new)
+            if nnew+nchanged==0:
+                return False
+            if self.filepath.endswith('.txt'):
+                snap=_snapshot(snap.version+1, time.time(), predicted, table)
+            else:
+                # rows from the first one that differs from the table in use
+                n=min(len(old), len(table))
+                differ=np.flatnonzero(np.any(old[:n]!=table[:n], axis=1))
+                first=differ[0] if len(differ) else n
+                header=read_header(self.filepath)
+                appended=read_store(self.filepath, header)[1]
+                if appended+1+len(table)-first>=COMPACT*len(table):
+                    tmp=self.filepath+'.tmp'
+                    write_store(tmp, table, predicted, snap.version+1)
+                    os.replace(tmp, self.filepath)
+                else:
+                    append_store(self.filepath, header, table[first:], predicted, snap.version+1)
+                snap=self._load(self.filepath)
+            self._snapshot=snap
+            self._warned=False
+        logger.info('EOP version {}: {} new, {} changed rows, MJD {}-{}'.format(
+                    snap.version, nnew, nchanged, *snap.coverage))
+        return True
+
+    def _run(self, finals, period):
+        mtime=os.path.getmtime(finals) if os.path.exists(finals) else None
+        while not self._stop.wait(period):
+            try:
+                if not os.path.exists(finals) or os.path.getmtime(finals)==mtime:
+                    continue
+                mtime=os.path.getmtime(finals)
+                self.refresh(finals)
+            except Exception as msg:
+                logger.error('EOP refresh from {} failed: {}'.format(finals, msg))
+
+    def watch(self, finals=data_path('finals2000A.all'), period=600.):
+        '''
+        refresh whenever the modification time of finals changes
+        '''
+        self._stop.clear()
+        self._thread=threading.Thread(target=self._run, args=(finals, period), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread=None
+
+    def stale(self, mjd):
+        '''
+        True where mjd is outside the tabulated range (the values are then held constant)
+        '''
+        mjd=np.asarray(mjd)
+        first, last=self.coverage
+        return (mjd<first)|(mjd>last)
 
     def getEOP(self, mjd):
-        pmx=np.interp(mjd, self.vmjd, self.vpmx)
-        pmy=np.interp(mjd, self.vmjd, self.vpmy)
-        ut1utc=np.interp(mjd, self.vmjd, self.vut1utc)
-        dx=np.interp(mjd, self.vmjd, self.vdx)
-        dy=np.interp(mjd, self.vmjd, self.vdy)
-        return  ut1utc, pmx, pmy,dx*1e-3,dy*1e-3
+        '''
+        mjd:    UTC MJD, scalar or array
+        return: UT1-UTC(s), PMx(arcsec), PMy(arcsec), dX(arcsec), dY(arcsec),
+                linear between the daily rows and held constant outside them
+        '''
+        snap=self._snapshot
+        if np.ndim(mjd)==0:
+            # the bracketing day of the last call is reused until mjd leaves it
+            mjd=float(mjd)
+            bracket=self._bracket
+            if bracket is None or bracket[0] is not snap or not bracket[1]<=mjd<bracket[2]:
+                bracket=self._find_bracket(snap, mjd)
+                self._bracket=bracket
+            snap, start, end, mjd0, v0, slope=bracket
+            return tuple(v0 + (mjd - mjd0)*slope)
+        mjd=np.asarray(mjd, dtype=float)
+        if not self._warned and np.any(self.stale(mjd)):
+            self._warn(mjd, snap)
+        n=len(snap.mjd)
+        i=np.clip(np.searchsorted(snap.mjd, mjd, side='right')-1, 0, n-2)
+        dt=np.clip(mjd, snap.mjd[0], snap.mjd[-1]) - snap.mjd[i]
+        values=snap.values[i] + dt[...,np.newaxis]*snap.slope[i]
+        return tuple(np.moveaxis(values, -1, 0))
+
+    def _find_bracket(self, snap, mjd):
+        '''
+        (snapshot, start, end, reference MJD, values there, slopes) of the
+        interval holding mjd, outside the table an open interval with zero slope
+        '''
+        n=len(snap.mjd)
+        i=int(np.searchsorted(snap.mjd, mjd, side='right'))-1
+        if 0<=i<n-1:
+            return snap, snap.mjd[i], snap.mjd[i+1], snap.mjd[i], snap.values[i], snap.slope[i]
+        if not self._warned:
+            self._warn(mjd, snap)
+        zero=np.zeros(snap.values.shape[1])
+        if i<0:
+            return snap, -np.inf, snap.mjd[0], snap.mjd[0], snap.values[0], zero
+        return snap, snap.mjd[-1], np.inf, snap.mjd[-1], snap.values[-1], zero
+
+    def _warn(self, mjd, snap):
+        logger.warning('MJD {}-{} outside the EOP coverage {}-{}'.format(np.min(mjd), np.max(mjd), *snap.coverage))
+        self._warned=True
 
 if __name__=='__main__':
+    import sys
+    if len(sys.argv)>1 and sys.argv[1]=='build':
+        # python -m yn40mtcs.func.eop build [finals2000A.all [iers.eop]]
+        logging.basicConfig(level=logging.INFO)
+        build(*sys.argv[2:4])
+        sys.exit()
+    if len(sys.argv)>1 and sys.argv[1]=='refresh':
+        # hot swap on a copy of the store while threads keep reading
+        import shutil
+        import tempfile
+        logging.basicConfig(level=logging.INFO)
+        finals=sys.argv[2] if len(sys.argv)>2 else data_path('iers.txt')
+        tmp=os.path.join(tempfile.mkdtemp(), 'iers.eop')
+        table, predicted=read_table(data_path('iers.txt'))
+        write_store(tmp, table[:-400], predicted-400)
+        eop=EOP(tmp)
+        errors=[]
+        def reader():
+            mjd=eop.coverage[0]+np.arange(1000)*17.3
+            while not eop._stop.is_set():
+                if not np.all(np.isfinite(eop.getEOP(mjd))):
+                    errors.append(mjd)
+        threads=[threading.Thread(target=reader) for i in range(4)]
+        for t in threads:
+            t.start()
+        print('before: version %d, coverage %s' % (eop.version, eop.coverage))
+        start=time.perf_counter()
+        eop.refresh(finals)
+        print('after:  version %d, coverage %s, refresh %.1f ms' % (eop.version, eop.coverage, (time.perf_counter()-start)*1e3))
+        eop._stop.set()
+        for t in threads:
+            t.join()
+        print('reader errors:', len(errors))
+        shutil.rmtree(os.path.dirname(tmp))
+        sys.exit()
+    start=time.perf_counter()
+    text=EOP(data_path('iers.txt'))
+    loadtxt=time.perf_counter()-start
+    start=time.perf_counter()
     eop=EOP()
-    print(eop.getEOP(56385))
+    mapped=time.perf_counter()-start
+    print('loadtxt %.1f ms, memory-mapped %.3f ms, version %d, coverage %s' % (loadtxt*1e3, mapped*1e3, eop.version, eop.coverage))
+    print(eop.getEOP(56385), text.getEOP(56385))
+
+    # against five np.interp calls, scalar within one day and vector
+    def interp(mjd):
+        t=eop.iers
+        return np.array([np.interp(mjd, t[:,0], t[:,3]), np.interp(mjd, t[:,0], t[:,1]), np.interp(mjd, t[:,0], t[:,2]),
+                         np.interp(mjd, t[:,0], t[:,4])*1e-3, np.interp(mjd, t[:,0], t[:,5])*1e-3])
+    mjd=60000.3+np.arange(10000)*1e-5
+    start=time.perf_counter()
+    ref=np.array([interp(v) for v in mjd])
+    old=time.perf_counter()-start
+    start=time.perf_counter()
+    new=np.array([eop.getEOP(v) for v in mjd])
+    cached=time.perf_counter()-start
+    print('scalar: np.interp x5 %.2f us, bracket cached %.2f us per call, max diff %g' % \
+          (old/len(mjd)*1e6, cached/len(mjd)*1e6, np.abs(new-ref).max()))
+    mjd=np.random.uniform(eop.coverage[0]-10, eop.coverage[1]+10, 100000)
+    start=time.perf_counter()
+    new=np.array(eop.getEOP(mjd))
+    vect=time.perf_counter()-start
+    print('vector: %d epochs in %.2f ms, max diff %g' % (len(mjd), vect*1e3, np.abs(new-interp(mjd)).max()))
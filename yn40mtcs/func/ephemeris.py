@@ -0,0 +1,180 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    memory-mapped reader of the JPL binary ephemeris (DE405/DE435 ...),
+    vectorized Chebyshev evaluation for many bodies and epochs
+    Date   : Oct. 18th 2026
+'''
+
+import ctypes
+import logging
+import struct
+
+import numpy as np
+
+from yn40mtcs.core.constants import LOGGER_NAME
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+# target/center numbering of jpl_pleph
+MERCURY, VENUS, EARTH, MARS, JUPITER, SATURN, URANUS, NEPTUNE, PLUTO, MOON, SUN, SSB, EMB = range(1, 14)
+
+# targets by name, as taken by Telescope.TrackBody
+BODIES = {'mercury': MERCURY, 'venus': VENUS, 'mars': MARS, 'jupiter': JUPITER, 'saturn': SATURN,
+          'uranus': URANUS, 'neptune': NEPTUNE, 'pluto': PLUTO, 'moon': MOON, 'sun': SUN}
+
+def copy_to_swig(ptr, array):
+    '''
+    copy a numpy array into the C double array behind a SWIG pointer
+    (e.g. sofaswig.Create2DArray23) in one memmove
+    '''
+    array = np.ascontiguousarray(array, dtype=np.float64)
+    ctypes.memmove(int(ptr), array.ctypes.data, array.nbytes)
+    return ptr
+
+class JPLEphemeris(object):
+    '''
+    NumPy reader of the JPL binary ephemeris
+
+    The data records are memory-mapped read-only, so processes that read
+    the same file share its pages. The file is opened on first use.
+    '''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._data = None
+
+    def _open(self):
+        with open(self.filepath, 'rb') as f:
+            head = f.read(2856)
+        for endian in '<>':
+            numde = struct.unpack(endian+'i', head[2840:2844])[0]
+            if 100<numde<10000:
+                break
+        else:
+            raise ValueError('{} is not a JPL binary ephemeris'.format(self.filepath))
+        self.title = head[:252].decode('ascii', 'replace')
+        self.start, self.end, self.step = struct.unpack(endian+'3d', head[2652:2676])
+        self.ncon = struct.unpack(endian+'i', head[2676:2680])[0]
+        self.au, self.emrat = struct.unpack(endian+'2d', head[2680:2696])
+        self.ipt = np.array(struct.unpack(endian+'36i', head[2696:2840])).reshape(12, 3)
+        self.numde = numde
+        lpt = np.array(struct.unpack(endian+'3i', head[2844:2856]))
+
+        ncoeff = 2
+        for i, (offset, ncf, nsub) in enumerate(list(self.ipt) + [lpt]):
+            ncoeff += ncf*nsub*(2 if i==11 else 3)
+        candidates = [ncoeff]
+        if self.ncon>400:
+            # DE430 and later: extra constant names, then the TT-TDB pointer
+            with open(self.filepath, 'rb') as f:
+                f.seek(2856 + (self.ncon - 400)*6)
+                tpt = struct.unpack(endian+'3i', f.read(12))
+            candidates.append(ncoeff + tpt[1]*tpt[2])
+        dtype = np.dtype(endian+'f8')
+        for ncoeff in candidates:
+            data = np.memmap(self.filepath, dtype=dtype, mode='r', offset=2*ncoeff*8)
+            if data.size>=ncoeff and data[0]==self.start and data[1]==self.start + self.step:
+                break
+        else:
+            raise ValueError('{}: cannot determine the record size'.format(self.filepath))
+        self.ncoeff = ncoeff
+        nrec = data.size//ncoeff
+        self._data = data[:nrec*ncoeff].reshape(nrec, ncoeff)
+        logger.info('JPL ephemeris DE{} {}-{} mapped, {} records'.format(numde, self.start, self.end, nrec))
+
+    def _interp(self, body, jd1, jd2):
+        '''
+        position (km) and velocity (km/day) of ipt body index from the
+        Chebyshev records, arrays of shape (N, 2, 3)
+        '''
+        data = self._data
+        offset, ncf, nsub = self.ipt[body]
+        t = ((jd1 - self.start) + jd2)/self.step
+        rec = np.clip(np.floor(t).astype(int), 0, data.shape[0] - 1)
+        if np.any(t<0) or np.any(t>data.shape[0]):
+            raise ValueError('epoch outside the ephemeris {}-{}'.format(self.start, self.end))
+        tc = (t - rec)*nsub
+        sub = np.clip(np.floor(tc).astype(int), 0, nsub - 1)
+        x = 2.*(tc - sub) - 1.
+
+        # Chebyshev polynomials and their derivatives, (N, ncf)
+        n = len(x)
+        pc = np.empty((n, ncf))
+        vc = np.zeros((n, ncf))
+        pc[:, 0] = 1.
+        pc[:, 1] = x
+        vc[:, 1] = 1.
+        for k in range(2, ncf):
+            pc[:, k] = 2.*x*pc[:, k-1] - pc[:, k-2]
+            vc[:, k] = 2.*x*vc[:, k-1] + 2.*pc[:, k-1] - vc[:, k-2]
+
+        idx = (offset - 1 + sub*ncf*3)[:, np.newaxis, np.newaxis] \
+                + (np.arange(3)*ncf)[np.newaxis, :, np.newaxis] + np.arange(ncf)[np.newaxis, np.newaxis, :]
+        coef = data[rec[:, np.newaxis, np.newaxis], idx]
+        pv = np.empty((n, 2, 3))
+        pv[:, 0, :] = np.einsum('nck,nk->nc', coef, pc)
+        pv[:, 1, :] = np.einsum('nck,nk->nc', coef, vc)*(2.*nsub/self.step)
+        return pv
+
+    def _barycentric(self, target, jd1, jd2):
+        '''
+        barycentric pv (km, km/day) of a jpl_pleph target
+        '''
+        if target==SSB:
+            return np.zeros((len(jd1), 2, 3))
+        if target in (EARTH, MOON):
+            emb = self._interp(2, jd1, jd2)
+            moon = self._interp(9, jd1, jd2)
+            if target==EARTH:
+                return emb - moon/(1. + self.emrat)
+            return emb + moon*self.emrat/(1. + self.emrat)
+        if target==EMB:
+            return self._interp(2, jd1, jd2)
+        if target==SUN:
+            return self._interp(10, jd1, jd2)
+        return self._interp(target - 1, jd1, jd2)
+
+    def state(self, tdb1, tdb2, targets, center=SSB):
+        '''
+        tdb1, tdb2: TDB as a 2-part Julian Date, scalars or arrays of N epochs
+        targets:    jpl_pleph target numbers
+        return:     position (au) and velocity (au/day), array (N, len(targets), 2, 3)
+        '''
+        if self._data is None:
+            self._open()
+        jd1, jd2 = np.broadcast_arrays(np.atleast_1d(np.asarray(tdb1, dtype=float)),
+                                       np.atleast_1d(np.asarray(tdb2, dtype=float)))
+        pv = np.empty((len(jd1), len(targets), 2, 3))
+        cpv = self._barycentric(center, jd1, jd2)
+        for i, target in enumerate(targets):
+            pv[:, i] = self._barycentric(target, jd1, jd2) - cpv
+        return pv/self.au
+
+if __name__=='__main__':
+    import sys
+    import time
+    from yn40mtcs.core.utils import data_path
+    from . import jplephswig as jpleph
+    print('testing ephemeris.py')
+    filepath = sys.argv[1] if len(sys.argv)>1 else data_path('DE435.1950.2050')
+    eph = JPLEphemeris(filepath)
+    swig = jpleph.JPLEph(filepath)
+    eph._open()
+    # jpl_state selects the record from the first part of the date only, and
+    # the previous one when it falls on a record boundary: split at noon
+    tdb = np.random.uniform(0, eph.end - eph.start - 1., 1000)
+    tdb1 = eph.start + np.floor(tdb) + 0.5
+    tdb2 = tdb - np.floor(tdb) - 0.5
+    targets = [SATURN, JUPITER, SUN, EARTH]
+    start = time.perf_counter()
+    ref = np.empty((len(tdb2), len(targets), 6))
+    for i in range(len(tdb)):
+        for j, ntarg in enumerate(targets):
+            swig.Calculate(tdb1[i], tdb2[i], ntarg, SSB)
+            ref[i, j] = [swig.GetValue(k) for k in range(6)]
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    pv = eph.state(tdb1, tdb2, targets)
+    vect = time.perf_counter() - start
+    print('max |dp| (au), |dv| (au/day):', np.abs(pv[..., 0, :] - ref[..., :3]).max(), np.abs(pv[..., 1, :] - ref[..., 3:]).max())
+    print('SWIG loop %.4f s, numpy %.4f s for %d epochs x %d bodies' % (loop, vect, len(tdb2), len(targets)))
@@ -24,10 +24,23 @@ import zmq
 
 
 from yn40mtcs.core.constants import LOGGER_NAME
+from yn40mtcs.core.utils import data_path
 from yn40mtcs.device.telescope import Telescope
 from yn40mtcs.func.sourcelist import SourceList
+from yn40mtcs.func import pointingfit, pointingmodel
 
 logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+# one sample of a cross scan, time in UNIX seconds
+SCAN_DTYPE = [('time', 'f8'), ('az', 'f8'), ('el', 'f8'), ('az_src', 'f8'), ('el_src', 'f8'),
+              ('az_conv', 'f8'), ('el_conv', 'f8'), ('daz', 'f8'), ('del', 'f8'), ('powl', 'f8'),
+              ('consume', 'f8')]
+
+def _iso(t):
+    # UNIX time as str(astropy.time.Time.now()) writes it
+    sec, us = divmod(int(round(t*1e6)), 1000000)
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(sec)) + '.%06d' % us
+
 class Point:
     def __init__(self,midpath):
 
@@ -38,10 +51,15 @@ class Point:
         self._Cal = self.middir + self._Tele.config.cal_fil
         self._srclst = SourceList()
         self._INST = self._Tele.config.pm_addr # 'TCPIP::178.1.16.32::INSTR'
+        self.fitter = None # pointingfit.RecursiveFit following cal.dat, see start_fit()
+        fitpar = self._Tele.config.getValue('pointing_fit')
+        self._FitPar = fitpar and data_path(fitpar) # model file the fit publishes
         
         # Start thread background
         self._Tele.StartControlThread()
         logger.info('Control thread started')
+        if self._FitPar:
+            self.start_fit()
 
         #ZMQ Init
         self.context = zmq.Context()
@@ -80,38 +98,19 @@ class Point:
     #--------------------Cross Scanning--------------------
     def cross_scan(self, sourcename, powmeter, az_scan=0.2, el_scan=0.2, shape=(120,120)):
 
-        # initial viable
-        vdaz = np.array([])
-        vdel = np.array([])
-        vpowl = np.array([])
-        vaz = np.array([])
-        vel = np.array([])
-        azsrc = np.array([]) #
-        elsrc = np.array([]) #
-        azconv = np.array([])
-        elconv = np.array([])
-        vdaz_fit = np.array([])
-        vdaz_pow_fit = np.array([])
-        vdel_fit = np.array([])
-        vdel_pow_fit = np.array([])
-        time_azel = [] #
-        time_consume = []
-
-        vdaz = []
-        vdel = []
-        vpowl = []
-        vaz = []
-        vel = []
-        vdaz_fit = []
-        vdaz_pow_fit = []
-        vdel_fit = []
-        vdel_pow_fit = []
+        # samples of the AZ scan then the EL scan, preallocated from shape;
+        # the curves below are views of it, the times become astropy Time in
+        # one call when the scan is done
+        scan = np.zeros(2*(shape[0] + shape[1]), dtype=SCAN_DTYPE)
+        n = 0
 
         # viewing********* Feb. 26th 2020
-        for idx in range(0,self._srclst.number_src()):
-            if sourcename == self._srclst.get_src_name(idx):
-                _ra,_dec = self._srclst.get_radec(idx)
-                _srcradec = _ra + ' ' + _dec
+        idx = self._srclst.find(sourcename)
+        if idx is None:
+            logger.error('source {} is not in {}'.format(sourcename, self._srclst.filename))
+            return False
+        _ra,_dec = self._srclst.get_radec(idx)
+        _srcradec = self._srclst.get_radec_rad(idx)
         with self._Tele._lock:
             if self._Tele.status in ['IDLE','LIMIT','TRACKAZEL','TRACKRADEC']:
                 self._Tele.sourcename = sourcename # 20210228
@@ -127,19 +126,19 @@ class Point:
                 
                 offset_rate = 0.99 # 20230915 Huang
                 self._Tele.SetAZEL_off(-az_scan*offset_rate/np.cos(np.deg2rad(EL_init)),0.0)
-                GMtime = time.gmtime()
-                Fortime = str(GMtime.tm_year) + '-' + str(GMtime.tm_mon) + '-' + str(GMtime.tm_mday) + ' ' \
-                        + str(GMtime.tm_hour) + ':' + str(GMtime.tm_min+12) + ':' + str(GMtime.tm_sec)
-                _sc = self._Tele._Longitude + self._Tele._Latitude + [self._Tele._Height]
-                _AZ, _EL = self._Tele._CoorGeo.radec2azel(_srcradec, SC=_sc, MCOW=self._Tele.config['atmosphere'], \
-                        curtim=Fortime, backend=self._Tele.config['coord_converter'])
-                _dAZ, _dEL = self._Tele.PointingModel(self._Tele._PointingParameter, _AZ, _EL)
-                AZ = _AZ + _dAZ
-                EL = _EL + _dEL
-                if EL<8.2:
-                    return 'EL LIMIT'
             else:
                 return False
+        Fortime = time.time() + 12*60. # 12 minutes ahead, UNIX time
+        # site and weather from the observer context set up by Telescope; the
+        # conversion runs on this thread's own engine, outside the telescope lock
+        _AZ, _EL = self._Tele._CoorGeo.radec2azel(_srcradec, curtim=Fortime, \
+                backend=self._Tele.config.coord_converter)
+        _dAZ, _dEL = self._Tele.PointingModel(self._Tele._PointingParameter, _AZ, _EL)
+        applied = self._applied_model()
+        AZ = _AZ + _dAZ
+        EL = _EL + _dEL
+        if EL<8.2:
+            return 'EL LIMIT'
 
         logger.debug('sourcename={},_ra={},_dec={}'.format(sourcename,_ra,_dec))
         
@@ -208,7 +207,7 @@ class Point:
                     if self._Tele.Isready(0.015*3600/np.cos(np.deg2rad(el_current))):
                         sleep(0.12)
                         #with self._Tele._lock:
-                        strtime = Time.now()
+                        strtime = time.time()
                         az_src = self._Tele.AZ
                         el_src = self._Tele.EL
                         az_conv = self._Tele.AZ_conv
@@ -219,28 +218,20 @@ class Point:
                         break
                 sleep(0.001)
 
-            time_azel.append(strtime)
             az_dlt = az_current - az_src
             if az_dlt>10.:
                 az_dlt = az_dlt - 360.
             elif az_dlt<-10.:
                 az_dlt = az_dlt + 360.
             el_dlt = el_current - el_src
-            tmp = '%s\t%s\t%f\t%f\t%f\t%f\t%f' % (strtime,sourcename,az_src,el_src,az_current,el_current,powlev)
+            tmp = '%s\t%s\t%f\t%f\t%f\t%f\t%f' % (_iso(strtime),sourcename,az_src,el_src,az_current,el_current,powlev)
             _f.writelines(tmp)
             _f.writelines('\n')
 
-            vaz = np.append(vaz, az_current)
-            vel = np.append(vel, el_current)
-            azsrc = np.append(azsrc, az_src)
-            elsrc = np.append(elsrc, el_src)
-            azconv = np.append(azconv, az_conv)
-            elconv = np.append(elconv, el_conv)
-            vdaz = np.append(vdaz, az_dlt)
-            vdel = np.append(vdel, el_dlt)
-            vpowl = np.append(vpowl, powlev)
-            vdaz_fit = np.append(vdaz_fit, az_dlt)
-            vdaz_pow_fit = np.append(vdaz_pow_fit, powlev)
+            scan[n] = (strtime, az_current, el_current, az_src, el_src, az_conv, el_conv, az_dlt, el_dlt, powlev, 0.)
+            n += 1
+            vdaz, vdel, vpowl = scan['daz'][:n], scan['del'][:n], scan['powl'][:n]
+            vdaz_fit, vdaz_pow_fit = vdaz, vpowl
             
             fig1.cla()
             fig2.cla()
@@ -258,7 +249,8 @@ class Point:
             fig2.plot(vpowl)
             fig3.plot(vdaz_fit, vdaz_pow_fit)
             time_stop = time.time()
-            time_consume.append(time_stop-time_start)
+            scan['consume'][n-1] = time_stop - time_start
+            time_consume = scan['consume'][:n]
             fig5.plot(time_consume)
             #ZMQ
             guistage = 'AZ+' if num<len(scan_az)/2 else 'AZ-'
@@ -275,7 +267,7 @@ class Point:
         with self._Tele._lock:
             self._Tele.SetAZEL_off(0.0,el_scan)
         sleep(15)
-        time_consumeAZ=time_consume[:]
+        time_consumeAZ = scan['consume'][:n].copy()
         for el_delta in scan_el:
             time_start = time.time()
             num += 1
@@ -292,7 +284,7 @@ class Point:
                         return 'EL LIMIT'
                     if self._Tele.Isready(0.015*3600/np.cos(np.deg2rad(el_current))):
                         sleep(0.12)
-                        strtime = Time.now()
+                        strtime = time.time()
                         az_src = self._Tele.AZ
                         el_src = self._Tele.EL
                         az_conv = self._Tele.AZ_conv
@@ -303,24 +295,16 @@ class Point:
                         break
                 sleep(0.001)
 
-            time_azel.append(strtime)
             az_dlt = az_current - az_src
             el_dlt = el_current - el_src
-            tmp1 = '%s\t%s\t%f\t%f\t%f\t%f\t%f' % (strtime,sourcename,az_src,el_src,az_current,el_current,powlev)
+            tmp1 = '%s\t%s\t%f\t%f\t%f\t%f\t%f' % (_iso(strtime),sourcename,az_src,el_src,az_current,el_current,powlev)
             _f.writelines(tmp1)
             _f.writelines('\n')
 
-            vaz = np.append(vaz, az_current)
-            vel = np.append(vel, el_current)
-            azsrc = np.append(azsrc, az_src)
-            elsrc = np.append(elsrc, el_src)
-            azconv = np.append(azconv, az_conv)
-            elconv = np.append(elconv, el_conv)
-            vdaz = np.append(vdaz, az_dlt)
-            vdel = np.append(vdel, el_dlt)
-            vpowl = np.append(vpowl, powlev)
-            vdel_fit = np.append(vdel_fit, el_dlt)
-            vdel_pow_fit = np.append(vdel_pow_fit, powlev)
+            scan[n] = (strtime, az_current, el_current, az_src, el_src, az_conv, el_conv, az_dlt, el_dlt, powlev, 0.)
+            n += 1
+            vdaz, vdel, vpowl = scan['daz'][:n], scan['del'][:n], scan['powl'][:n]
+            vdel_fit, vdel_pow_fit = vdel[2*shape[0]:], vpowl[2*shape[0]:]
             
             fig1.cla()
             fig2.cla()
@@ -338,7 +322,8 @@ class Point:
             fig2.plot(vpowl)
             fig4.plot(vdel_fit, vdel_pow_fit)
             time_stop = time.time()
-            time_consume.append(time_stop-time_start)
+            scan['consume'][n-1] = time_stop - time_start
+            time_consume = scan['consume'][:n]
             fig6.plot(time_consume)
             #ZMQ
             guistage = 'EL-' if num<len(scan_el)/2 else 'EL+'
@@ -350,6 +335,8 @@ class Point:
 
         with self._Tele._lock:
             self._Tele.Status='IDLE'
+        time_azel = Time(scan['time'][:n], format='unix', precision=6)
+        time_azel.format = 'iso'
         sleep(5)
 
         vdaz_pow_fit = vdaz_pow_fit.astype('float64')
@@ -438,43 +425,43 @@ class Point:
                 else:
                     indx1 = np.argmin(np.abs(vdaz_fit1 - azopt1[0])) # 2020-0125 predcit location of source to location of source
                     time1 = time_azel[indx1]
-                    az_premdl1 = azconv[indx1]
-                    el_premdl1 = elconv[indx1]
+                    az_premdl1 = scan['az_conv'][indx1]
+                    el_premdl1 = scan['el_conv'][indx1]
                     scanaz1 = azopt1[0] # vdaz_fit1[indx1]
                     scanel1 = 0.0
-                    az_fit1 = vaz[indx1]
-                    el_fit1 = vel[indx1]
-                    powl1 = vpowl[indx1]
+                    az_fit1 = scan['az'][indx1]
+                    el_fit1 = scan['el'][indx1]
+                    powl1 = scan['powl'][indx1]
                     indx2 = np.argmin(np.abs(vdaz_fit2 - azopt2[0])) #
                     scanaz2 = azopt2[0] # vdaz_fit2[indx2]
                     indx2 += shape[0]
                     time2 = time_azel[indx2]
-                    az_premdl2 = azconv[indx2]
-                    el_premdl2 = elconv[indx2]
+                    az_premdl2 = scan['az_conv'][indx2]
+                    el_premdl2 = scan['el_conv'][indx2]
                     scanel2 = 0.0
-                    az_fit2 = vaz[indx2]
-                    el_fit2 = vel[indx2]
-                    powl2 = vpowl[indx2]
+                    az_fit2 = scan['az'][indx2]
+                    el_fit2 = scan['el'][indx2]
+                    powl2 = scan['powl'][indx2]
                     indx3 = np.argmin(np.abs(vdel_fit1 - elopt1[0]))
                     scanaz3 = 0.0
                     scanel3 = elopt1[0] # vdel_fit1[indx3]
                     indx3 += (2*shape[0])
                     time3 = time_azel[indx3]
-                    az_premdl3 = azconv[indx3]
-                    el_premdl3 = elconv[indx3]
-                    az_fit3 = vaz[indx3]
-                    el_fit3 = vel[indx3]
-                    powl3 = vpowl[indx3]
+                    az_premdl3 = scan['az_conv'][indx3]
+                    el_premdl3 = scan['el_conv'][indx3]
+                    az_fit3 = scan['az'][indx3]
+                    el_fit3 = scan['el'][indx3]
+                    powl3 = scan['powl'][indx3]
                     indx4 = np.argmin(np.abs(vdel_fit2 - elopt2[0]))
                     scanel4 = elopt2[0] #vdel_fit2[indx4]
                     indx4 += (2*shape[0] + shape[1])
                     time4 = time_azel[indx4]
-                    az_premdl4 = azconv[indx4]
-                    el_premdl4 = elconv[indx4]
+                    az_premdl4 = scan['az_conv'][indx4]
+                    el_premdl4 = scan['el_conv'][indx4]
                     scanaz4 = 0.0
-                    az_fit4 = vaz[indx4]
-                    el_fit4 = vel[indx4]
-                    powl4 = vpowl[indx4]
+                    az_fit4 = scan['az'][indx4]
+                    el_fit4 = scan['el'][indx4]
+                    powl4 = scan['powl'][indx4]
 
     	            # print meanaz,meanel,azopt,elopt,azopt.shape,elopt.shape
                     '''
@@ -510,10 +497,60 @@ class Point:
                     plt.savefig(pngname)
                     _f.close()
                     _fscan.close()
+                    if self.fitter is not None and self.fitter.follow(self._Cal, applied):
+                        self.publish_fit()
                     sleep(3)
                     plt.close('all')
                     return '1'
 
+    #--------------------Pointing model fit during the session--------------------
+    def _applied_model(self):
+        # the pointing model the track commands carry, None when they carry none
+        return self._Tele._PointingModels.model if self._Tele._ApplyPointing else None
+
+    def start_fit(self, sigma=10./3600.):
+        '''
+            fit the pointing model to the cal.dat archive and update it
+            recursively after each cross-scan, publishing each solution to
+            pointing_fit (Model fit puts it in use); p9..p11 are held at
+            the model in use, and the archive is taken as scanned with it.
+            With fewer records than twice the number of terms, start from
+            the model in use with an error of sigma (deg) per coefficient.
+            Not started while the basis of the terms is provisional
+        '''
+        model = self._Tele._PointingModels.model
+        if not pointingmodel.VERIFIED:
+            logger.warning('no pointing fit: the pointing model basis {} is provisional'.format(pointingmodel.BASIS))
+            return None
+        if not self._FitPar or os.path.abspath(self._FitPar)==os.path.abspath(self._Tele._PointingModels.filepath):
+            logger.error('no pointing fit: pointing_fit must name a file other than pointing_par')
+            return None
+        fixed = {k: model.coef[k] for k in pointingfit.FIXED}
+        cal = pointingfit.read_cal(self._Cal)[0] if os.path.exists(self._Cal) else []
+        if len(cal)>=2*len(pointingfit.TERMS):
+            solution = pointingfit.fit(*pointingfit.observations(cal, self._applied_model()), fixed=fixed)
+            self.fitter = pointingfit.RecursiveFit.from_solution(solution)
+            logger.info('pointing fit of {} records, rms {:.2f} arcsec'.format(len(cal), solution.rms))
+        else:
+            sigma = np.full(len(model.coef), float(sigma))
+            sigma[list(fixed)] = 0.
+            self.fitter = pointingfit.RecursiveFit.from_prior(model.coef, sigma)
+        if os.path.exists(self._Cal):
+            self.fitter.skip(self._Cal)
+        return self.fitter
+
+    def publish_fit(self):
+        '''
+            write the session fit as the next version of pointing_fit
+        '''
+        try:
+            version = self.fitter.publish(self._FitPar)
+        except (OSError, ValueError) as msg:
+            logger.error('pointing fit not written: {}'.format(msg))
+            return None
+        logger.info('pointing fit version {} written to {}'.format(version, self._FitPar))
+        return version
+
     #--------------------fitting scanned profile of source--------------------
     def fit(self,x,y,mean,sigma,amp,a,b,c,d,e,f,g,h,k,l):
         try:
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    pointing model fit: the 22-term model from the cross-scan records of
+    cal.dat by weighted least squares with outlier rejection, and recursive
+    updates of the solution as new cross-scans land
+    Date   : Oct. 18th 2026
+'''
+
+import logging
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from yn40mtcs.core.constants import LOGGER_NAME
+from yn40mtcs.func.pointingmodel import TERMS, design, read_header, require_basis, write_model
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+# one line of cal.dat as written by Point.cross_scan: scan is az+, az-, el-
+# or el+, var the variance of the fitted beam centre (deg^2) and width the
+# fitted beam width (deg)
+CAL_DTYPE = [('name', 'U32'), ('scan', 'U3'), ('time', 'f8'), ('powl', 'f8'),
+             ('az_premdl', 'f8'), ('el_premdl', 'f8'), ('scanaz', 'f8'), ('scanel', 'f8'),
+             ('az_fit', 'f8'), ('el_fit', 'f8'), ('var', 'f8'), ('width', 'f8')]
+
+# error assumed for a record without a usable variance, and the smallest
+# error given to any record (deg)
+SIGMA_DEFAULT = 10./3600.
+SIGMA_FLOOR = 1./3600.
+# outlier threshold in robust standard deviations
+CLIP = 3.
+# coefficients held at the model in use by the session fit (0-based, p9..p11
+# in the numbering of vpar.txt, which TERMS follows once its basis is verified)
+FIXED = (8, 9, 10)
+
+Solution = namedtuple('Solution', ['coef', 'cov', 'rms', 'scale', 'used', 'nobs'])
+
+def read_cal(filepath, offset=0):
+    '''
+    records of cal.dat from byte offset on, lines that are not complete
+    records are skipped
+    return: structured array of CAL_DTYPE and the offset after the last
+            complete line
+    '''
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    lines = [v.split('\t') for v in data[:end].decode('ascii', 'replace').splitlines()]
+    lines = [v for v in lines if len(v)==len(CAL_DTYPE)]
+    cal = np.zeros(len(lines), dtype=CAL_DTYPE)
+    if len(lines):
+        columns = list(zip(*lines))
+        cal['name'] = columns[0]
+        cal['scan'] = columns[1]
+        # astropy Time strings, 'YYYY-MM-DD hh:mm:ss.sss' in UTC
+        stamp = np.array([v.strip().replace(' ', 'T') for v in columns[2]], dtype='datetime64[us]')
+        cal['time'] = (stamp - np.datetime64('1970-01-01T00:00:00'))/np.timedelta64(1, 's')
+        for k, (key, dtype) in enumerate(CAL_DTYPE[3:], 3):
+            cal[key] = np.array(columns[k], dtype=float)
+    return cal, offset + end
+
+def observations(cal, applied=None):
+    '''
+    pointing offsets of cal.dat records: the az scans measure dAz and the el
+    scans dEl, the fitted beam centre (scanaz, scanel, from the commanded
+    position) plus the pointing model the commands carried
+    applied: PointingModel (or correct(az, el) -> dAz, dEl in deg) added to
+             the commands of the scans, None when they carried none
+    return: az, el (deg), axis (0 dAz, 1 dEl), offset and error (deg)
+    '''
+    axis = np.where(np.char.startswith(cal['scan'], 'el'), 1, 0)
+    value = np.where(axis==0, cal['scanaz'], cal['scanel'])
+    if applied is not None:
+        daz, dele = applied(cal['az_premdl'], cal['el_premdl'])
+        value = value + np.where(axis==0, daz, dele)
+    sigma = np.sqrt(np.where(cal['var']>0., cal['var'], SIGMA_DEFAULT**2))
+    return cal['az_premdl'], cal['el_premdl'], axis, value, np.maximum(sigma, SIGMA_FLOOR)
+
+def rows(az, el, axis, terms=TERMS):
+    '''
+    rows of the least squares problem: the basis functions of the terms on
+    the axis each observation measures
+    '''
+    X, mask = design(az, el, terms)
+    return X*mask[axis]
+
+def fit(az, el, axis, value, sigma, terms=TERMS, fixed=None, clip=CLIP, maxiter=10):
+    '''
+    weighted least squares of the model, iterated with outliers beyond clip
+    robust standard deviations (1.4826 median absolute deviation) of the
+    normalized residuals left out
+    fixed:  {index: value} of coefficients held (0-based, p9 is 8)
+    return: Solution; cov is scaled by the reduced chi-square (scale) and
+            zero for fixed terms, rms of the kept residuals (arcsec)
+    '''
+    n = len(terms)
+    fixed = fixed or {}
+    free = np.array([k for k in range(n) if k not in fixed], dtype=int)
+    H = rows(az, el, axis, terms)
+    y = np.asarray(value, dtype=float).copy()
+    for k, v in fixed.items():
+        y -= H[:, k]*v
+    w = 1./np.asarray(sigma, dtype=float)
+    A = H[:, free]*w[:, np.newaxis]
+    b = y*w
+    used = np.ones(len(y), dtype=bool)
+    for i in range(maxiter):
+        x = np.linalg.lstsq(A[used], b[used], rcond=None)[0]
+        r = b - A @ x
+        s = 1.4826*np.median(np.abs(r[used]))
+        keep = np.abs(r)<=clip*s if s>0. else used
+        if (keep==used).all():
+            break
+        used = keep
+    dof = max(used.sum() - len(free), 1)
+    scale = float((r[used]**2).sum()/dof)
+    coef = np.zeros(n)
+    coef[free] = x
+    for k, v in fixed.items():
+        coef[k] = v
+    cov = np.zeros((n, n))
+    cov[np.ix_(free, free)] = np.linalg.pinv(A[used].T @ A[used])*scale
+    rms = float(np.sqrt(np.mean((r[used]/w[used])**2))*3600.) if used.any() else np.nan
+    logger.info('pointing fit of {} observations, {} rejected, rms {:.2f} arcsec'.format(len(y), (~used).sum(), rms))
+    return Solution(coef, cov, rms, scale, used, len(y))
+
+def fit_cal(filepath, terms=TERMS, fixed=None, clip=CLIP, applied=None):
+    '''
+    fit of all records of a cal.dat file
+    '''
+    cal, offset = read_cal(filepath)
+    return fit(*observations(cal, applied), terms=terms, fixed=fixed, clip=clip)
+
+def write_par(filepath, coef, comment=''):
+    '''
+    coefficients as the next version of a fitted model file; a model file
+    without a basis header (the plain vpar.txt of pointing_par) is not
+    replaced by a fit, and nothing is written while the TERMS basis is
+    provisional
+    return: the version
+    '''
+    require_basis('fitted pointing model')
+    if os.path.exists(filepath) and not read_header(filepath)['basis']:
+        raise ValueError('{} is not a fitted pointing model file, write the fit to another file'.format(filepath))
+    return write_model(filepath, coef, comment=comment)
+
+class RecursiveFit(object):
+    '''
+    recursive least squares of the model coefficients
+
+    Each observation is a rank-one update of the solution and its
+    covariance, so a cross-scan improves the model during a session at a
+    cost independent of the archive size. Observations further than clip
+    standard deviations of their prediction are rejected; forget below 1
+    ages older observations out.
+    '''
+    def __init__(self, coef, cov, scale=1., terms=TERMS, clip=CLIP, forget=1.):
+        '''
+        coef, cov:  starting solution and its covariance, e.g. of fit(); a
+                    term with zero variance stays fixed
+        scale:      factor of the observation variances (reduced chi-square)
+        '''
+        self.coef = np.array(coef, dtype=float)
+        self.cov = np.array(cov, dtype=float)
+        self.scale = float(scale)
+        self.terms = terms
+        self.clip = float(clip)
+        self.forget = float(forget)
+        self.nobs = 0
+        self.rejected = 0
+        self._offsets = {}
+
+    @classmethod
+    def from_solution(cls, solution, **kwargs):
+        return cls(solution.coef, solution.cov, solution.scale, **kwargs)
+
+    @classmethod
+    def from_prior(cls, coef, sigma, **kwargs):
+        '''
+        starting from a model (e.g. vpar.txt) with an error per coefficient (deg)
+        '''
+        sigma = np.broadcast_to(np.asarray(sigma, dtype=float), np.shape(coef))
+        return cls(coef, np.diag(sigma**2), **kwargs)
+
+    def update(self, az, el, axis, value, sigma):
+        '''
+        observations as returned by observations()
+        return: number of observations taken
+        '''
+        H = rows(np.atleast_1d(az), np.atleast_1d(el), np.atleast_1d(axis), self.terms)
+        value = np.atleast_1d(value)
+        var = self.scale*np.atleast_1d(sigma)**2
+        taken = 0
+        for h, y, v in zip(H, value, var):
+            Ph = self.cov @ h
+            s = v + h @ Ph
+            innovation = y - h @ self.coef
+            if innovation*innovation>self.clip*self.clip*s:
+                self.rejected += 1
+                continue
+            gain = Ph/s
+            self.coef += gain*innovation
+            self.cov = (self.cov - np.outer(gain, Ph))/self.forget
+            taken += 1
+        self.nobs += taken
+        return taken
+
+    def update_cal(self, cal, applied=None):
+        '''
+        cal.dat records (CAL_DTYPE), applied as in observations()
+        '''
+        return self.update(*observations(cal, applied))
+
+    def follow(self, filepath, applied=None):
+        '''
+        take the records appended to a cal.dat file since the last call
+        return: number of observations taken
+        '''
+        cal, self._offsets[filepath] = read_cal(filepath, self._offsets.get(filepath, 0))
+        taken = self.update_cal(cal, applied) if len(cal) else 0
+        if len(cal):
+            logger.info('pointing model updated from {} records of {}, {} taken'.format(len(cal), filepath, taken))
+        return taken
+
+    def skip(self, filepath):
+        '''
+        start following a cal.dat file at its end
+        '''
+        with open(filepath, 'rb') as f:
+            self._offsets[filepath] = f.seek(0, 2)
+
+    def publish(self, filepath, comment=''):
+        '''
+        write the solution as the next version of a fitted model file
+        (write_par), which ModelStore puts in use when asked to
+        return: the version
+        '''
+        return write_par(filepath, self.coef, comment or 'recursive fit, {} observations taken, {} rejected'.format(
+                         self.nobs, self.rejected))
+
+    @property
+    def sigma(self):
+        return np.sqrt(np.maximum(np.diag(self.cov), 0.))
+
+if __name__=='__main__':
+    import sys
+    import tempfile
+    import time
+    from yn40mtcs.core.utils import data_path
+    from yn40mtcs.func.pointingmodel import PointingModel
+    if len(sys.argv)>1:
+        # python -m yn40mtcs.func.pointingfit cal.dat [vpar.fit.txt [model of the commands]]
+        # p9..p11 are held at the model of the commands when it is given
+        applied = PointingModel.load(sys.argv[3]) if len(sys.argv)>3 else None
+        solution = fit_cal(sys.argv[1], fixed=applied and {k: applied.coef[k] for k in FIXED}, applied=applied)
+        print('%d observations, %d rejected, rms %.2f arcsec' % (solution.nobs, (~solution.used).sum(), solution.rms))
+        for (name, axis, f), c, e in zip(TERMS, solution.coef, np.sqrt(np.diag(solution.cov))):
+            print('%-5s %13.6f +- %.6f' % (name, c, e))
+        if len(sys.argv)>2:
+            version = write_par(sys.argv[2], solution.coef, 'fit of {} ({} observations, rms {:.2f} arcsec)'.format(
+                                sys.argv[1], solution.used.sum(), solution.rms))
+            print('%s version %d' % (sys.argv[2], version))
+        sys.exit(0)
+    print('testing pointingfit.py')
+    # synthetic models in the TERMS basis
+    from yn40mtcs.func import pointingmodel
+    pointingmodel.VERIFIED = True
+
+    # a synthetic cal.dat archive: cross-scans of a known model, 3 arcsec
+    # noise and 5% bad scans, written the way cross_scan writes them; the
+    # fitted centres are the offsets from the model in the commands, if any
+    rng = np.random.default_rng(1)
+    truth = np.loadtxt(data_path('vpar.txt')) + rng.normal(0., 5e-3, len(TERMS))
+    model = PointingModel(truth)
+    def archive(n, t0, applied=None):
+        az = rng.uniform(0., 360., n)
+        el = rng.uniform(10., 85., n)
+        daz, dele = model.evaluate(az, el)
+        if applied is not None:
+            daz, dele = daz - applied(az, el)[0], dele - applied(az, el)[1]
+        noise = rng.normal(0., 3./3600., (4, n))
+        noise[:, rng.random(n)<0.05] += rng.normal(0., 120./3600., (4, 1))
+        lines = []
+        for i in range(n):
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t0 + 600.*i)) + '.000'
+            for k, scan in enumerate(['az+', 'az-', 'el-', 'el+']):
+                scanaz = (daz[i] + noise[k, i])*(k<2)
+                scanel = (dele[i] + noise[k, i])*(k>=2)
+                lines.append('%s\t%s\t%s\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%1.12f\t%f\n' % ('3C84', scan, stamp, -30.,
+                             az[i], el[i], scanaz, scanel, (az[i] + daz[i] + noise[k, i]*(k<2)) % 360.,
+                             el[i] + dele[i] + noise[k, i]*(k>=2), (3./3600.)**2, 0.05))
+        return ''.join(lines)
+    filepath = os.path.join(tempfile.mkdtemp(), 'cal.dat')
+    with open(filepath, 'w') as f:
+        f.write(archive(2000, 1694304000.))
+
+    start = time.perf_counter()
+    cal, offset = read_cal(filepath)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    solution = fit(*observations(cal))
+    print('read %d records: %.3f s, fit: %.3f s' % (len(cal), elapsed, time.perf_counter() - start))
+    print('rms %.2f arcsec, %d of %d rejected' % (solution.rms, (~solution.used).sum(), solution.nobs))
+    print('max |coef - truth| / sigma: %.2f' % (np.abs(solution.coef - truth)/np.sqrt(np.diag(solution.cov))).max())
+    grid = rng.uniform([0., 10.], [360., 85.], (10000, 2)).T
+    print('max model error over the sky (arcsec): %.2f' % (np.abs(np.stack(PointingModel(solution.coef).evaluate(*grid)) -
+          np.stack(model.evaluate(*grid))).max()*3600.))
+
+    # a session: start from the first half of the archive, then one
+    # cross-scan at a time as cross_scan appends them
+    half = len(cal)//2
+    recursive = RecursiveFit.from_solution(fit(*observations(cal[:half])))
+    recursive.skip(filepath)
+    start = time.perf_counter()
+    for i in range(half, len(cal), 4):
+        recursive.update_cal(cal[i:i+4])
+    elapsed = time.perf_counter() - start
+    print('recursive, %d cross-scans: %.1f us per cross-scan, %d rejected' % ((len(cal) - half)//4,
+          elapsed/((len(cal) - half)//4)*1e6, recursive.rejected))
+    print('max |recursive - batch| / sigma: %.2f' % (np.abs(recursive.coef - solution.coef)/np.sqrt(np.diag(solution.cov))).max())
+    with open(filepath, 'a') as f:
+        f.write(archive(10, 1694304000. + 86400.*30))
+    print('followed %d new observations' % recursive.follow(filepath))
+
+    fixed = {k: truth[k] for k in FIXED}
+    solution = fit(*observations(cal), fixed=fixed)
+    print('p9..p11 held: rms %.2f arcsec, sigma of p9 %.1e' % (solution.rms, np.sqrt(solution.cov[8, 8])))
+
+    # a session with vpar.txt in the commands: the fit starts from it with
+    # p9..p11 held, follows the new cross-scans and publishes each solution
+    # to a fitted model file that ModelStore loads
+    from yn40mtcs.func.pointingmodel import ModelStore
+    applied = PointingModel(np.loadtxt(data_path('vpar.txt')))
+    sigma = np.full(len(TERMS), 0.05)
+    sigma[list(FIXED)] = 0.
+    recursive = RecursiveFit.from_prior(applied.coef, sigma)
+    recursive.skip(filepath)
+    fitpar = os.path.join(os.path.dirname(filepath), 'vpar.fit.txt')
+    for i in range(3):
+        with open(filepath, 'a') as f:
+            f.write(archive(200, 1694304000. + 86400.*(31 + i), applied))
+        recursive.follow(filepath, applied)
+        version = recursive.publish(fitpar)
+    store = ModelStore(fitpar)
+    held = np.abs(store.coef[list(FIXED)] - applied.coef[list(FIXED)]).max()
+    free = [k for k in range(len(TERMS)) if k not in FIXED]
+    print('published version %d: %d observations, p9..p11 moved %.1e, max |coef - truth| of the rest %.1e deg' % (
+          store.version, recursive.nobs, held, np.abs(store.coef[free] - truth[free]).max()))
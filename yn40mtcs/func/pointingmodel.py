@@ -0,0 +1,506 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    22-term pointing model: corrections on arrays of az/el, an optional
+    dense correction grid with bilinear or bicubic lookup, and versioned
+    model files swapped in while tracking
+    Date   : Oct. 18th 2026
+'''
+
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from yn40mtcs.core.constants import LOGGER_NAME
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+# terms of the model in the order of the coefficients p1..p22 of vpar.txt:
+# (name, axis, basis function of A, E in rad); dAz and dEl (deg) are the sums
+# of the coefficients times their basis functions on axis 0 and 1
+# BASIS names this set of terms in the header of the model files written
+# here. It is provisional until the term definitions of vpar.txt are at
+# hand and VERIFIED is set: until then a plain coefficient file (no basis,
+# the ACU's vpar.txt) gives no corrections, and models, fitted files,
+# grids and residual maps in the TERMS basis are refused
+BASIS = 'provisional-1'
+VERIFIED = False
+TERMS = [
+    ('IA',   0, lambda A, E: np.ones_like(A)),     # p1  azimuth encoder offset
+    ('IE',   1, lambda A, E: np.ones_like(A)),     # p2  elevation encoder offset
+    ('NPAE', 0, lambda A, E: np.tan(E)),           # p3  non-perpendicularity of the axes
+    ('CA',   0, lambda A, E: 1./np.cos(E)),        # p4  collimation error
+    ('AN',   0, lambda A, E: np.sin(A)*np.tan(E)), # p5  azimuth axis tilt north-south
+    ('AW',   0, lambda A, E: -np.cos(A)*np.tan(E)),# p6  azimuth axis tilt east-west
+    ('ANE',  1, lambda A, E: np.cos(A)),           # p7  azimuth axis tilt north-south, elevation part
+    ('AWE',  1, lambda A, E: np.sin(A)),           # p8  azimuth axis tilt east-west, elevation part
+    ('TF',   1, lambda A, E: np.cos(E)),           # p9  tube flexure
+    ('TX',   1, lambda A, E: 1./np.tan(E)),        # p10 refraction residual
+    ('ECES', 1, lambda A, E: np.sin(E)),           # p11 elevation centring
+    ('ACA',  0, lambda A, E: np.cos(A)),           # p12 azimuth centring
+    ('ASA',  0, lambda A, E: np.sin(A)),           # p13
+    ('AC2A', 0, lambda A, E: np.cos(2*A)),         # p14 azimuth track ellipticity
+    ('AS2A', 0, lambda A, E: np.sin(2*A)),         # p15
+    ('EC2A', 1, lambda A, E: np.cos(2*A)),         # p16 elevation with azimuth, second harmonic
+    ('ES2A', 1, lambda A, E: np.sin(2*A)),         # p17
+    ('EC2E', 1, lambda A, E: np.cos(2*E)),         # p18 elevation second harmonic
+    ('AC3A', 0, lambda A, E: np.cos(3*A)),         # p19 azimuth track, third harmonic
+    ('AS3A', 0, lambda A, E: np.sin(3*A)),         # p20
+    ('EC3A', 1, lambda A, E: np.cos(3*A)),         # p21 elevation with azimuth, third harmonic
+    ('ES3A', 1, lambda A, E: np.sin(3*A)),         # p22
+]
+
+# elevation range of the correction grid (deg): below the lowest elevation
+# cross_scan accepts, up to where tan(E) and sec(E) steepen too fast for a
+# regular grid; outside of it the model is evaluated
+GRID_EL = (5., 85.)
+# largest interpolation error accepted when the grid is built (arcsec)
+GRID_TOL = 0.1
+
+def require_basis(what):
+    '''
+    raise ValueError for 'what' while the TERMS basis is not verified
+    '''
+    if not VERIFIED:
+        raise ValueError('{} needs the term definitions of vpar.txt, the TERMS basis {} is provisional'.format(
+                         what, BASIS))
+
+def design(az, el, terms=TERMS):
+    '''
+    az, el: deg, arrays of one shape
+    return: basis functions on the last axis and a 0/1 axis mask of the terms,
+            dAz = (X*mask[0]) @ p, dEl = (X*mask[1]) @ p
+    '''
+    A = np.deg2rad(np.asarray(az, dtype=float))
+    E = np.deg2rad(np.asarray(el, dtype=float))
+    X = np.stack([f(A, E) for name, axis, f in terms], axis=-1)
+    axes = np.array([axis for name, axis, f in terms])
+    return X, np.stack([axes==0, axes==1]).astype(float)
+
+def read_header(filepath):
+    '''
+    '# key: value' lines at the top of a model file as a dict, version 0,
+    the file time and no basis for a file without them (the plain vpar.txt)
+    '''
+    header = {'version': 0, 'created': os.path.getmtime(filepath), 'comment': '', 'basis': ''}
+    with open(filepath) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            key, sep, value = line[1:].partition(':')
+            if sep and key.strip() in header:
+                header[key.strip()] = value.strip()
+    header['version'] = int(header['version'])
+    header['created'] = float(header['created'])
+    return header
+
+def history_path(filepath, version):
+    '''
+    file of one version of a model next to the model file, vpar.3.txt of vpar.txt
+    '''
+    root, ext = os.path.splitext(filepath)
+    return '{}.{}{}'.format(root, version, ext)
+
+def write_model(filepath, coef, version=None, comment='', basis=BASIS):
+    '''
+    write coefficients with a version and basis header, the version counts
+    up from the model file that is replaced; the file is written next to
+    the old one and renamed over it, and kept as history_path(filepath, version)
+    return: the version
+    '''
+    if version is None:
+        version = read_header(filepath)['version'] + 1 if os.path.exists(filepath) else 1
+    head = 'version: {}\ncreated: {:.3f}\ncomment: {}\nbasis: {}'.format(version, time.time(), comment, basis)
+    np.savetxt(history_path(filepath, version), np.asarray(coef, dtype=float), header=head)
+    tmp = filepath + '.tmp'
+    np.savetxt(tmp, np.asarray(coef, dtype=float), header=head)
+    os.replace(tmp, filepath)
+    return version
+
+def _cubic_weights(f):
+    '''
+    Catmull-Rom weights of the samples -1, 0, 1, 2 around fraction f
+    '''
+    f2 = f*f
+    f3 = f2*f
+    return np.stack([0.5*(-f3 + 2*f2 - f), 0.5*(3*f3 - 5*f2 + 2), 0.5*(-3*f3 + 4*f2 + f), 0.5*(f3 - f2)], axis=-1)
+
+def interpolate(values, nel, x, y, method='bilinear'):
+    '''
+    values: node values of a regular grid of nel nodes in y, flattened, one
+            array per component
+    x, y:   positions in node units, at least one node from the edges for
+            'bilinear' and two for 'bicubic' (Catmull-Rom)
+    return: one array per component
+    '''
+    i = np.floor(x).astype(int)
+    j = np.floor(y).astype(int)
+    if method=='bilinear':
+        k = [0, 1]
+        wx = np.stack([1. - (x - i), x - i], axis=-1)
+        wy = np.stack([1. - (y - j), y - j], axis=-1)
+    else:
+        k = [-1, 0, 1, 2]
+        wx = _cubic_weights(x - i)
+        wy = _cubic_weights(y - j)
+    # weighted sum over the stencil
+    base = i*nel + j
+    found = [np.zeros(base.shape) for v in values]
+    for a, ka in enumerate(k):
+        for b, kb in enumerate(k):
+            node = base + (ka*nel + kb)
+            w = wx[..., a]*wy[..., b]
+            for d, v in zip(found, values):
+                d += w*v[node]
+    return found
+
+class PointingModel(object):
+    '''
+    pointing model of the coefficients p1..p22 (TERMS)
+
+    evaluate() is the analytic form on arrays; build_grid() tabulates it once
+    on a regular az/el grid so that correct() is an interpolation, checked
+    against the analytic form to stay within a stated error (grid_error).
+    A model without a basis (the ACU's vpar.txt) keeps its coefficients
+    and gives zero corrections; one in the TERMS basis is only evaluated
+    once that basis is verified.
+    '''
+    def __init__(self, coef, terms=TERMS, basis=BASIS):
+        coef = np.asarray(coef, dtype=float).ravel()
+        if len(coef)!=len(terms):
+            raise ValueError('pointing model of {} terms, {} coefficients given'.format(len(terms), len(coef)))
+        self.coef = coef
+        self.terms = terms
+        self.basis = basis
+        axes = np.array([axis for name, axis, f in terms])
+        # coefficients by axis: dAz, dEl = X @ C
+        self._C = np.stack([np.where(axes==0, coef, 0.), np.where(axes==1, coef, 0.)], axis=-1)
+        self.grid = None
+        self.method = None
+        self.grid_error = None
+        self.version = 0
+        self.created = None
+        self.filepath = None
+        self.residual = None
+        self._grid_args = None
+
+    @classmethod
+    def load(cls, filepath, residual=None, **kwargs):
+        '''
+        model of a coefficient file (vpar.txt); a file without a basis
+        gives zero corrections, a file in the TERMS basis is refused until
+        that basis is verified
+        residual:   residual map file (residualmap.ResidualMap.save), optional
+        kwargs:     optional grid arguments of build_grid
+        '''
+        header = read_header(filepath)
+        if header['basis'] and header['basis']!=BASIS:
+            raise ValueError('{} holds a pointing model of basis {}, the terms here are {}'.format(
+                             filepath, header['basis'], BASIS))
+        if header['basis']:
+            require_basis('pointing model {}'.format(filepath))
+        model = cls(np.loadtxt(filepath), basis=header['basis'])
+        model.version = header['version']
+        model.created = header['created']
+        model.filepath = filepath
+        if residual:
+            from yn40mtcs.func.residualmap import ResidualMap
+            model.set_residual(ResidualMap.load(residual))
+        if kwargs.get('method'):
+            model.build_grid(**kwargs)
+        return model
+
+    def set_residual(self, residual):
+        '''
+        add an empirical residual map (residualmap.ResidualMap, None removes
+        it) to the corrections; a grid is built again with it folded in. A
+        map of another model version is dropped: its residuals are taken
+        from that model and must be rebuilt against this one
+        return: True if the map is in use
+        '''
+        if residual is not None:
+            require_basis('residual map')
+        if residual is not None and residual.model_version!=self.version:
+            logger.error('residual map of pointing model version {} dropped for version {}, rebuild it '
+                         '(python -m yn40mtcs.func.residualmap)'.format(residual.model_version, self.version))
+            residual = None
+        self.residual = residual
+        if self.grid is not None:
+            self.build_grid(**self._grid_args)
+        return residual is not None
+
+    def evaluate(self, az, el):
+        '''
+        az, el: deg, scalars or arrays of one shape
+        return: dAz, dEl (deg) of the analytic form, zero without a basis
+        '''
+        if not self.basis:
+            zero = np.zeros(np.broadcast(np.asarray(az), np.asarray(el)).shape)
+            return zero, zero.copy()
+        require_basis('pointing model')
+        X, mask = design(az, el, self.terms)
+        d = X @ self._C
+        return d[..., 0], d[..., 1]
+
+    def exact(self, az, el):
+        '''
+        az, el: deg, arrays of one shape
+        return: dAz, dEl (deg) of the analytic form and the residual map
+        '''
+        daz, dele = self.evaluate(az, el)
+        if self.residual is not None:
+            raz, rel = self.residual.lookup(az, el)
+            daz = daz + raz
+            dele = dele + rel
+        return daz, dele
+
+    def build_grid(self, method='bicubic', step=0.25, el_range=GRID_EL, tol=GRID_TOL, max_cells=4000000):
+        '''
+        tabulate the model every step (deg), halving the step until the
+        interpolation stays within tol (arcsec) of the analytic form or the
+        grid would exceed max_cells
+        method: 'bilinear' or 'bicubic' (Catmull-Rom)
+        return: the interpolation error (arcsec)
+        '''
+        if method not in ('bilinear', 'bicubic'):
+            raise ValueError('unknown grid method {}'.format(method))
+        require_basis('pointing correction grid')
+        self._grid_args = {'method': method, 'step': step, 'el_range': el_range, 'tol': tol, 'max_cells': max_cells}
+        while True:
+            self._tabulate(method, step, el_range)
+            self.grid_error = self._grid_error()
+            if self.grid_error<=tol or 4*self.grid.shape[0]*self.grid.shape[1]>max_cells:
+                break
+            step *= 0.5
+        if self.grid_error>tol:
+            logger.warning('pointing grid error {:.3f} arcsec above {} arcsec at step {} deg'.format(self.grid_error, tol, step))
+        logger.info('pointing grid {} {} deg, {}x{}, error {:.4f} arcsec'.format(
+                    method, step, self.grid.shape[0], self.grid.shape[1], self.grid_error))
+        return self.grid_error
+
+    def _tabulate(self, method, step, el_range):
+        # one node of margin below and two above each range for the cubic stencil
+        self.method = method
+        self.step = float(step)
+        self.el_range = (float(el_range[0]), float(el_range[1]))
+        naz = int(np.ceil(360./step))
+        nel = int(np.ceil((el_range[1] - el_range[0])/step))
+        self._az0 = -step
+        self._el0 = el_range[0] - step
+        az = self._az0 + step*np.arange(naz + 4)
+        el = self._el0 + step*np.arange(nel + 4)
+        daz, dele = self.exact(*np.meshgrid(az, el, indexing='ij'))
+        self.grid = np.stack([daz, dele], axis=-1)
+        self._daz = daz.ravel()
+        self._del = dele.ravel()
+
+    def _grid_error(self):
+        # cell centres, where the interpolation is farthest from the nodes,
+        # and random points
+        step = self.step
+        lo, hi = self.el_range
+        az = np.arange(0., 360., step) + 0.5*step
+        el = np.arange(lo, hi, step) + 0.5*step
+        az, el = [v.ravel() for v in np.meshgrid(az, el[el<hi], indexing='ij')]
+        rng = np.random.default_rng(0)
+        az = np.concatenate([az, rng.uniform(0., 360., 100000)])
+        el = np.concatenate([el, rng.uniform(lo, hi, 100000)])
+        exact = np.stack(self.exact(az, el))
+        return float(np.abs(np.stack(self.lookup(az, el)) - exact).max()*3600.)
+
+    def lookup(self, az, el):
+        '''
+        az, el: deg, arrays of one shape, el inside the grid range
+        return: dAz, dEl (deg) interpolated on the grid
+        '''
+        x = (np.asarray(az, dtype=float) % 360. - self._az0)/self.step
+        y = (np.asarray(el, dtype=float) - self._el0)/self.step
+        daz, dele = interpolate([self._daz, self._del], self.grid.shape[1], x, y, self.method)
+        return daz, dele
+
+    def correct(self, az, el):
+        '''
+        az, el: deg, scalars or arrays of one shape
+        return: dAz, dEl (deg), from the grid where there is one and el is
+                inside it, the analytic form and the residual map
+                elsewhere; floats for scalars
+        '''
+        scalar = np.ndim(az)==0 and np.ndim(el)==0
+        az, el = np.broadcast_arrays(np.atleast_1d(np.asarray(az, dtype=float)), np.atleast_1d(np.asarray(el, dtype=float)))
+        if self.grid is None:
+            daz, dele = self.exact(az, el)
+        else:
+            inside = (el>=self.el_range[0]) & (el<=self.el_range[1])
+            if inside.all():
+                daz, dele = self.lookup(az, el)
+            else:
+                daz, dele = self.exact(az, el)
+                if inside.any():
+                    daz[inside], dele[inside] = self.lookup(az[inside], el[inside])
+        if scalar:
+            return float(daz[0]), float(dele[0])
+        return daz, dele
+
+    __call__ = correct
+
+class ModelStore(object):
+    '''
+    the pointing model in use, reloaded from its versioned file
+
+    A new model (and its grid) is built on the thread that reloads it and
+    the reference is replaced in one assignment, so the control loop, which
+    takes .model once per tick, switches models between two ticks without
+    waiting and tags each command with the version it used.
+    '''
+    def __init__(self, filepath, residual=None, **grid):
+        '''
+        filepath:  model file (vpar.txt)
+        residual:  residual map file, optional
+        grid:      arguments of PointingModel.build_grid, none for no grid
+        '''
+        self.filepath = filepath
+        self.residual = residual
+        self.grid = grid
+        self.model = PointingModel.load(filepath, residual, **grid)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    version = property(lambda self: self.model.version)
+    coef = property(lambda self: self.model.coef)
+
+    def reload(self, filepath=None):
+        '''
+        load the model file again, or another file; the residual map is
+        left out until it is rebuilt for the version loaded
+        return: True if a different model is in use
+        '''
+        filepath = filepath or self.filepath
+        with self._lock:
+            old = self.model
+            model = PointingModel.load(filepath, self.residual, **self.grid)
+            if model.version==old.version and np.array_equal(model.coef, old.coef) and \
+                    (model.residual and model.residual.created)==(old.residual and old.residual.created):
+                return False
+            self.model = model
+        logger.info('pointing model version {} from {} in use, was version {}'.format(model.version, filepath, old.version))
+        return True
+
+    def install(self, version):
+        '''
+        put one version of the history in use (it is not written to the model file)
+        '''
+        return self.reload(history_path(self.filepath, version))
+
+    def _mtime(self):
+        return [os.path.getmtime(v) for v in [self.filepath, self.residual] if v]
+
+    def _run(self, period):
+        mtime = self._mtime()
+        while not self._stop.wait(period):
+            try:
+                if self._mtime()==mtime:
+                    continue
+                mtime = self._mtime()
+                self.reload()
+            except Exception as msg:
+                logger.error('pointing model reload from {} failed: {}'.format(self.filepath, msg))
+
+    def watch(self, period=5.):
+        '''
+        reload whenever the modification time of the model file or the
+        residual map changes
+        '''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(period,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+if __name__=='__main__':
+    import shutil
+    import tempfile
+    from yn40mtcs.core.utils import data_path
+    logging.basicConfig(level=logging.INFO)
+    print('testing pointingmodel.py')
+    print('vpar.txt, no basis: dAz, dEl at az 180 el 45 (deg):', PointingModel.load(data_path('vpar.txt')).correct(180., 45.))
+    try:
+        PointingModel(np.loadtxt(data_path('vpar.txt'))).correct(180., 45.)
+    except ValueError as msg:
+        print('refused:', msg)
+    # the rest works on the vpar.txt coefficients taken in the TERMS basis
+    VERIFIED = True
+    model = PointingModel(np.loadtxt(data_path('vpar.txt')))
+    print('dAz, dEl at az 180 el 45 (deg):', model.correct(180., 45.))
+
+    # the analytic form point by point, the way PointingModel was called
+    rng = np.random.default_rng(1)
+    n = 100000
+    az = rng.uniform(0., 360., n)
+    el = rng.uniform(8.2, GRID_EL[1], n)
+    start = time.perf_counter()
+    for i in range(2000):
+        model.correct(az[i], el[i])
+    print('analytic, scalar calls: %.2f us per point' % ((time.perf_counter() - start)/2000*1e6))
+    start = time.perf_counter()
+    exact = np.stack(model.evaluate(az, el))
+    print('analytic, %d points: %.3f us per point' % (n, (time.perf_counter() - start)/n*1e6))
+
+    for method in ['bilinear', 'bicubic']:
+        for step in [0.5, 0.1]:
+            grid = PointingModel(model.coef)
+            tic = time.perf_counter()
+            grid.build_grid(method, step, tol=np.inf)
+            built = time.perf_counter() - tic
+            tic = time.perf_counter()
+            found = np.stack(grid.lookup(az, el))
+            elapsed = time.perf_counter() - tic
+            print('%s %.1f deg grid (%d nodes, built in %.2f s): %.3f us per point, stated error %.4f arcsec, '
+                  'max |lookup - analytic| %.4f arcsec' % (method, step, grid.grid.shape[0]*grid.grid.shape[1], built,
+                  elapsed/n*1e6, grid.grid_error, np.abs(found - exact).max()*3600.))
+
+    model.build_grid('bicubic')
+    print('bicubic grid to %.1f arcsec: step %g deg, error %.4f arcsec' % (GRID_TOL, model.step, model.grid_error))
+    el[:100] = rng.uniform(GRID_EL[1], 90., 100)
+    found = np.stack(model.correct(az, el))
+    print('correct() with points above the grid, max |correct - analytic| %.4f arcsec' % \
+          (np.abs(found - np.stack(model.evaluate(az, el))).max()*3600.))
+
+    # a control loop reading the store while new versions are written and
+    # picked up by the file watch
+    filepath = os.path.join(tempfile.mkdtemp(), 'vpar.txt')
+    shutil.copy(data_path('vpar.txt'), filepath)
+    store = ModelStore(filepath, method='bicubic')
+    store.watch(0.05)
+    ticks = []
+    def control(stop):
+        while not stop.is_set():
+            tic = time.perf_counter()
+            model = store.model
+            daz, dele = model.correct(az[:1000], el[:1000])
+            ticks.append((time.perf_counter() - tic, model.version, daz[0]))
+            time.sleep(0.002)
+    stop = threading.Event()
+    loop = threading.Thread(target=control, args=(stop,))
+    loop.start()
+    for i in range(3):
+        time.sleep(1.5)
+        write_model(filepath, store.coef + 1e-3, comment='test {}'.format(i))
+    time.sleep(1.5)
+    stop.set()
+    loop.join()
+    store.stop()
+    elapsed, versions, first = [np.array(v) for v in zip(*ticks)]
+    print('%d ticks, versions %s, median tick %.2f ms, longest %.2f ms, one model per version: %s' % (len(ticks),
+          sorted(set(versions.tolist())), np.median(elapsed)*1e3, elapsed.max()*1e3, all(len(set(first[versions==v]))==1 for v in set(versions))))
+    tic = time.perf_counter()
+    for i in range(1000):
+        store.model = store.model
+    print('swap: %.3f us, reload of version 2 from the history: %s' % ((time.perf_counter() - tic)/1000*1e6, store.install(2)))
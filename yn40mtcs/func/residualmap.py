@@ -0,0 +1,272 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    empirical residual map: cross-scan residuals of cal.dat from the
+    analytic pointing model, smoothed on the sphere and gridded for lookup
+    Date   : Oct. 18th 2026
+'''
+
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from yn40mtcs.core.constants import LOGGER_NAME
+from yn40mtcs.func.pointingfit import CLIP, observations
+from yn40mtcs.func.pointingmodel import interpolate, require_basis
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+# Gaussian kernel width and grid step (deg), nearest observations in a
+# kernel sum
+SCALE = 5.
+STEP = 1.
+NEIGHBOURS = 64
+# spread of the residuals where there are no observations (deg): the map
+# goes to zero where the kernel holds less weight than one such observation
+PRIOR = 10./3600.
+# dAz is smoothed as the cross-elevation offset and divided by cos(El),
+# taken no higher than this (deg)
+EL_TOP = 89.
+
+def unit(az, el):
+    '''
+    unit vectors of az, el (deg) on the last axis
+    '''
+    A = np.deg2rad(np.asarray(az, dtype=float))
+    E = np.deg2rad(np.asarray(el, dtype=float))
+    return np.stack([np.cos(E)*np.cos(A), np.cos(E)*np.sin(A), np.sin(E)], axis=-1)
+
+def residuals(cal, model, applied=None):
+    '''
+    residuals of cal.dat records (CAL_DTYPE) from a PointingModel (its
+    analytic form), dAz as cross-elevation offsets; applied is the model
+    in the commands of the scans (pointingfit.observations)
+    return: az, el (deg), axis (0 cross-elevation, 1 dEl), residual and error (deg)
+    '''
+    az, el, axis, value, sigma = observations(cal, applied)
+    daz, dele = model.evaluate(az, el)
+    cosel = np.cos(np.deg2rad(el))
+    r = np.where(axis==0, (value - daz)*cosel, value - dele)
+    sigma = np.where(axis==0, sigma*cosel, sigma)
+    return az, el, axis, r, sigma
+
+def smooth(tree, r, w, points, scale=SCALE, neighbours=NEIGHBOURS, prior=PRIOR):
+    '''
+    Gaussian kernel mean of the residuals r (weights w) of the observations
+    in tree (unit vectors) at points (unit vectors), shrunk to zero where the
+    kernel weight is small against 1/prior^2
+    '''
+    k = min(neighbours, tree.n)
+    if k==0:
+        return np.zeros(len(points))
+    radius = np.deg2rad(scale)
+    dist, idx = tree.query(points, k=list(range(1, k + 1)), distance_upper_bound=2.*np.sin(1.5*radius))
+    found = idx<tree.n
+    idx = np.where(found, idx, 0)
+    theta = 2.*np.arcsin(np.minimum(np.where(found, dist, 0.)/2., 1.))
+    weight = np.where(found, np.exp(-0.5*(theta/radius)**2), 0.)*w[idx]
+    return (weight*r[idx]).sum(axis=-1)/(weight.sum(axis=-1) + 1./prior**2)
+
+# observations of this process, set by _init_worker
+_data = None
+
+def _init_worker(data):
+    global _data
+    _data = [(cKDTree(points), r, w) for points, r, w in data]
+
+def _smooth_chunk(args):
+    points, scale, neighbours, prior = args
+    return [smooth(tree, r, w, points, scale, neighbours, prior) for tree, r, w in _data]
+
+class ResidualMap(object):
+    '''
+    residual map on a regular az/el grid
+
+    The kernel sums run once per grid node when the map is built, split
+    across a process pool; lookup() is a bicubic interpolation, and a
+    PointingModel with a correction grid folds the map into it, so the map
+    costs nothing per call there.
+    '''
+    def __init__(self, xel, dele, step, scale, nobs, model_version, created=None):
+        '''
+        xel, dele:  cross-elevation and elevation residuals (deg) on the nodes
+                    az = (i - 1)*step, el = (j - 1)*step
+        '''
+        self.xel = np.ascontiguousarray(xel, dtype=float)
+        self.dele = np.ascontiguousarray(dele, dtype=float)
+        self.step = float(step)
+        self.scale = float(scale)
+        self.nobs = int(nobs)
+        self.model_version = int(model_version)
+        self.created = time.time() if created is None else float(created)
+        self._xel = self.xel.ravel()
+        self._del = self.dele.ravel()
+
+    @classmethod
+    def build(cls, cal, model, scale=SCALE, step=STEP, neighbours=NEIGHBOURS, prior=PRIOR,
+              processes=0, chunksize=20000, clip=CLIP, applied=None):
+        '''
+        cal:        cal.dat records (CAL_DTYPE)
+        model:      PointingModel the residuals are taken from
+        applied:    PointingModel in the commands of the scans, if any
+        processes:  pool size, None for os.cpu_count(), 0 works in this process
+        clip:       observations further than clip robust standard deviations
+                    from the smoothed residuals at their position are left out
+        the residuals are taken from the TERMS basis, no map is built while
+        it is provisional
+        '''
+        require_basis('residual map')
+        az, el, axis, r, sigma = residuals(cal, model, applied)
+        points = unit(az, el)
+        data = []
+        for k in [0, 1]:
+            on = axis==k
+            p, v, w = points[on], r[on], 1./sigma[on]**2
+            if len(v):
+                d = v - smooth(cKDTree(p), v, w, p, scale, neighbours, prior)
+                s = 1.4826*np.median(np.abs(d))
+                if s>0.:
+                    keep = np.abs(d)<=clip*s
+                    p, v, w = p[keep], v[keep], w[keep]
+            data.append((p, v, w))
+        nobs = sum(len(v) for p, v, w in data)
+        # nodes one step beyond 0 and 360 deg in az and beyond the horizon
+        # and the zenith in el, which are points of the sphere as well
+        naz = int(np.ceil(360./step)) + 4
+        nel = int(np.ceil(90./step)) + 4
+        nodes = unit(*np.meshgrid(step*(np.arange(naz) - 1), step*(np.arange(nel) - 1), indexing='ij')).reshape(-1, 3)
+        tasks = [(nodes[a:a+chunksize], scale, neighbours, prior) for a in range(0, len(nodes), chunksize)]
+        processes = os.cpu_count() if processes is None else int(processes)
+        if processes==0:
+            _init_worker(data)
+            chunks = [_smooth_chunk(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(processes, _init_worker, (data,)) as pool:
+                chunks = pool.map(_smooth_chunk, tasks)
+        xel = np.concatenate([c[0] for c in chunks]).reshape(naz, nel)
+        dele = np.concatenate([c[1] for c in chunks]).reshape(naz, nel)
+        logger.info('residual map of {} of {} observations against pointing model version {}, {}x{} nodes'.format(
+                    nobs, len(r), model.version, naz, nel))
+        return cls(xel, dele, step, scale, nobs, model.version)
+
+    def lookup(self, az, el):
+        '''
+        az, el: deg, arrays of one shape
+        return: dAz, dEl (deg) of the map
+        '''
+        el = np.asarray(el, dtype=float)
+        x = np.asarray(az, dtype=float) % 360./self.step + 1.
+        y = np.clip(el, 0., 90.)/self.step + 1.
+        xel, dele = interpolate([self._xel, self._del], self.xel.shape[1], x, y, 'bicubic')
+        return xel/np.cos(np.deg2rad(np.minimum(el, EL_TOP))), dele
+
+    def save(self, filepath):
+        '''
+        write the map next to filepath and rename it over it
+        '''
+        tmp = filepath + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, xel=self.xel, dele=self.dele, step=self.step, scale=self.scale, nobs=self.nobs,
+                     model_version=self.model_version, created=self.created)
+        os.replace(tmp, filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(filepath) as f:
+            return cls(f['xel'], f['dele'], f['step'], f['scale'], f['nobs'], f['model_version'], f['created'])
+
+def rebuild(calfile, parfile, output, processes=None, **kwargs):
+    '''
+    residual map of all records of a cal.dat file against a model file,
+    built on a process pool and written to output
+    '''
+    from yn40mtcs.func.pointingfit import read_cal
+    from yn40mtcs.func.pointingmodel import PointingModel
+    cal, offset = read_cal(calfile)
+    rmap = ResidualMap.build(cal, PointingModel.load(parfile), processes=processes, **kwargs)
+    rmap.save(output)
+    return rmap
+
+if __name__=='__main__':
+    import sys
+    from yn40mtcs.core.utils import data_path
+    from yn40mtcs.func.pointingfit import CAL_DTYPE, fit
+    from yn40mtcs.func.pointingmodel import PointingModel
+    if len(sys.argv)>3:
+        # python -m yn40mtcs.func.residualmap cal.dat vpar.txt residual.npz [processes]
+        tic = time.perf_counter()
+        rmap = rebuild(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv)>4 else None)
+        print('%s: %d observations, model version %d, %.2f s' % (sys.argv[3], rmap.nobs, rmap.model_version,
+              time.perf_counter() - tic))
+        sys.exit(0)
+    print('testing residualmap.py')
+    # synthetic models in the TERMS basis
+    from yn40mtcs.func import pointingmodel
+    pointingmodel.VERIFIED = True
+
+    # cross-scans of a known model with a local deformation the 22 terms
+    # cannot follow: 30 arcsec in El and cross-El around az 120, el 40
+    rng = np.random.default_rng(1)
+    truth = PointingModel(np.loadtxt(data_path('vpar.txt')))
+    def bump(az, el):
+        theta = np.rad2deg(np.arccos(np.clip(unit(az, el) @ unit(120., 40.), -1., 1.)))
+        b = 30./3600.*np.exp(-0.5*(theta/8.)**2)
+        return b/np.cos(np.deg2rad(el)), b
+    def archive(n):
+        cal = np.zeros(4*n, dtype=CAL_DTYPE)
+        cal['scan'] = np.tile(['az+', 'az-', 'el-', 'el+'], n)
+        cal['az_premdl'] = np.repeat(rng.uniform(0., 360., n), 4)
+        cal['el_premdl'] = np.repeat(rng.uniform(10., 85., n), 4)
+        daz, dele = truth.evaluate(cal['az_premdl'], cal['el_premdl'])
+        baz, bel = bump(cal['az_premdl'], cal['el_premdl'])
+        noise = rng.normal(0., 3./3600., len(cal))
+        cal['scanaz'] = daz + baz + noise/np.cos(np.deg2rad(cal['el_premdl']))
+        cal['scanel'] = dele + bel + noise
+        cal['az_fit'] = cal['az_premdl'] + cal['scanaz']
+        cal['el_fit'] = cal['el_premdl'] + cal['scanel']
+        cal['var'] = (3./3600.)**2
+        return cal
+    cal = archive(3000)
+    model = PointingModel(fit(*observations(cal)).coef)
+    for processes in sorted(set([0, 1, 2, os.cpu_count()])):
+        tic = time.perf_counter()
+        rmap = ResidualMap.build(cal, model, processes=processes)
+        print('%d observations, %d workers: built in %.2f s' % (rmap.nobs, processes, time.perf_counter() - tic))
+
+    # independent cross-scans: residuals of the model alone and with the map
+    test = archive(1000)
+    az, el, axis, value, sigma = observations(test)
+    plain = np.stack(model.evaluate(az, el))
+    model.set_residual(rmap)
+    mapped = np.stack(model.exact(az, el))
+    def rms(d, on):
+        r = np.where(axis==0, (value - d[0])*np.cos(np.deg2rad(el)), value - d[1])
+        return np.sqrt(np.mean(r[on]**2))*3600.
+    near = unit(az, el) @ unit(120., 40.)>np.cos(np.deg2rad(8.))
+    for label, on in [('all', np.ones(len(az), dtype=bool)), ('within 8 deg of the deformation', near)]:
+        print('residual rms of new cross-scans, %s: %.2f arcsec by the model, %.2f with the map (noise 3.00)' % (
+              label, rms(plain, on), rms(mapped, on)))
+
+    # cost per point of correct(): analytic with and without the map, and
+    # the correction grid with the map folded in
+    az = rng.uniform(0., 360., 100000)
+    el = rng.uniform(8.2, 85., 100000)
+    for label, residual, grid in [('analytic', None, False), ('analytic + map', rmap, False), ('grid + map', rmap, True)]:
+        m = PointingModel(model.coef)
+        m.set_residual(residual)
+        if grid:
+            m.build_grid('bicubic')
+        tic = time.perf_counter()
+        m.correct(az, el)
+        print('%-15s %.3f us per point' % (label, (time.perf_counter() - tic)/len(az)*1e6))
+    print('grid error with the map: %.4f arcsec' % m.grid_error)
+
+    import tempfile
+    filepath = os.path.join(tempfile.mkdtemp(), 'residual.npz')
+    rmap.save(filepath)
+    again = ResidualMap.load(filepath)
+    print('saved and loaded: %s' % np.array_equal(again.lookup(az, el), rmap.lookup(az, el)))
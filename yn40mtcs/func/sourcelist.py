@@ -4,6 +4,7 @@
 Author : Huang Yuxiang, Li Kejia, Dai Wei, Wei Shoulin
 Date   : Aug. 24th 2019
          Sep. 10th 2023
+         Oct. 18th 2026  structured numeric catalogue, name index
 '''
 
 import numpy as np
@@ -14,6 +15,39 @@ from yn40mtcs.core.utils import data_path
 from yn40mtcs.core.constants import LOGGER_NAME
 
 logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+# catalogue columns of each list: name, RA, Dec, epoch and the optional
+# duration, scan number and VLBI times
+LAYOUTS = {'0': {'name': 0, 'ra': 1, 'dec': 2, 'epoch': 3},
+           '1': {'name': 0, 'ra': 1, 'dec': 2, 'epoch': 3, 'duration': 4},
+           '2': {'name': 2, 'ra': 3, 'dec': 4, 'epoch': 5, 'duration': 9, 'scan_num': 0,
+                 'preob_time': 6, 'record_time': 7, 'valid_time': 8}}
+
+def sexagesimal(values, scale=1.):
+    '''
+    'dd:mm:ss.s' strings -> float array of dd + mm/60 + ss/3600 times scale,
+    the sign of the first field applies to the whole value ('-00:30:00')
+    '''
+    values = np.char.strip(np.asarray(values, dtype='U'))
+    fields = np.array([v.split(':') for v in values], dtype=float).reshape(len(values), 3)
+    mag = np.abs(fields[:, 0]) + fields[:, 1]/60. + fields[:, 2]/3600.
+    return np.where(np.char.startswith(values, '-'), -mag, mag)*scale
+
+def radec2rad(ra, dec):
+    '''
+    'hh:mm:ss.s', '+dd:mm:ss.s' strings (or arrays of them) -> RA, Dec in radians
+    '''
+    return np.deg2rad(sexagesimal(np.atleast_1d(ra), 15.)), np.deg2rad(sexagesimal(np.atleast_1d(dec)))
+
+def vlbi_time(values):
+    '''
+    'yyyy.ddd.hh:mm:ss' (year, day of year) -> datetime64[s]
+    '''
+    fields = np.array([v.replace(':', '.').split('.') for v in values], dtype=int).reshape(len(values), 5)
+    year = (fields[:, 0] - 1970).astype('datetime64[Y]')
+    return year.astype('datetime64[D]') + (fields[:, 1] - 1) \
+            + (fields[:, 2]*3600 + fields[:, 3]*60 + fields[:, 4]).astype('timedelta64[s]')
+
 class SourceList:
     '''
     get the catalogue entry of sourcelist
@@ -38,10 +72,49 @@ class SourceList:
         #
         #self.Catalog = np.loadtxt(self.filename, dtype='str', comments='#', delimiter='\t')
         self.catalog = np.loadtxt(self.filename, dtype='str', comments='#',ndmin=2)
+        self.sources = self._parse(self.catalog, LAYOUTS.get(filenum, LAYOUTS['0']))
+        # case-folded name -> first row
+        self._index = {}
+        for idx, name in enumerate(self.sources['name']):
+            self._index.setdefault(name.casefold(), idx)
+    #
+    @staticmethod
+    def _parse(catalog, layout):
+        '''
+        string catalogue -> structured array, RA/Dec in radians
+        '''
+        dtype = [('name', 'U32'), ('ra', 'f8'), ('dec', 'f8'), ('epoch', 'f8')]
+        if 'duration' in layout:
+            dtype.append(('duration', 'f8'))
+        if 'scan_num' in layout:
+            dtype += [('scan_num', 'i4'), ('preob_time', 'M8[s]'), ('record_time', 'M8[s]'), ('valid_time', 'M8[s]')]
+        sources = np.zeros(len(catalog), dtype=dtype)
+        sources['name'] = catalog[:, layout['name']]
+        sources['ra'], sources['dec'] = radec2rad(catalog[:, layout['ra']], catalog[:, layout['dec']])
+        # 'J2000' or '2000.0'
+        sources['epoch'] = np.char.lstrip(catalog[:, layout['epoch']], 'JB').astype(float)
+        if 'duration' in layout:
+            sources['duration'] = catalog[:, layout['duration']].astype(float)
+        if 'scan_num' in layout:
+            sources['scan_num'] = catalog[:, layout['scan_num']].astype(int)
+            for key in ['preob_time', 'record_time', 'valid_time']:
+                sources[key] = vlbi_time(catalog[:, layout[key]])
+        return sources
+    #
+    def find(self, name):
+        '''
+        row of the source name (case-insensitive), None if absent
+        '''
+        return self._index.get(str(name).casefold())
+    #
+    def get_radec_rad(self, idx):
+        '''
+        RA, Dec in radians of row idx, as taken by CoordGeometry.radec2azel
+        '''
+        return float(self.sources['ra'][idx]), float(self.sources['dec'][idx])
     #
     def number_src(self):
-        row, _ = self.catalog.shape
-        return row
+        return len(self.catalog)
     #
     def get_radec(self, idx, col1=1, col2=2):
         row = self.number_src()
@@ -87,3 +160,10 @@ class SourceList:
         row = self.number_src()
         if (idx>=0) and (idx<row):
             return self.catalog[idx, col9] #
+
+if __name__=='__main__':
+    for filenum in ['0', '1', '2']:
+        srclst = SourceList(filenum=filenum)
+        print(srclst.filename, srclst.number_src(), srclst.sources.dtype.names)
+        print(srclst.sources[:2])
+    print(srclst.find('nrao150'), srclst.find('unknown'))
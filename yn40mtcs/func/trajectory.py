@@ -0,0 +1,244 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    trajectory engine: full reductions at sparse knots, Chebyshev segments
+    evaluated at control rate
+    Date   : Oct. 18th 2026
+'''
+
+import bisect
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from numpy.polynomial import chebyshev
+
+from yn40mtcs.core.constants import LOGGER_NAME
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+Segment = namedtuple('Segment', ['t0', 't1', 'caz', 'cel', 'err'])
+
+def finite_rates(position, t, h=0.5):
+    '''
+    position: position(t) -> Az, El (deg) for an array of UNIX times, the
+              arrays may have further source axes after the time axis
+    t:        UNIX times
+    h:        difference step (s)
+    return:   Az, El (deg), their rates (deg/s) and accelerations (deg/s^2)
+              by central differences, arrays over t
+    '''
+    t = np.atleast_1d(np.asarray(t, dtype=float))
+    az, el = position(np.concatenate((t - h, t, t + h)))
+    az = np.asarray(az).reshape((3, len(t)) + np.shape(az)[1:])
+    el = np.asarray(el).reshape((3, len(t)) + np.shape(el)[1:])
+    dplus = (az[2] - az[1] + 180.) % 360. - 180.
+    dminus = (az[1] - az[0] + 180.) % 360. - 180.
+    return (az[1], el[1], (dplus + dminus)/(2.*h), (el[2] - el[0])/(2.*h),
+            (dplus - dminus)/(h*h), (el[2] - 2.*el[1] + el[0])/(h*h))
+
+class Trajectory(object):
+    '''
+    Az/El track of one source as a list of Chebyshev segments
+
+    reduce(t) gives the full reduction (Az, El in degrees) for an array of
+    UNIX times. Each segment interpolates reduce() at Chebyshev knots and is
+    checked against it half way between the knots; a segment that misses
+    the tolerance is split until it holds. invalidate() refits the segments
+    ahead of a time after the inputs of reduce() changed.
+    '''
+    def __init__(self, reduce, span=120., nknot=8, tol=0.1, lead=600., minspan=2.):
+        '''
+        span:    segment length (s), the knots are span/nknot apart on average
+        tol:     error bound against the full reduction (arcsec on the sky)
+        lead:    how far ahead of now the background thread keeps segments (s)
+        '''
+        self.reduce = reduce
+        self.span = float(span)
+        self.nknot = int(nknot)
+        self.tol = float(tol)
+        self.lead = float(lead)
+        self.minspan = float(minspan)
+        self._segments = []
+        self._starts = []
+        # extend() and invalidate() replace the segments one at a time
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+        k = np.arange(self.nknot)
+        self._xknot = -np.cos(np.pi*(k + 0.5)/self.nknot)
+        self._xcheck = np.concatenate(([-1.], (self._xknot[1:] + self._xknot[:-1])/2., [1.]))
+
+    def _fit(self, t0, t1):
+        '''
+        Chebyshev segment(s) covering [t0, t1]
+        '''
+        half = (t1 - t0)/2.
+        x = np.concatenate((self._xknot, self._xcheck))
+        az, el = self.reduce(t0 + half*(x + 1.))
+        az = np.ravel(az)
+        el = np.ravel(el)
+        order = np.argsort(x)
+        az[order] = np.rad2deg(np.unwrap(np.deg2rad(az[order])))
+        n = self.nknot
+        caz = chebyshev.chebfit(x[:n], az[:n], n - 1)
+        cel = chebyshev.chebfit(x[:n], el[:n], n - 1)
+        daz = chebyshev.chebval(x[n:], caz) - az[n:]
+        dele = chebyshev.chebval(x[n:], cel) - el[n:]
+        err = np.sqrt((daz*np.cos(np.deg2rad(el[n:])))**2 + dele**2).max()*3600.
+        if err>self.tol and (t1 - t0)>self.minspan:
+            return self._fit(t0, t0 + half) + self._fit(t0 + half, t1)
+        if err>self.tol:
+            logger.warning('trajectory segment {}-{} misses tolerance: {:.3f} arcsec'.format(t0, t1, err))
+        return [Segment(t0, t1, caz, cel, err)]
+
+    def extend(self, until, start=None):
+        '''
+        append segments until UNIX time 'until', dropping those already passed
+        '''
+        while True:
+            # one span at a time, so that invalidate() does not wait long
+            with self._lock:
+                segments = list(self._segments)
+                if segments:
+                    t0 = segments[-1].t1
+                else:
+                    t0 = time.time() if start is None else float(start)
+                if t0<until:
+                    segments += self._fit(t0, t0 + self.span)
+                now = time.time()
+                while len(segments)>1 and segments[0].t1<now - self.span:
+                    segments.pop(0)
+                # replace both lists at once, readers never see a half-built list
+                self._segments, self._starts = segments, [s.t0 for s in segments]
+            if t0>=until:
+                return
+
+    def invalidate(self, t=None):
+        '''
+        drop the segments that end after UNIX time t (default now) and fit
+        one span from there, so that t stays covered; the background thread
+        extends the rest
+        '''
+        t = time.time() if t is None else float(t)
+        with self._lock:
+            segments = [s for s in self._segments if s.t1<=t]
+            t0 = segments[-1].t1 if segments else t
+            segments += self._fit(t0, max(t0 + self.span, t + self.minspan))
+            self._segments, self._starts = segments, [s.t0 for s in segments]
+        self._wake.set()
+
+    def covers(self, t):
+        segments = self._segments
+        return len(segments)>0 and segments[0].t0<=t<=segments[-1].t1
+
+    def evaluate(self, t=None):
+        '''
+        Az, El (deg) at UNIX time t, default now
+        falls back to the full reduction outside the precomputed segments
+        '''
+        if t is None:
+            t = time.time()
+        segments, starts = self._segments, self._starts
+        i = bisect.bisect_right(starts, t) - 1
+        if i<0 or t>segments[i].t1:
+            logger.warning('trajectory does not cover {}, using full reduction'.format(t))
+            az, el = self.reduce(np.array([t]))
+            return float(np.ravel(az)[0]), float(np.ravel(el)[0])
+        s = segments[i]
+        x = 2.*(t - s.t0)/(s.t1 - s.t0) - 1.
+        return chebyshev.chebval(x, s.caz) % 360., chebyshev.chebval(x, s.cel)
+
+    def evaluate_rates(self, t=None):
+        '''
+        Az, El (deg), rates (deg/s) and accelerations (deg/s^2) at UNIX times
+        t (default now), arrays over t, from the derivatives of the segments;
+        central differences of the full reduction outside them
+        '''
+        if t is None:
+            t = time.time()
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        segments, starts = self._segments, self._starts
+        i = np.searchsorted(starts, t, side='right') - 1
+        out = np.empty((6, len(t)))
+        inside = (i>=0) & (t<=np.array([s.t1 for s in segments])[np.clip(i, 0, len(segments) - 1)]) \
+                if segments else np.zeros(len(t), dtype=bool)
+        for k in np.unique(i[inside]):
+            s = segments[k]
+            m = inside & (i==k)
+            scale = 2./(s.t1 - s.t0)
+            x = scale*(t[m] - s.t0) - 1.
+            for j, c in enumerate([s.caz, s.cel]):
+                dc = chebyshev.chebder(c)
+                out[j, m] = chebyshev.chebval(x, c)
+                out[j + 2, m] = chebyshev.chebval(x, dc)*scale
+                out[j + 4, m] = chebyshev.chebval(x, chebyshev.chebder(dc))*scale*scale
+        out[0, inside] %= 360.
+        if not np.all(inside):
+            logger.warning('trajectory does not cover {} epochs, using full reduction'.format((~inside).sum()))
+            out[:, ~inside] = [np.ravel(v) for v in finite_rates(self.reduce, t[~inside])]
+        return tuple(out)
+
+    def _run(self, period):
+        while not self._stop.is_set():
+            try:
+                self.extend(time.time() + self.lead)
+            except Exception as msg:
+                logger.error('trajectory extension failed: {}'.format(msg))
+            self._wake.wait(period)
+            self._wake.clear()
+
+    def start(self, period=10., first=None):
+        '''
+        precompute the first segments, 'first' seconds of them (default
+        lead), then keep extending them to lead in the background
+        '''
+        self.extend(time.time() + (self.lead if first is None else float(first)))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(period,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+if __name__=='__main__':
+    import sys
+    from yn40mtcs.func.conv_coord import CoordGeometry
+    print('testing trajectory.py')
+    backend = sys.argv[1] if len(sys.argv)>1 else 'CONTEXT'
+    coodgeo = CoordGeometry()
+    ra, dec = np.deg2rad(83.633), np.deg2rad(22.0145)
+    def reduce(t):
+        return coodgeo.radec2azel_batch(ra, dec, t, backend=backend)
+    traj = Trajectory(reduce)
+    t0 = time.time()
+    start = time.perf_counter()
+    traj.extend(t0 + 3600., start=t0)
+    print('%d segments for one hour in %.3f s' % (len(traj._segments), time.perf_counter() - start))
+    t = t0 + np.sort(np.random.uniform(0, 3600., 500))
+    start = time.perf_counter()
+    track = np.array([traj.evaluate(v) for v in t])
+    print('evaluate %.1f us per call' % ((time.perf_counter() - start)/len(t)*1e6))
+    az, el = reduce(t)
+    az, el = np.ravel(az), np.ravel(el)
+    daz = (track[:, 0] - az + 180.) % 360. - 180.
+    print('max error against full reduction (arcsec):',
+          np.sqrt((daz*np.cos(np.deg2rad(el)))**2 + (track[:, 1] - el)**2).max()*3600.)
+    # rates and accelerations of the segments against differences of the full reduction
+    t = t0 + np.sort(np.random.uniform(10., 3590., 200))
+    start = time.perf_counter()
+    rates = traj.evaluate_rates(t)
+    print('evaluate_rates %.1f us per epoch' % ((time.perf_counter() - start)/len(t)*1e6))
+    ref = [np.ravel(v) for v in finite_rates(reduce, t, 2.)]
+    print('max |rate - central difference| (arcsec/s): Az %.2e El %.2e' % \
+          (np.abs(rates[2] - ref[2]).max()*3600., np.abs(rates[3] - ref[3]).max()*3600.))
+    print('max |acceleration - central difference| (arcsec/s^2): Az %.2e El %.2e' % \
+          (np.abs(rates[4] - ref[4]).max()*3600., np.abs(rates[5] - ref[5]).max()*3600.))
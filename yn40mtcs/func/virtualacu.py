@@ -22,6 +22,9 @@ class VirtualTel(object):
         Virtual antenna interface module
         communication mode: sockets, TCP/IP protocl
     '''
+    # the track_on frame carries positions only, no rates
+    feed_forward = False
+
     def __init__(self, cfg_fil):
         self._AZ=0.0
         self._EL=0.0
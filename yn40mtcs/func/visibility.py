@@ -0,0 +1,266 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    visibility planner: rise, set, transit and maximum elevation of whole
+    catalogues over a night, sources split across a process pool
+    Date   : Oct. 18th 2026
+'''
+
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from yn40mtcs.core.constants import LOGGER_NAME
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+# lowest elevation cross_scan accepts (deg)
+EL_LIMIT = 8.2
+
+VISIBILITY_DTYPE = [('name', 'U32'), ('ra', 'f8'), ('dec', 'f8'),
+                    ('rise', 'f8'), ('set', 'f8'), ('transit', 'f8'),
+                    ('max_el', 'f8'), ('above', 'f8')]
+
+# bisection steps of the limit crossings and golden section steps of the
+# transit: a 600 s grid step is refined to below 1 ms
+BISECTIONS = 20
+GOLDEN = 32
+
+# CoordGeometry of this process, built on first use
+_geometry = None
+_geometry_args = {}
+
+def _init_worker(geometry_args):
+    global _geometry, _geometry_args
+    _geometry = None
+    _geometry_args = geometry_args
+
+def _get_geometry():
+    global _geometry
+    if _geometry is None:
+        from yn40mtcs.func.conv_coord import CoordGeometry
+        _geometry = CoordGeometry(**_geometry_args)
+    return _geometry
+
+def _bisect(f, lo, hi, rising, n=BISECTIONS):
+    '''
+    vectorized bisection of f = 0 in [lo, hi], f rising or falling through zero
+    '''
+    for i in range(n):
+        mid = 0.5*(lo + hi)
+        upper = (f(mid)>=0.)==rising
+        hi = np.where(upper, mid, hi)
+        lo = np.where(upper, lo, mid)
+    return 0.5*(lo + hi)
+
+def _golden(f, a, b, n=GOLDEN):
+    '''
+    vectorized golden section search of the maximum of f in [a, b]
+    return: abscissa and value of the maximum
+    '''
+    g = 0.5*(np.sqrt(5.) - 1.)
+    c = b - g*(b - a)
+    d = a + g*(b - a)
+    fc, fd = f(c), f(d)
+    for i in range(n):
+        left = fc>fd
+        a = np.where(left, a, c)
+        b = np.where(left, d, b)
+        x = np.where(left, b - g*(b - a), a + g*(b - a))
+        fx = f(x)
+        c, d = np.where(left, x, d), np.where(left, c, x)
+        fc, fd = np.where(left, fx, fd), np.where(left, fc, fx)
+    left = fc>fd
+    return np.where(left, c, d), np.where(left, fc, fd)
+
+def visibility(ra, dec, start, end, step=600., limit=EL_LIMIT, SC=None, MCOW=None, coodgeo=None):
+    '''
+    ra, dec:    ICRS coordinates of the sources (rad), 1-D arrays
+    start, end: UNIX times of the window (s)
+    step:       coarse grid step (s)
+    limit:      elevation limit (deg)
+    coodgeo:    CoordGeometry, default is the one of this process
+    return:     structured array of VISIBILITY_DTYPE, names left empty
+
+    The elevations on the grid come from the batch reduction. Limit
+    crossings and the transit are refined against one astrometry context at
+    the middle of the window, whose slow terms (aberration, precession-
+    nutation) change by less than 0.1 arcsec over a night. Excursions above
+    the limit shorter than the grid step may be missed.
+    '''
+    from yn40mtcs.func.conv_coord import utc_jd
+    if coodgeo is None:
+        coodgeo = _get_geometry()
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    t = np.linspace(start, end, max(int(np.ceil((end - start)/step)), 1) + 1)
+    step = t[1] - t[0]
+    Az, El = coodgeo.radec2azel_batch(ra, dec, t, SC, MCOW, backend='CONTEXT')
+
+    utc1, utc2 = utc_jd(0.5*(start + end))
+    ctx = coodgeo.get_context(utc1[0], utc2[0], SC, MCOW, window=0.5*(end - start) + step)
+    ri, di = ctx.atciq(ra, dec)
+
+    def elevation(i):
+        def f(x):
+            u1, u2 = utc_jd(x)
+            return 90. - np.rad2deg(ctx.atioq(ri[i], di[i], ctx.eral_at(u1, u2))[1])
+        return f
+
+    table = np.zeros(len(ra), dtype=VISIBILITY_DTYPE)
+    table['ra'] = ra
+    table['dec'] = dec
+    up = El>=limit
+    table['above'] = (up[:-1] & up[1:]).sum(axis=0)*step
+
+    # limit crossings, (interval, source) pairs
+    rise = np.full(len(ra), np.inf)
+    sett = np.full(len(ra), np.inf)
+    for rising, cross in [(True, ~up[:-1] & up[1:]), (False, up[:-1] & ~up[1:])]:
+        k, i = np.nonzero(cross)
+        if not len(k):
+            continue
+        f = elevation(i)
+        root = _bisect(lambda x: f(x) - limit, t[k], t[k+1], rising)
+        if rising:
+            np.minimum.at(rise, i, root)
+            np.add.at(table['above'], i, t[k+1] - root)
+        else:
+            np.minimum.at(sett, i, root)
+            np.add.at(table['above'], i, root - t[k])
+    table['rise'] = np.where(np.isinf(rise), np.nan, rise)
+    table['set'] = np.where(np.isinf(sett), np.nan, sett)
+
+    # upper culmination inside the window
+    kmax = El.argmax(axis=0)
+    table['max_el'] = El[kmax, np.arange(len(ra))]
+    table['transit'] = np.nan
+    i = np.nonzero((kmax>0) & (kmax<len(t) - 1))[0]
+    if len(i):
+        k = kmax[i]
+        table['transit'][i], table['max_el'][i] = _golden(elevation(i), t[k-1], t[k+1])
+    return table
+
+def _visibility_chunk(args):
+    return visibility(*args)
+
+class VisibilityPlanner(object):
+    '''
+    visibility of catalogues on a process pool
+
+    Each worker builds its own CoordGeometry once and keeps it for all later
+    chunks, so only RA, Dec and the results cross the process boundary.
+    '''
+    def __init__(self, processes=None, step=600., limit=EL_LIMIT, chunksize=2000, **geometry):
+        '''
+        processes:  pool size, default os.cpu_count(); 0 works in this process
+        step:       coarse grid step (s)
+        limit:      elevation limit (deg)
+        chunksize:  sources per task
+        geometry:   keyword arguments of CoordGeometry (iersfile, ephfile, precision)
+        '''
+        self.processes = os.cpu_count() if processes is None else int(processes)
+        self.step = float(step)
+        self.limit = float(limit)
+        self.chunksize = int(chunksize)
+        self.geometry = geometry
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes, _init_worker, (self.geometry,))
+        return self._pool
+
+    def plan(self, sources, start, end, SC=None, MCOW=None):
+        '''
+        sources:    structured array with 'ra', 'dec' (rad) and optional 'name'
+                    fields, e.g. SourceList.sources
+        start, end: UNIX times of the window (s)
+        SC, MCOW:   site and weather, default is the observer of the workers
+        return:     structured array of VISIBILITY_DTYPE, one row per source;
+                    rise and set are the first crossings of the limit (UNIX
+                    times, NaN if none, set before rise when the source is up
+                    at the start), transit is NaN when the maximum elevation is
+                    at an end of the window, above is the time above the limit (s)
+        '''
+        n = len(sources)
+        bounds = list(range(0, n, self.chunksize)) + [n]
+        tasks = [(sources['ra'][a:b], sources['dec'][a:b], start, end, self.step, self.limit, SC, MCOW)
+                 for a, b in zip(bounds[:-1], bounds[1:])]
+        if self.processes==0:
+            if _geometry_args!=self.geometry:
+                _init_worker(self.geometry)
+            chunks = [_visibility_chunk(task) for task in tasks]
+        else:
+            chunks = self._get_pool().map(_visibility_chunk, tasks)
+        table = np.concatenate(chunks) if chunks else np.zeros(0, dtype=VISIBILITY_DTYPE)
+        if 'name' in sources.dtype.names:
+            table['name'] = sources['name']
+        logger.info('visibility of {} sources from {} to {}'.format(n, start, end))
+        return table
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _clock(t):
+    return '--:--:--' if np.isnan(t) else time.strftime('%H:%M:%S', time.gmtime(t))
+
+def format_table(table):
+    '''
+    text lines of a visibility table, times in UTC
+    '''
+    lines = ['{:<16s} {:>8s} {:>8s} {:>8s} {:>7s} {:>8s}'.format('name', 'rise', 'set', 'transit', 'max_el', 'above_h')]
+    for row in table:
+        lines.append('{:<16s} {} {} {} {:7.2f} {:8.2f}'.format(row['name'], _clock(row['rise']), _clock(row['set']),
+                                                               _clock(row['transit']), row['max_el'], row['above']/3600.))
+    return lines
+
+if __name__=='__main__':
+    import sys
+    from yn40mtcs.func.sourcelist import SourceList
+    print('testing visibility.py')
+    # night of the date in argv (UTC+8, 18:00 to 06:00 local time)
+    night = sys.argv[1] if len(sys.argv)>1 else '2023-09-10'
+    start = (np.datetime64(night + 'T10:00:00') - np.datetime64('1970-01-01T00:00:00'))/np.timedelta64(1, 's')
+    end = start + 12*3600.
+
+    with VisibilityPlanner() as planner:
+        for filenum in ['0', '1', '2']:
+            srclst = SourceList(filenum=filenum)
+            print(srclst.filename)
+            print('\n'.join(format_table(planner.plan(srclst.sources, start, end))))
+
+    # refined crossings against a fine direct grid
+    rng = np.random.default_rng(1)
+    sources = np.zeros(200, dtype=VISIBILITY_DTYPE)
+    sources['ra'] = rng.uniform(0., 2*np.pi, len(sources))
+    sources['dec'] = np.arcsin(rng.uniform(-0.6, 1., len(sources)))
+    table = visibility(sources['ra'], sources['dec'], start, end)
+    t = np.arange(start, end + 1., 5.)
+    Az, El = _get_geometry().radec2azel_batch(sources['ra'], sources['dec'], t, backend='CONTEXT')
+    above = (El[:-1]>=EL_LIMIT).sum(axis=0)*5.
+    print('time above the limit, max |refined - 5 s grid|: %.1f s' % np.abs(table['above'] - above).max())
+    print('max elevation, max |refined - 5 s grid|: %.4f deg' % np.abs(table['max_el'] - El.max(axis=0)).max())
+
+    # 100k synthetic sources, scaling with the number of workers
+    sources = np.zeros(100000, dtype=VISIBILITY_DTYPE)
+    sources['ra'] = rng.uniform(0., 2*np.pi, len(sources))
+    sources['dec'] = np.arcsin(rng.uniform(-1., 1., len(sources)))
+    for processes in [0] + sorted(set([1, 2, 4, os.cpu_count()])):
+        with VisibilityPlanner(processes, chunksize=5000) as planner:
+            tic = time.perf_counter()
+            table = planner.plan(sources, start, end)
+            print('%d sources, %d workers: %.2f s, %d ever above %.1f deg' % (len(sources), processes,
+                    time.perf_counter() - tic, (table['above']>0).sum(), EL_LIMIT))
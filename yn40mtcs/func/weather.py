@@ -0,0 +1,258 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+'''
+    weather input stage: live pressure, temperature and humidity from a
+    file, UDP or ZMQ feed (or a simulator) into the observer context
+    Date   : Oct. 18th 2026
+'''
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from yn40mtcs.core.constants import LOGGER_NAME
+from yn40mtcs.func.astrometry import refco
+
+logger = logging.getLogger('{}.func.{}'.format(LOGGER_NAME, __name__))
+
+Reading = namedtuple('Reading', ['time', 'pressure', 'temperature', 'humidity'])
+
+# the weather in use is replaced when a reading changes the refraction
+# (iauRefco) by more than THRESHOLD (arcsec) at THRESHOLD_EL (deg) elevation;
+# at 800 hPa and 25 C that is about 0.3 hPa, 0.03 C or 0.06% humidity
+THRESHOLD = 0.1
+THRESHOLD_EL = 10.
+
+def parse(message):
+    '''
+    one reading from text: JSON {"pressure":, "temperature":, "humidity":[, "time":]}
+    or 'pressure temperature humidity' / 'time pressure temperature humidity'
+    (blank or comma separated); humidity above 1 is taken as percent
+    '''
+    if isinstance(message, bytes):
+        message = message.decode('ascii', 'replace')
+    message = message.strip()
+    if message.startswith('{'):
+        d = json.loads(message)
+        t = float(d.get('time', time.time()))
+        p, tc, rh = float(d['pressure']), float(d['temperature']), float(d['humidity'])
+    else:
+        values = [float(v) for v in message.replace(',', ' ').split()]
+        if len(values)==3:
+            t = time.time()
+            p, tc, rh = values
+        elif len(values)==4:
+            t, p, tc, rh = values
+        else:
+            raise ValueError('cannot read weather from "{}"'.format(message))
+    if rh>1.:
+        rh /= 100.
+    return Reading(t, p, tc, rh)
+
+class FileSource(object):
+    '''
+    last line of a text file written by the weather station
+    '''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._mtime = None
+
+    def read(self, timeout):
+        mtime = os.path.getmtime(self.filepath)
+        if mtime==self._mtime:
+            time.sleep(timeout)
+            return None
+        self._mtime = mtime
+        with open(self.filepath, 'rb') as f:
+            f.seek(max(0, os.path.getsize(self.filepath) - 4096))
+            lines = [v for v in f.read().splitlines() if v.strip() and not v.startswith(b'#')]
+        return parse(lines[-1]) if lines else None
+
+    def close(self):
+        pass
+
+class UDPSource(object):
+    '''
+    one reading per datagram
+    '''
+    def __init__(self, port, host='0.0.0.0'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, int(port)))
+
+    def read(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            data, addr = self.sock.recvfrom(1024)
+        except socket.timeout:
+            return None
+        return parse(data)
+
+    def close(self):
+        self.sock.close()
+
+class ZMQSource(object):
+    '''
+    ZMQ SUB socket, the last frame of each message is the reading
+    '''
+    def __init__(self, address, topic=b''):
+        import zmq
+        self._zmq = zmq
+        self.context = zmq.Context.instance()
+        self.sock = self.context.socket(zmq.SUB)
+        self.sock.setsockopt(zmq.SUBSCRIBE, topic)
+        self.sock.connect(address)
+
+    def read(self, timeout):
+        if not self.sock.poll(int(timeout*1000)):
+            return None
+        return parse(self.sock.recv_multipart()[-1])
+
+    def close(self):
+        self.sock.close()
+
+class SimulatedSource(object):
+    '''
+    stand-in weather station: slow drifts and noise around a base reading
+    '''
+    def __init__(self, pressure=800., temperature=15., humidity=0.5, seed=None):
+        self.base = (pressure, temperature, humidity)
+        self._rng = np.random.default_rng(seed)
+
+    def read(self, timeout):
+        time.sleep(timeout)
+        t = time.time()
+        p, tc, rh = self.base
+        phase = 2*np.pi*t/86400.
+        return Reading(t, p + 2.*np.sin(phase) + self._rng.normal(0., 0.05),
+                       tc + 5.*np.sin(phase) + self._rng.normal(0., 0.02),
+                       float(np.clip(rh + 0.2*np.cos(phase) + self._rng.normal(0., 0.005), 0., 1.)))
+
+    def close(self):
+        pass
+
+def open_source(spec):
+    '''
+    'file:path', 'udp:[host:]port', 'zmq:tcp://host:port' or 'sim'
+    '''
+    kind, _, arg = spec.partition(':')
+    if kind=='file':
+        return FileSource(arg)
+    if kind=='udp':
+        host, _, port = arg.rpartition(':')
+        return UDPSource(port, host or '0.0.0.0')
+    if kind=='zmq':
+        return ZMQSource(arg)
+    if kind=='sim':
+        return SimulatedSource()
+    raise ValueError('unknown weather source {}'.format(spec))
+
+class WeatherStation(object):
+    '''
+    reads a source in a background thread and pushes readings into an
+    ObserverContext when one of them changes the refraction beyond the
+    threshold, so the observer state is replaced at most once per such
+    change and the coordinate calls keep their constant cost
+    '''
+    def __init__(self, observer, source, threshold=THRESHOLD, elevation=THRESHOLD_EL, maxage=600., on_update=None):
+        '''
+        observer:  astrometry.ObserverContext (e.g. CoordGeometry.observer)
+        source:    object with read(timeout) -> Reading or None, or a spec for open_source
+        threshold: refraction change (arcsec) at elevation (deg) that is applied
+        maxage:    readings older than this (s) are ignored
+        on_update: on_update(state) after the observer took a reading, for
+                   the users of the state that do not read it on every call
+                   (precomputed trajectories, the coordinate service)
+        '''
+        self.observer = observer
+        self.source = open_source(source) if isinstance(source, str) else source
+        self.threshold = float(threshold)
+        # refraction at zenith distance Z is A tan(Z) + B tan(Z)^3
+        self._tz = np.tan(np.deg2rad(90. - elevation))
+        self.maxage = float(maxage)
+        self.on_update = on_update
+        self.last = None
+        self.updates = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def feed(self, reading):
+        '''
+        apply one reading, True if the refraction was re-evaluated
+        '''
+        if time.time() - reading.time>self.maxage:
+            logger.warning('weather reading from {} is stale, ignored'.format(reading.time))
+            return False
+        state = self.observer.state
+        refa, refb = refco((reading.pressure, reading.temperature, reading.humidity) + state.MCOW[3:])
+        tz = self._tz
+        if abs((refa - state.refa)*tz + (refb - state.refb)*tz**3)*206264.806<self.threshold:
+            return False
+        state = self.observer.set_weather(reading.pressure, reading.temperature, reading.humidity)
+        self.last = reading
+        self.updates += 1
+        logger.debug('weather {:.1f} hPa {:.2f} C {:.3f}'.format(reading.pressure, reading.temperature, reading.humidity))
+        if self.on_update is not None:
+            self.on_update(state)
+        return True
+
+    def _run(self, period):
+        while not self._stop.is_set():
+            try:
+                reading = self.source.read(period)
+                if reading is not None:
+                    self.feed(reading)
+            except Exception as msg:
+                logger.error('weather input failed: {}'.format(msg))
+                self._stop.wait(period)
+
+    def start(self, period=1.):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(period,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.source.close()
+
+if __name__=='__main__':
+    from yn40mtcs.func.conv_coord import CoordGeometry
+    print('testing weather.py')
+    coodgeo = CoordGeometry()
+    station = WeatherStation(coodgeo.observer, SimulatedSource(seed=1))
+
+    # an hour of 1 s readings: how often the refraction is re-evaluated
+    t0 = time.time()
+    sim = station.source
+    for i in range(3600):
+        p, tc, rh = sim.base
+        phase = 2*np.pi*(t0 + i)/86400.
+        station.feed(Reading(t0, p + 2.*np.sin(phase) + sim._rng.normal(0., 0.05),
+                             tc + 5.*np.sin(phase) + sim._rng.normal(0., 0.02), rh + 0.2*np.cos(phase)))
+    print('3600 readings, %d refraction updates, observer revision %d' % (station.updates, coodgeo.observer.state.revision))
+
+    # UDP feed into a running station, per-call cost of the tracking path
+    station = WeatherStation(coodgeo.observer, 'udp:127.0.0.1:50051')
+    station.start(0.1)
+    out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    out.sendto(b'780.5 12.3 45', ('127.0.0.1', 50051))
+    time.sleep(0.3)
+    print('after UDP reading:', coodgeo.observer.state.MCOW)
+    for feed in [False, True]:
+        start = time.perf_counter()
+        for i in range(2000):
+            coodgeo.radec2azel('05:34:32.00 22:00:58.00', curtim=1694347200. + i*4e-4, backend='CONTEXT')
+            if feed and i % 100==0:
+                out.sendto(('%f 12.3 45' % (780. + i*0.01)).encode(), ('127.0.0.1', 50051))
+        print('CONTEXT radec2azel %s live weather: %.1f us per call' % \
+                ('with' if feed else 'without', (time.perf_counter() - start)/2000*1e6))
+    print('refraction updates from UDP:', station.updates)
+    station.stop()